@@ -11,12 +11,12 @@ import sys
 import os
 import io
 import pathlib
-import tqdm
 import templating
 import variational_analysis
 import topology_inference
 import subprocess
 import process_results
+import scheduler
 import util
 import Bio
 import Bio.Phylo
@@ -33,8 +33,6 @@ def do_coverage(config):
     beast_args = ['java'] + util.cmd_kwargs(jar=config['beast_jar'], seed=config['seed']) + ['-overwrite']
 
     print('Running simulations for seed {0}'.format(config['seed']))
-    pop_size, taxon_names, date_trait_string = build_templates.build_tree_sim(config)
-
     def run_beast(xml_path, **kwargs):
         result = subprocess.run(beast_args + [xml_path], **kwargs)
         if result.returncode != 0:
@@ -44,10 +42,13 @@ def do_coverage(config):
         else:
             print('Ran BEAST ({0}) successfully'.format(xml_path))
 
-
-        
-    run_beast(build_templates.tree_sim_out_path)
-    newick_string = build_templates.extract_newick_string(build_templates.tree_sim_result_path)
+    native_simulation = config.get('simulator', 'native') == 'native'
+    if native_simulation:
+        pop_size, taxon_names, date_trait_string, newick_string = build_templates.simulate_tree(config)
+    else:
+        pop_size, taxon_names, date_trait_string = build_templates.build_tree_sim(config)
+        run_beast(build_templates.tree_sim_out_path)
+        newick_string = build_templates.extract_newick_string(build_templates.tree_sim_result_path)
 
     run_summary = {
         'config': config,
@@ -59,9 +60,12 @@ def do_coverage(config):
     with(open(build_templates.run_summary_path, 'w')) as f:
         yaml.dump(run_summary, f)
 
-    build_templates.build_seq_sim(config, taxon_names, newick_string)
-    run_beast(build_templates.seq_sim_out_path)
-    sequence_dict = build_templates.extract_sequence_dict()
+    if native_simulation:
+        sequence_dict = build_templates.simulate_sequences(config, newick_string)
+    else:
+        build_templates.build_seq_sim(config, taxon_names, newick_string)
+        run_beast(build_templates.seq_sim_out_path)
+        sequence_dict = build_templates.extract_sequence_dict()
 
     print('Running topology inference for seed {0}'.format(config['seed']))
     nj_tree = topology_inference.get_neighbor_joining_tree(sequence_dict)
@@ -78,10 +82,14 @@ def do_coverage(config):
 
     print('Running PyMC for seed {0}'.format(config['seed']))
     tree = newick.loads(analysis_newick)[0]
-    model = variational_analysis.construct_model(config, tree, sequence_dict)
-    inference = variational_analysis.construct_inference(config, model)
-
-    approx = inference.fit(config['n_iter'])
+    if variational_analysis.supports_shared_model(config): # Compiled once per worker for each taxon count
+        analysis = variational_analysis.model_factory.get_analysis(config, tree, sequence_dict)
+        model, inference = analysis.model, analysis.inference
+        approx = analysis.fit(config['n_iter'])
+    else:
+        model = variational_analysis.construct_model(config, tree, sequence_dict)
+        inference = variational_analysis.construct_inference(config, model)
+        approx = inference.fit(config['n_iter'])
 
     with open(build_templates.pymc_analysis_result_path, 'wb') as f:
         pickle.dump(approx, f)
@@ -123,7 +131,9 @@ def do_coverage(config):
 
     all_quantile_df = pd.concat([beast_quantile_df.assign(method='BEAST'), pymc_quantile_df.assign(method='Variational')])
     result_df = all_quantile_df.assign(seed=config['seed'], truth=all_quantile_df.variable.replace(true_values))
-    result_df.to_csv(build_templates.run_results_path)
+    results_tmp_path = build_templates.run_results_path.with_name(build_templates.run_results_file + '.tmp') # results.csv marks the replicate complete, so it is written atomically
+    result_df.to_csv(results_tmp_path)
+    os.replace(results_tmp_path, build_templates.run_results_path)
     return result_df
 
 
@@ -134,12 +144,18 @@ if __name__ == '__main__':
         config = yaml.load(f)
     
     out_dir = pathlib.Path(config['out_dir'])
-    def run_iteration(i):
-        run_out_dir = out_dir / str(i)
-        run_seed = i + 1
-        run_config = util.update_dict(config, out_dir=str(run_out_dir), seed=run_seed) 
-        return do_coverage(run_config)
-    
-    runs = [run_iteration(i) for i in tqdm.tqdm(range(config['n_runs']))]
-    result_df = pd.concat(runs)
-    result_df.to_csv(out_dir / 'results.csv', index=False)
+    os.makedirs(out_dir, exist_ok=True)
+    results_path = out_dir / 'results.csv'
+    complete_runs = [i for i in range(config['n_runs']) if scheduler.is_complete(scheduler.get_run_config(config, out_dir, i), 'results.csv')]
+    if complete_runs: # Rebuild the combined results from replicates finished in earlier runs
+        pd.concat([pd.read_csv(out_dir / str(i) / 'results.csv', index_col=0) for i in complete_runs]).to_csv(results_path, index=False)
+    elif results_path.exists():
+        os.remove(results_path)
+
+    def append_results(i, result_df):
+        result_df.to_csv(results_path, mode='a', header=not results_path.exists(), index=False)
+
+    failed = scheduler.run_replicates(do_coverage, config, out_dir, 'results.csv',
+        worker_count=config.get('n_workers'), on_result=append_results)
+    if failed:
+        sys.exit('Replicates {0} failed, rerun to retry them'.format(failed))
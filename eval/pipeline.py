@@ -1,12 +1,27 @@
 import sys
 import os
 import yaml
-import util
 import pathlib
 import papermill
-from tqdm import tqdm
+import scheduler
 import nbconvert
 
+def run_notebook(run_config):
+    run_out_dir = pathlib.Path(run_config['out_dir'])
+    if not os.path.exists(run_out_dir):
+        os.makedirs(run_out_dir)
+
+    run_nb = run_out_dir / 'pipeline.ipynb'
+    running_nb = run_out_dir / 'pipeline-running.ipynb' # Renamed on success, so pipeline.ipynb marks the replicate complete
+    papermill.execute_notebook(
+        'pipeline.ipynb',
+        str(running_nb),
+        parameters=dict(config=run_config)
+    )
+    os.replace(running_nb, run_nb)
+    #body, resources = exporter.from_filename(str(run_nb))
+    #writer.write(output=body, resources=resources, notebook_name='pipeline')
+
 if __name__ == '__main__':
     config_filename = sys.argv[1]
     
@@ -16,22 +31,6 @@ if __name__ == '__main__':
     #exporter = nbconvert.HTMLExporter()
     #writer = nbconvert.writers.FilesWriter()
 
-    for i in tqdm(range(config['n_runs'])):
-        run_out_dir = pathlib.Path('out') / str(i)
-        if not os.path.exists(run_out_dir):
-            os.makedirs(run_out_dir)
-
-        run_seed = i + 1
-        run_config = util.update_dict(config, seed=run_seed, out_dir=str(run_out_dir))
-        run_nb = str(run_out_dir / 'pipeline.ipynb')
-        papermill.execute_notebook(
-            'pipeline.ipynb',
-            run_nb, 
-            parameters=dict(config=run_config)
-        )
-        #body, resources = exporter.from_filename(run_nb)
-        #writer.write(output=body, resources=resources, notebook_name='pipeline')
-
-
-
-
+    failed = scheduler.run_replicates(run_notebook, config, pathlib.Path('out'), 'pipeline.ipynb', worker_count=config.get('n_workers'))
+    if failed:
+        sys.exit('Replicates {0} failed, rerun to retry them'.format(failed))
@@ -51,8 +51,11 @@ def get_variational_trace(result_filename, config, sequence_dict, newick_string)
     with open(result_filename, 'rb') as f:
         pymc_tracker = pickle.load(f)
     tree = newick.loads(newick_string)[0]
-    model = variational_analysis.construct_model(config, tree, sequence_dict)
-    inference = variational_analysis.construct_inference(config, model)
+    if variational_analysis.supports_shared_model(config):
+        inference = variational_analysis.model_factory.get_analysis(config, tree, sequence_dict).inference
+    else:
+        model = variational_analysis.construct_model(config, tree, sequence_dict)
+        inference = variational_analysis.construct_inference(config, model)
     for key, var in inference.approx.shared_params.items():
         var.set_value(pymc_tracker[key][-1])
     return inference.approx.sample(config['n_trace_samples'])
@@ -0,0 +1,78 @@
+import os
+import queue
+import pathlib
+import traceback
+import multiprocessing
+import tqdm
+import util
+
+# Runs replicates in a pool of worker processes, skipping replicates that already have their output so that interrupted studies resume
+# Theano reads its flags when first imported, so each worker is started with its own compile directory in its environment
+
+def get_run_config(config, out_dir, i):
+    return util.update_dict(config, out_dir=str(pathlib.Path(out_dir) / str(i)), seed=i + 1)
+
+def is_complete(run_config, complete_file):
+    return (pathlib.Path(run_config['out_dir']) / complete_file).exists()
+
+def work(task, task_queue, result_queue):
+    for i, run_config in iter(task_queue.get, None):
+        try:
+            result_queue.put((i, task(run_config), None))
+        except Exception:
+            result_queue.put((i, None, traceback.format_exc()))
+
+def start_workers(task, task_queue, result_queue, worker_count, compile_dir):
+    context = multiprocessing.get_context('spawn') # Fresh interpreters, so Theano is imported after the environment is set
+    theano_flags = os.environ.get('THEANO_FLAGS')
+    workers = []
+    try:
+        for worker_index in range(worker_count):
+            worker_compile_dir = pathlib.Path(compile_dir).resolve() / 'worker-{0}'.format(worker_index)
+            os.environ['THEANO_FLAGS'] = ','.join(flag for flag in [theano_flags, 'base_compiledir={0}'.format(worker_compile_dir)] if flag)
+            worker = context.Process(target=work, args=(task, task_queue, result_queue), daemon=True)
+            worker.start()
+            workers.append(worker)
+    finally:
+        if theano_flags is None:
+            del os.environ['THEANO_FLAGS']
+        else:
+            os.environ['THEANO_FLAGS'] = theano_flags
+    return workers
+
+def run_replicates(task, config, out_dir, complete_file, worker_count=None, compile_dir=None, on_result=None):
+    # task(run_config) runs in a worker and should write complete_file to run_config['out_dir'] last
+    # on_result(i, result) is called in this process as each replicate finishes, and the indices of failed replicates are returned
+    run_configs = [get_run_config(config, out_dir, i) for i in range(config['n_runs'])]
+    pending = [i for i, run_config in enumerate(run_configs) if not is_complete(run_config, complete_file)]
+    tqdm.tqdm.write('Running {0} of {1} replicates, {2} already complete'.format(len(pending), len(run_configs), len(run_configs) - len(pending)))
+    if not pending:
+        return []
+
+    worker_count = min(worker_count or os.cpu_count(), len(pending))
+    context = multiprocessing.get_context('spawn')
+    task_queue, result_queue = context.Queue(), context.Queue()
+    for i in pending:
+        task_queue.put((i, run_configs[i]))
+    for _ in range(worker_count):
+        task_queue.put(None)
+    workers = start_workers(task, task_queue, result_queue, worker_count, pathlib.Path(out_dir) / 'theano' if compile_dir is None else compile_dir)
+
+    failed = []
+    for _ in tqdm.tqdm(range(len(pending))):
+        while True:
+            try:
+                i, result, error = result_queue.get(timeout=10.0)
+                break
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers): # Workers killed outside Python, e.g. by a crash in compiled code
+                    raise RuntimeError('All workers exited with replicates outstanding, rerun to resume')
+        if error is None:
+            if on_result is not None:
+                on_result(i, result)
+        else:
+            tqdm.tqdm.write('Replicate {0} failed:\n{1}'.format(i, error))
+            failed.append(i)
+    for worker in workers:
+        worker.join()
+    return sorted(failed)
@@ -5,6 +5,11 @@ import jinja2
 from Bio import Phylo
 import io
 import xml
+import xml.etree.ElementTree
+import newick
+import pylo.simulation
+from pylo.hky import HKYSubstitutionModel
+from pylo.topology import TreeTopology
 
 default_template_dir = 'templates'
 class TemplateBuilder:
@@ -64,12 +69,16 @@ class TemplateBuilder:
         self.run_trace_file = 'trace.csv'
         self.run_trace_path = self.out_path / self.run_trace_file
 
-    def build_tree_sim(self, config):
+    def draw_tree_sim_params(self, config):
         sampling_window, n_taxa = config['sampling_window'], config['n_taxa'] 
         pop_size = float(np.exp(np.random.normal(config['prior_params']['pop_size']['m'], config['prior_params']['pop_size']['s'])))
         sampling_times = [random.random() * sampling_window for i in range(n_taxa)]
         taxon_names = ["T{}".format(i) for i in range(n_taxa)]
         date_trait_string = ','.join(['{0}={1}'.format(taxon_name, sampling_time) for taxon_name, sampling_time in zip(taxon_names, sampling_times)])
+        return pop_size, sampling_times, taxon_names, date_trait_string
+
+    def build_tree_sim(self, config):
+        pop_size, sampling_times, taxon_names, date_trait_string = self.draw_tree_sim_params(config)
 
         tree_sim_template = self.template_env.get_template(self.tree_sim_template_file)
         tree_sim_string = tree_sim_template.render(pop_size=pop_size, date_trait_string=date_trait_string, taxon_names=taxon_names, out_file=self.tree_sim_result_path)  
@@ -79,6 +88,12 @@ class TemplateBuilder:
         
         return pop_size, taxon_names, date_trait_string
 
+    def simulate_tree(self, config): # In process, instead of build_tree_sim and a BEAST run
+        pop_size, sampling_times, taxon_names, date_trait_string = self.draw_tree_sim_params(config)
+        sampling_heights = max(sampling_times) - np.array(sampling_times) # Sampling times are dates
+        tree = pylo.simulation.simulate_coalescent_tree(sampling_heights, pop_size, taxon_names=taxon_names)
+        return pop_size, taxon_names, date_trait_string, newick.dumps(tree)
+
     def extract_newick_string(self, tree_path):
         with io.StringIO() as s:
             Phylo.convert(tree_path, 'nexus', s, 'newick')
@@ -95,6 +110,20 @@ class TemplateBuilder:
         with open(self.seq_sim_out_path, 'w') as f:
             f.write(seq_sim_string)
 
+    def simulate_sequences(self, config, newick_string): # In process, instead of build_seq_sim and a BEAST run, with the result written as BEAST would
+        tree = newick.loads(newick_string)[0]
+        substitution_model = HKYSubstitutionModel(config['kappa'], np.array(config['frequencies']))
+        branch_rates = None
+        if config['relaxed_clock']: # Lognormal with mean one, as UCRelaxedClockModel
+            branch_rates = np.random.lognormal(-0.5 * config['rate_sd'] ** 2, config['rate_sd'], size=TreeTopology(tree).get_node_count() - 1)
+        sequence_dict = pylo.simulation.simulate_sequences(tree, substitution_model, config['sequence_length'], rate=config['mutation_rate'], branch_rates=branch_rates)
+
+        alignment = xml.etree.ElementTree.Element('alignment')
+        for taxon_name, sequence in sequence_dict.items():
+            xml.etree.ElementTree.SubElement(alignment, 'sequence', taxon=taxon_name, value=sequence)
+        xml.etree.ElementTree.ElementTree(alignment).write(self.seq_sim_result_path)
+        return sequence_dict
+
     def extract_sequence_dict(self):
         seq_xml_root = xml.etree.ElementTree.parse(self.seq_sim_result_path)
         sequence_dict = { tag.attrib['taxon']: tag.attrib['value'] for tag in seq_xml_root.findall('./sequence') }
@@ -1,26 +1,36 @@
 import numpy as np
 import theano.tensor as tt
-from pylo.topology import TreeTopology
+from pylo.topology import TreeTopology, SharedTreeTopology
 import pylo.transform
 import newick
+import theano
 import pymc3 as pm
+from pymc3.variational.inference import State
 from pylo.tree.coalescent import CoalescentTree, ConstantPopulationFunction
 from pylo.hky import HKYSubstitutionModel
 from pylo.pruning import LeafSequences
+from pylo.clock import UncorrelatedLognormalClock, RandomLocalClock, get_child_distances
+from pylo.step_methods import CachedTreeMetropolis
 import sys
 import json
 import datetime
 import pickle
 
+def get_patterns(sequence_dict):
+    return pylo.transform.group_sequences(pylo.transform.encode_sequences(sequence_dict))
+
+def get_pattern_tables(topology, patterns): # Patterns from get_patterns to child pattern and pattern count arrays
+    pattern_dict, pattern_counts = patterns
+    return np.asarray(topology.build_sequence_table(pattern_dict)), np.asarray(pattern_counts)
+
 def construct_model(config, tree, sequence_dict):
     topology = TreeTopology(tree)
-    sequence_dict_encoded = pylo.transform.encode_sequences(sequence_dict)
-    pattern_dict, pattern_counts = pylo.transform.group_sequences(sequence_dict_encoded)
-    pattern_counts = tt.as_tensor_variable(pattern_counts)
-    child_patterns = tt.as_tensor_variable(topology.build_sequence_table(pattern_dict))
+    child_patterns, pattern_counts = get_pattern_tables(topology, get_patterns(sequence_dict))
+    return build_model(config, topology, tt.as_tensor_variable(child_patterns), tt.as_tensor_variable(pattern_counts), config['prior_params'], config['mutation_rate'])
 
+def build_model(config, topology, child_patterns, pattern_counts, prior_params, mutation_rate):
     def get_lognormal_params(var):
-        return { 'mu': config['prior_params'][var]['m'], 'sd': config['prior_params'][var]['s'], 'testval': config['init_values'][var] }
+        return { 'mu': prior_params[var]['m'], 'sd': prior_params[var]['s'], 'testval': config['init_values'][var] }
 
     with pm.Model() as model:
         pop_size = pm.Lognormal('pop_size', **get_lognormal_params('pop_size'))
@@ -30,11 +40,23 @@ def construct_model(config, tree, sequence_dict):
         kappa = pm.Lognormal('kappa', **get_lognormal_params('kappa'))
         pi = pm.Dirichlet('pi', a=np.ones(4))
         substitution_model = HKYSubstitutionModel(kappa, pi)
-        clock_rate = pm.Lognormal('clock_rate', **get_lognormal_params('clock_rate')) if config['estimate_clock_rate'] else config['mutation_rate']
+        clock_rate = pm.Lognormal('clock_rate', **get_lognormal_params('clock_rate')) if config['estimate_clock_rate'] else mutation_rate
 
-        branch_lengths = topology.get_child_branch_lengths(tree_heights)
-        distances = branch_lengths * clock_rate
-        sequences = LeafSequences('sequences', topology, substitution_model, distances, child_patterns, pattern_counts)
+        clock_model = config.get('clock_model', 'strict')
+        if clock_model == 'strict':
+            distances = topology.get_child_branch_lengths(tree_heights) * clock_rate
+        else:
+            clock_params = dict(noncentered=config.get('noncentered_clock', True))
+            if clock_model == 'uncorrelated_lognormal':
+                rate_sd = pm.Lognormal('rate_sd', **get_lognormal_params('rate_sd'))
+                branch_rates = UncorrelatedLognormalClock('branch_rates', topology, clock_rate, rate_sd, **clock_params)
+            elif clock_model == 'random_local':
+                rate_scale = pm.Lognormal('rate_scale', **get_lognormal_params('rate_scale'))
+                branch_rates = RandomLocalClock('branch_rates', topology, clock_rate, rate_scale, **clock_params)
+            else:
+                raise ValueError('Unknown clock model: {0}'.format(clock_model))
+            distances = get_child_distances(topology, tree_heights, branch_rates)
+        sequences = LeafSequences('sequences', topology, substitution_model, distances, child_patterns, pattern_counts, **config.get('likelihood', {}))
     return model
 
 class SampleTracker(pm.callbacks.Tracker):
@@ -54,6 +76,95 @@ def construct_inference(config, model):
         'full_rank': pm.FullRankADVI
     }[config['inference']](model=model)
 
+SHARED_MODEL_KEYS = ['estimate_clock_rate', 'clock_model', 'noncentered_clock', 'likelihood', 'inference'] # Config that changes the model graph
+
+def supports_shared_model(config): # Graphs that depend on the shape of the tree can't be reused for other trees
+    likelihood_config = config.get('likelihood', {})
+    return config.get('clock_model', 'strict') != 'random_local' and not likelihood_config.get('level_order', False) and not likelihood_config.get('analytic_gradient', False)
+
+class SharedAnalysis:
+    # Model and inference with the tree, site patterns and prior hyperparameters in shared variables,
+    # so the compiled inference step is reused for any data with the same number of taxa
+    def __init__(self, config, tree, patterns):
+        if not supports_shared_model(config):
+            raise ValueError('Model depends on the shape of the tree, so cannot be shared')
+        self.topology = SharedTreeTopology(tree)
+        child_patterns, pattern_counts = get_pattern_tables(self.topology, patterns)
+        self.child_patterns = theano.shared(child_patterns, name='child_patterns')
+        self.pattern_counts = theano.shared(pattern_counts, name='pattern_counts')
+        self.prior_params = { var: { key: theano.shared(float(value), name='{0}_{1}'.format(var, key)) for key, value in params.items() } for var, params in config['prior_params'].items() }
+        self.mutation_rate = theano.shared(float(config['mutation_rate']), name='mutation_rate')
+        self.model = build_model(config, self.topology, self.child_patterns, self.pattern_counts, self.prior_params, self.mutation_rate)
+        self.rng = pm.theanof.tt_rng() # Used by the approximation, and reseeded for each analysis
+        self.inference = construct_inference(config, self.model)
+        self.step = None
+        self.initial_values = None
+
+    def set_data(self, config, tree, patterns):
+        self.topology.set_tree(tree)
+        child_patterns, pattern_counts = get_pattern_tables(self.topology, patterns)
+        self.child_patterns.set_value(child_patterns)
+        self.pattern_counts.set_value(pattern_counts)
+        for var, params in config['prior_params'].items():
+            for key, value in params.items():
+                self.prior_params[var][key].set_value(float(value))
+        self.mutation_rate.set_value(float(config['mutation_rate']))
+
+    def get_start(self, config): # Test point of the current tree and initial values
+        start = self.model.test_point
+        values = dict(config['init_values'], tree=self.topology.get_init_heights()[self.topology.node_mask])
+        for name, value in values.items():
+            if name in self.model.named_vars:
+                rv = self.model.named_vars[name]
+                start[rv.transformed.name] = rv.transformation.forward_val(np.asarray(value))
+        return start
+
+    def reset(self, config): # Restores the optimizer and approximation to their initial state at the current start point
+        if self.initial_values is not None:
+            for var, value in self.initial_values:
+                if var not in self.data_variables:
+                    var.set_value(value)
+        approx = self.inference.approx
+        approx.shared_params['mu'].set_value(pm.floatX(approx.groups[0].bij.map(self.get_start(config))))
+        self.rng.seed(config['seed'])
+        self.inference.hist = np.asarray(())
+
+    @property
+    def data_variables(self):
+        return set(self.topology.shared_arrays.values()) | { self.child_patterns, self.pattern_counts, self.mutation_rate } | { var for params in self.prior_params.values() for var in params.values() }
+
+    def fit(self, n, callbacks=None, progressbar=True):
+        if self.step is None:
+            self.step = self.inference.objective.step_function(score=True)
+            self.initial_values = [(var, var.get_value()) for var in self.step.get_shared()] # Before any step, so later analyses start from the same state
+        self.inference.state = State(0, self.step, [] if callbacks is None else callbacks, True)
+        self.inference.refine(n, progressbar=progressbar)
+        self.inference.approx.hist = self.inference.hist
+        return self.inference.approx
+
+class ModelFactory:
+    # Builds one SharedAnalysis per signature of taxon count, pattern count and model config, and reuses it for later analyses
+    def __init__(self):
+        self.analyses = {}
+
+    def get_signature(self, config, patterns):
+        model_config = { key: config.get(key) for key in SHARED_MODEL_KEYS }
+        pattern_dict, pattern_counts = patterns # Site patterns size the partials, so are kept fixed like the taxa
+        return len(pattern_dict), len(pattern_counts), tuple(sorted(config['prior_params'])), json.dumps(model_config, sort_keys=True)
+
+    def get_analysis(self, config, tree, sequence_dict):
+        patterns = get_patterns(sequence_dict) # Compressed once, for both the signature and the data
+        signature = self.get_signature(config, patterns)
+        if signature in self.analyses:
+            analysis = self.analyses[signature]
+            analysis.set_data(config, tree, patterns)
+        else:
+            analysis = self.analyses[signature] = SharedAnalysis(config, tree, patterns)
+        analysis.reset(config)
+        return analysis
+
+model_factory = ModelFactory() # Per process, so each worker of a coverage study compiles once
+
 def run_analysis(config, newick_string, sequence_dict, out_file):
     tree = newick.loads(newick_string)[0]
     model = construct_model(config, tree, sequence_dict)
@@ -93,10 +204,11 @@ def run_mcmc(config, newick_string, sequence_dict, out_file):
     tree = newick.loads(newick_string)[0]
     model = construct_model(config, tree, sequence_dict)
     with model:
-        #trace = TimedTrace()
-        #step = pm.Metropolis()
-        #pm.sample(chains=1, draws=config['nuts_draws'], trace=trace, step=[step], tune=0)
-        trace = pm.sample(draws=config['nuts_draws'], tune=config['nuts_tune'])
+        if config.get('cached_tree_metropolis', False): # Node heights by Metropolis with cached partials, requires analytic_gradient in the likelihood config
+            step = CachedTreeMetropolis([model.named_vars['tree']], model.named_vars['sequences'])
+            trace = pm.sample(draws=config['nuts_draws'], tune=config['nuts_tune'], step=[step])
+        else:
+            trace = pm.sample(draws=config['nuts_draws'], tune=config['nuts_tune'])
    
     with open(out_file, 'wb') as f:
         pickle.dump(trace, f) 
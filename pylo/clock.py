@@ -0,0 +1,45 @@
+import theano.tensor as tt
+import pymc3 as pm
+from pylo.topology import SharedTreeTopology, get_node_depth_levels
+
+# Relaxed clocks, with branch rates indexed by the postorder index of the node below each branch, so the root has none
+# Non-centered variants sample standard normal offsets and scale them deterministically, which keeps ADVI and NUTS well conditioned on large trees
+
+def get_branch_count(topology):
+    return topology.get_node_count() - 1
+
+def get_child_branch_rates(topology, branch_rates): # branch_rates [..., branch] to the layout of get_child_branch_lengths
+    return branch_rates[..., topology.get_node_children()]
+
+def get_child_distances(topology, heights, branch_rates): # One gather and multiply over all branches
+    return topology.get_child_branch_lengths(heights) * get_child_branch_rates(topology, branch_rates)
+
+def get_root_path_sums(topology, branch_values): # Sum of branch_values [branch] from the root down to each branch, filled level by level
+    parent_indices = topology.parent_indices
+    path_sums = tt.zeros(topology.get_node_count())
+    for level in get_node_depth_levels(parent_indices)[1:]:
+        path_sums = tt.set_subtensor(path_sums[level], path_sums[parent_indices[level]] + branch_values[level])
+    return path_sums[:-1]
+
+def UncorrelatedLognormalClock(name, topology, mean_rate, sd, noncentered=True):
+    # Independent lognormal branch rates with mean mean_rate (Drummond et al. 2006)
+    branch_count = get_branch_count(topology)
+    if noncentered:
+        offsets = pm.Normal(name + '_offsets', mu=0.0, sd=1.0, shape=branch_count)
+        return pm.Deterministic(name, mean_rate * tt.exp(sd * offsets - 0.5 * sd ** 2))
+    else:
+        return pm.Lognormal(name, mu=tt.log(mean_rate) - 0.5 * sd ** 2, sd=sd, shape=branch_count)
+
+def RandomLocalClock(name, topology, root_rate, scale, noncentered=True):
+    # Rates inherited from the parent branch, with a log-rate change on each branch under a horseshoe prior
+    # Continuous shrinkage stands in for the rate-change indicators of Drummond and Suchard (2010), so most branches keep their parent's rate
+    if isinstance(topology, SharedTreeTopology): # Root paths are built from the depth levels of one tree
+        raise ValueError('Random local clock depends on the shape of the tree, so cannot use a shared topology')
+    branch_count = get_branch_count(topology)
+    local_scales = pm.HalfCauchy(name + '_local_scales', beta=1.0, shape=branch_count)
+    if noncentered:
+        offsets = pm.Normal(name + '_offsets', mu=0.0, sd=1.0, shape=branch_count)
+        log_rate_changes = scale * local_scales * offsets
+    else:
+        log_rate_changes = pm.Normal(name + '_log_rate_changes', mu=0.0, sd=scale * local_scales, shape=branch_count)
+    return pm.Deterministic(name, root_rate * tt.exp(get_root_path_sums(topology, log_rate_changes)))
@@ -1,3 +1,40 @@
+import numpy as np
+
 A, C, G, T = range(4)
+R, Y, S, W, K, M, B, D, H, V = range(4, 14) # IUPAC ambiguity codes
 GAP = -1
 DUMMY_INDEX = -1
+
+AMBIGUITY_STATES = {
+    R: [A, G], Y: [C, T], S: [C, G], W: [A, T], K: [G, T], M: [A, C],
+    B: [C, G, T], D: [A, G, T], H: [A, C, T], V: [A, C, G]
+}
+
+class Alphabet(object):
+    # Codes 0 to state_count - 1 are states, followed by ambiguity codes, and GAP indexes the last row of state_partials
+    # States are strings of one character, or several for codons
+    def __init__(self, states, ambiguities={}, aliases={}, missing='-?.'):
+        self.states = list(states)
+        self.state_count = len(self.states)
+        self.width = len(self.states[0]) # Characters per site
+        self.codes = { state: code for code, state in enumerate(self.states) }
+        state_partials = [np.eye(self.state_count)[code] for code in range(self.state_count)]
+        for char, ambiguous_states in ambiguities.items():
+            self.codes[char] = len(state_partials)
+            state_partials.append(np.eye(self.state_count)[[self.codes[state] for state in ambiguous_states]].sum(axis=0))
+        for char, state in aliases.items():
+            self.codes[char] = self.codes[state]
+        for char in missing:
+            self.codes[char] = GAP
+        self.state_partials = np.stack(state_partials + [np.ones(self.state_count)]) # [code, char]
+
+NUCLEOTIDES = Alphabet('ACGT', ambiguities={ 'RYSWKMBDHV'[code - R]: ['ACGT'[state] for state in states] for code, states in AMBIGUITY_STATES.items() }, aliases={ 'U': 'T' }, missing='-.?N')
+STATE_PARTIALS = NUCLEOTIDES.state_partials # [code, char] partial-state vector for each nucleotide code
+
+AMINO_ACIDS = Alphabet('ARNDCQEGHILKMFPSTWYV', ambiguities={ 'B': 'ND', 'Z': 'QE', 'J': 'IL' }, missing='-.?X*')
+
+# Standard genetic code, with codons ordered by nucleotide codes and stop codons as '*'
+NUCLEOTIDE_CODONS = [a + b + c for a in 'ACGT' for b in 'ACGT' for c in 'ACGT']
+GENETIC_CODE = dict(zip(NUCLEOTIDE_CODONS, 'KNKNTTTTRSRSIIMIQHQHPPPPRRRRLLLLEDEDAAAAGGGGVVVV*Y*YSSSS*CWCLFLF'))
+
+CODONS = Alphabet([codon for codon in NUCLEOTIDE_CODONS if GENETIC_CODE[codon] != '*']) # 61 sense codons
@@ -3,16 +3,29 @@ import theano
 import theano.tensor as tt
 import theano.tensor.slinalg as tsl
 
-from pylo.common import A, C, G, T
+from pylo.common import A, C, G, T, NUCLEOTIDES, CODONS, GENETIC_CODE
 
-def make_tensor(x):
-	return tt.stacklists(x)
+def make_tensor(x, like=None): # If like is given, entries are broadcast to its shape, which becomes the leading dimensions
+	if like is None or like.ndim == 0:
+		return tt.stacklists(x)
+	stacked = tt.stacklists(map_lists(lambda y: tt.zeros_like(like) + y, x))
+	list_ndim = stacked.ndim - like.ndim
+	return stacked.dimshuffle(list(range(list_ndim, stacked.ndim)) + list(range(list_ndim)))
 
-def hky_eigendecomposition(kappa, pi):
-	piY = pi[T] + pi[C]
-	piR = pi[A] + pi[G]
+def map_lists(f, x):
+	return [map_lists(f, y) for y in x] if isinstance(x, list) else f(x)
 
-	beta = -1 / (2.0 * (piR*piY + kappa * (pi[A]*pi[G] + pi[C]*pi[T])))
+def swap_last_axes(x):
+	return x.dimshuffle(list(range(x.ndim - 2)) + [x.ndim - 1, x.ndim - 2])
+
+def hky_eigendecomposition(kappa, pi): # Parameters can have leading batch dimensions
+	kappa = tt.as_tensor_variable(kappa)
+	pi = tt.as_tensor_variable(pi)
+	piA, piC, piG, piT = pi[..., A], pi[..., C], pi[..., G], pi[..., T]
+	piY = piT + piC
+	piR = piA + piG
+
+	beta = -1 / (2.0 * (piR*piY + kappa * (piA*piG + piC*piT)))
 	A_R = 1.0 + piR * (kappa - 1)
 	A_Y = 1.0 + piY * (kappa - 1)
 	lambd = make_tensor([ # Eigenvalues 
@@ -20,20 +33,21 @@ def hky_eigendecomposition(kappa, pi):
 		beta,
 		beta * A_Y,
 		beta * A_R
-	])
+	], like=beta)
 	U = make_tensor([ # Right eigenvectors as columns (rows of transpose)
 		[1, 1, 1, 1],
 		[1/piR, -1/piY, 1/piR, -1/piY],
-		[0, pi[T]/piY, 0, -pi[C]/piY],
-		[pi[G]/piR, 0, -pi[A]/piR, 0]
-	]).transpose()
+		[0, piT/piY, 0, -piC/piY],
+		[piG/piR, 0, -piA/piR, 0]
+	], like=beta)
+	U = swap_last_axes(U)
 
 	Vt = make_tensor([ # Left eigenvectors as rows
-		[pi[A], pi[C], pi[G], pi[T]],
-		[pi[A]*piY, -pi[C]*piR, pi[G]*piY, -pi[T]*piR],
+		[piA, piC, piG, piT],
+		[piA*piY, -piC*piR, piG*piY, -piT*piR],
 		[0, 1, 0, -1],
 		[1, 0, -1, 0]
-	])
+	], like=beta)
 
 	return U, lambd, Vt
 
@@ -71,6 +85,36 @@ def eigen_transition_probs_mat(eigendecomposition, t):
 
 	return (U_dot_diag_expanded * Vt_expanded).sum(axis=3)
 
+def expand_batch(x, batch_ndim, expand_ndim): # Insert broadcastable dimensions after the leading batch dimensions
+	return x.dimshuffle(list(range(batch_ndim)) + ['x'] * expand_ndim + list(range(batch_ndim, x.ndim)))
+
+def eigen_transition_probs_batch(eigendecomposition, t):
+	U, lambd, Vt = eigendecomposition # [..., 4, 4], [..., 4], [..., 4, 4]
+	batch_ndim = lambd.ndim - 1
+	distance_ndim = t.ndim - batch_ndim # t [..., t.shape]
+
+	diag = tt.exp(tt.shape_padright(t) * expand_batch(lambd, batch_ndim, distance_ndim)) # [..., t.shape, 4]
+	U_dot_diag = expand_batch(U, batch_ndim, distance_ndim) * tt.shape_padaxis(diag, -2) # [..., t.shape, 4, 4]
+	Vt_expanded = tt.shape_padaxis(expand_batch(Vt, batch_ndim, distance_ndim), -3)
+	return (tt.shape_padright(U_dot_diag) * Vt_expanded).sum(axis=-2)
+
+def hky_closed_form_transition_probs(eigendecomposition, t):
+	# P(t) = 1 pi^T + sum of exp(lambda t) u v^T over the three non-zero eigenvalues, as one product of [..., t.shape, 3] and [..., 3, 16]
+	# Relies on the first eigenvalue being zero with eigenvectors 1 and pi, as in hky_eigendecomposition
+	U, lambd, Vt = eigendecomposition # [..., 4, 4], [..., 4], [..., 4, 4]
+	batch_ndim = lambd.ndim - 1
+	distance_ndim = t.ndim - batch_ndim # t [..., t.shape]
+	rank_one_terms = tt.shape_padright(swap_last_axes(U)[..., 1:, :]) * tt.shape_padaxis(Vt[..., 1:, :], -2) # [..., 3, 4, 4]
+	rank_one_terms = rank_one_terms.reshape(tt.concatenate([rank_one_terms.shape[:-2], [16]]), ndim=rank_one_terms.ndim - 1)
+	exps = tt.exp(tt.shape_padright(t) * expand_batch(lambd[..., 1:], batch_ndim, distance_ndim)) # [..., t.shape, 3]
+	if batch_ndim == 0:
+		transition_probs = tt.dot(exps.reshape((-1, 3)), rank_one_terms)
+	else:
+		batch_exps = exps.reshape(tt.stack([-1, tt.prod(t.shape[batch_ndim:]), 3]), ndim=3)
+		transition_probs = tt.batched_dot(batch_exps, rank_one_terms.reshape(tt.stack([-1, 3, 16]), ndim=3))
+	transition_probs = transition_probs.reshape(tt.concatenate([t.shape, [4, 4]]), ndim=t.ndim + 2)
+	return transition_probs + tt.shape_padaxis(expand_batch(Vt[..., 0, :], batch_ndim, distance_ndim), -2)
+
 def eigen_transition_probs_scalar(eigendecomposition, t):
 	U, lambd, Vt = eigendecomposition
 
@@ -78,18 +122,72 @@ def eigen_transition_probs_scalar(eigendecomposition, t):
 
 def hky_transition_probs_expm(kappa, pi, t):
 	Q_nodiag = make_tensor([
-		[0, kappa*pi[C], pi[A], pi[G]],
-		[kappa*pi[T], 0, pi[A], pi[G]],
-		[pi[T], pi[C], 0, kappa*pi[G]],
-		[pi[T], pi[C], kappa*pi[A], 0]	
+		[0, pi[C], kappa*pi[G], pi[T]],
+		[pi[A], 0, pi[G], kappa*pi[T]],
+		[kappa*pi[A], pi[C], 0, pi[T]],
+		[pi[A], kappa*pi[C], pi[G], 0]
 	])
 	
 	Q_unnormalised = Q_nodiag - tt.diag(Q_nodiag.sum(axis = 1))
 	average_subs = -tt.nlinalg.trace(tt.dot(Q_unnormalised, tt.diag(pi)))
 
-	return tsl.expm(Q * t / average_subs)
+	return tsl.expm(Q_unnormalised * t / average_subs)
+
+def flatten_lists(x):
+	return [z for y in x for z in flatten_lists(y)] if isinstance(x, list) else [x]
+
+def make_array(x, shape=None): # Nested lists of scalars and arrays to [..., rows, columns], where ... is the arrays' shape
+	if shape is None:
+		shape = np.broadcast(*flatten_lists(x)).shape
+	if isinstance(x, list):
+		return np.stack([make_array(y, shape) for y in x], axis=len(shape))
+	else:
+		return np.broadcast_to(x, shape)
+
+def hky_eigendecomposition_val(kappa, pi): # Numpy, vectorised over leading dimensions of parameters
+	kappa = np.asarray(kappa, dtype=float)
+	pi = np.asarray(pi, dtype=float)
+	piA, piC, piG, piT = pi[..., A], pi[..., C], pi[..., G], pi[..., T]
+	piY = piT + piC
+	piR = piA + piG
+
+	beta = -1 / (2.0 * (piR*piY + kappa * (piA*piG + piC*piT)))
+	A_R = 1.0 + piR * (kappa - 1)
+	A_Y = 1.0 + piY * (kappa - 1)
+	shape = beta.shape
+	lambd = make_array([
+		0,
+		beta,
+		beta * A_Y,
+		beta * A_R
+	], shape)
+	U = np.swapaxes(make_array([
+		[1, 1, 1, 1],
+		[1/piR, -1/piY, 1/piR, -1/piY],
+		[0, piT/piY, 0, -piC/piY],
+		[piG/piR, 0, -piA/piR, 0]
+	], shape), -1, -2)
+
+	Vt = make_array([
+		[piA, piC, piG, piT],
+		[piA*piY, -piC*piR, piG*piY, -piT*piR],
+		[0, 1, 0, -1],
+		[1, 0, -1, 0]
+	], shape)
+
+	return U, lambd, Vt
+
+def eigen_transition_probs_val(eigendecomposition, t): # t has the eigendecomposition's leading dimensions followed by distance dimensions
+	U, lambd, Vt = eigendecomposition
+	t = np.asarray(t, dtype=float)
+	distance_dims = t.ndim - (lambd.ndim - 1)
+	expand = lambda x: np.expand_dims(x, tuple(range(lambd.ndim - 1, lambd.ndim - 1 + distance_dims)))
+	diag = np.exp(t[..., np.newaxis] * expand(lambd)) # [..., char]
+	return (expand(U) * diag[..., np.newaxis, :]) @ expand(Vt)
 
 class SubstitutionModel:
+    alphabet = NUCLEOTIDES
+
     def get_transition_probs_scalar(self, d):
         raise NotImplementedError
 
@@ -99,23 +197,41 @@ class SubstitutionModel:
     def get_transition_probs_mat(self, d):
         raise NotImplementedError
 
+    def get_transition_probs_batch(self, d):
+        raise NotImplementedError
+
+    def get_batch_ndim(self):
+        return 0
+
     def get_transition_probs(self, d):
-        if d.ndim == 0:
+        if self.get_batch_ndim() > 0 or d.ndim > 2: # d has the parameters' leading dimensions, or extra leading dimensions such as rate categories
+            return self.get_transition_probs_batch(d)
+        elif d.ndim == 0:
             return self.get_transition_probs_scalar(d)
         elif d.ndim == 1:
             return self.get_transition_probs_vec(d)
-        elif d.ndim == 2:
-            return self.get_transition_probs_mat(d)
         else:
-            raise ValueError('Only distances up to 2 dimensions supported')
+            return self.get_transition_probs_mat(d)
 
     def get_equilibrium_probs(self):
         raise NotImplementedError
 
+    def get_transition_probs_val(self, d): # Numpy
+        raise NotImplementedError
+
+    def get_equilibrium_probs_val(self):
+        raise NotImplementedError
+
 class EigenSubstitutionModel(SubstitutionModel):
     def get_eigendecomposition(self):
         raise NotImplementedError
 
+    def get_eigendecomposition_val(self):
+        raise NotImplementedError
+
+    def get_transition_probs_val(self, d):
+        return eigen_transition_probs_val(self.get_eigendecomposition_val(), d)
+
     def get_transition_probs_scalar(self, d):
         return eigen_transition_probs_scalar(self.get_eigendecomposition(), d)
         
@@ -124,28 +240,200 @@ class EigenSubstitutionModel(SubstitutionModel):
         
     def get_transition_probs_mat(self, d):
         return eigen_transition_probs_mat(self.get_eigendecomposition(), d)
+
+    def get_transition_probs_batch(self, d):
+        return eigen_transition_probs_batch(self.get_eigendecomposition(), d)
+
+    def get_batch_ndim(self):
+        return self.get_eigendecomposition()[1].ndim - 1
     
-class HKYSubstitutionModel(EigenSubstitutionModel):
+class HKYSubstitutionModel(EigenSubstitutionModel): # Parameters are either Theano variables or arrays for Numpy evaluation
     def __init__(self, kappa, pi):
         self.kappa = kappa
         self.pi = pi
-        self.eigendecomposition = hky_eigendecomposition(kappa, pi)
+        self.eigendecomposition = None
 
     def get_eigendecomposition(self):
+        if self.eigendecomposition is None:
+            self.eigendecomposition = hky_eigendecomposition(self.kappa, self.pi)
         return self.eigendecomposition
 
+    def get_transition_probs(self, d): # Closed form for distances of any shape
+        return hky_closed_form_transition_probs(self.get_eigendecomposition(), tt.as_tensor_variable(d))
+
+    def get_equilibrium_probs(self):
+        return self.pi
+
+    def get_eigendecomposition_val(self):
+        return hky_eigendecomposition_val(self.kappa, self.pi)
+
+    def get_equilibrium_probs_val(self):
+        return np.asarray(self.pi, dtype=float)
+
+# Exchangeability rates are ordered by rows of the upper triangle, AC, AG, AT, CG, CT, GT for nucleotides
+def get_exchangeability_indices(state_count):
+	return np.triu_indices(state_count, 1)
+
+def reversible_symmetric_matrix(rates, pi, state_count=4):
+	# Rate matrix symmetrised as diag(sqrt(pi)) Q diag(1/sqrt(pi)), normalised to one expected substitution per unit time
+	sqrt_pi = tt.sqrt(pi)
+	rows, columns = get_exchangeability_indices(state_count)
+	exchangeabilities = tt.set_subtensor(tt.zeros((state_count, state_count))[rows, columns], rates)
+	exchangeabilities = exchangeabilities + exchangeabilities.T
+	Q_nodiag = exchangeabilities * pi
+	Q_diag = -Q_nodiag.sum(axis=1)
+	average_subs = -(Q_diag * pi).sum()
+	return (tt.outer(sqrt_pi, sqrt_pi) * exchangeabilities + tt.diag(Q_diag)) / average_subs
+
+def reversible_eigendecomposition(rates, pi, eigh=None, state_count=4):
+	sqrt_pi = tt.sqrt(pi)
+	lambd, W = (tt.nlinalg.Eigh() if eigh is None else eigh)(reversible_symmetric_matrix(rates, pi, state_count))
+	U = W / sqrt_pi.dimshuffle(0, 'x')
+	Vt = W.T * sqrt_pi.dimshuffle('x', 0)
+	return U, lambd, Vt
+
+def reversible_symmetric_matrix_val(rates, pi): # Numpy, vectorised over leading dimensions of parameters
+	state_count = pi.shape[-1]
+	sqrt_pi = np.sqrt(pi)
+	rows, columns = get_exchangeability_indices(state_count)
+	exchangeabilities = np.zeros(np.broadcast(rates[..., 0], pi[..., 0]).shape + (state_count, state_count))
+	exchangeabilities[..., rows, columns] = exchangeabilities[..., columns, rows] = rates
+	Q_nodiag = exchangeabilities * pi[..., np.newaxis, :]
+	Q_diag = -Q_nodiag.sum(axis=-1)
+	average_subs = -(Q_diag * pi).sum(axis=-1)
+	symmetric = sqrt_pi[..., :, np.newaxis] * exchangeabilities * sqrt_pi[..., np.newaxis, :] + Q_diag[..., np.newaxis] * np.eye(state_count)
+	return symmetric / average_subs[..., np.newaxis, np.newaxis]
+
+def reversible_eigendecomposition_val(rates, pi):
+	rates = np.asarray(rates, dtype=float)
+	pi = np.asarray(pi, dtype=float)
+	sqrt_pi = np.sqrt(pi)
+	lambd, W = np.linalg.eigh(reversible_symmetric_matrix_val(rates, pi))
+	return W / sqrt_pi[..., :, np.newaxis], lambd, np.swapaxes(W, -1, -2) * sqrt_pi[..., np.newaxis, :]
+
+class CachedEigh(tt.nlinalg.Eigh):
+    # Reuses the last decomposition while the matrix is unchanged, e.g. when only branch lengths change between evaluations
+    def __init__(self, UPLO='L'):
+        super().__init__(UPLO=UPLO)
+        self.cache = None
+
+    def perform(self, node, inputs, outputs):
+        (x,) = inputs
+        if self.cache is None or not np.array_equal(self.cache[0], x):
+            self.cache = (x.copy(), np.linalg.eigh(x, self.UPLO))
+        w, v = self.cache[1]
+        outputs[0][0] = w.copy()
+        outputs[1][0] = v.copy()
+
+class ReversibleSubstitutionModel(EigenSubstitutionModel):
+    # Subclasses give exchangeability rates [..., state_count * (state_count - 1) / 2] and equilibrium frequencies [..., state_count]
+    # Theano parameters can't have batch dimensions, Numpy parameters can
+    def __init__(self):
+        self.eigendecomposition = None
+        self.eigendecomposition_val_cache = None
+
+    def get_rates(self):
+        raise NotImplementedError
+
+    def get_rates_val(self):
+        raise NotImplementedError
+
+    def get_eigendecomposition(self):
+        if self.eigendecomposition is None:
+            self.eigendecomposition = reversible_eigendecomposition(self.get_rates(), self.get_equilibrium_probs(), eigh=CachedEigh(), state_count=self.alphabet.state_count)
+        return self.eigendecomposition
+
+    def get_eigendecomposition_val(self):
+        rates = self.get_rates_val()
+        pi = self.get_equilibrium_probs_val()
+        cached = self.eigendecomposition_val_cache
+        if cached is None or not (np.array_equal(cached[0], rates) and np.array_equal(cached[1], pi)):
+            self.eigendecomposition_val_cache = (rates, pi, reversible_eigendecomposition_val(rates, pi))
+        return self.eigendecomposition_val_cache[2]
+
+class GTRSubstitutionModel(ReversibleSubstitutionModel): # Any alphabet, e.g. AMINO_ACIDS with equal rates for the Poisson model
+    def __init__(self, rates, pi, alphabet=NUCLEOTIDES):
+        super().__init__()
+        self.rates = rates
+        self.pi = pi
+        self.alphabet = alphabet
+
+    def get_rates(self):
+        return tt.as_tensor_variable(self.rates)
+
+    def get_rates_val(self):
+        return np.asarray(self.rates, dtype=float)
+
+    def get_equilibrium_probs(self):
+        return self.pi
+
+    def get_equilibrium_probs_val(self):
+        return np.asarray(self.pi, dtype=float)
+
+class TN93SubstitutionModel(ReversibleSubstitutionModel):
+    def __init__(self, kappa_R, kappa_Y, pi): # Purine and pyrimidine transition rates relative to transversions
+        super().__init__()
+        self.kappa_R = kappa_R
+        self.kappa_Y = kappa_Y
+        self.pi = pi
+
+    def get_rates(self):
+        return make_tensor([1.0, self.kappa_R, 1.0, 1.0, self.kappa_Y, 1.0])
+
+    def get_rates_val(self):
+        return make_array([1.0, self.kappa_R, 1.0, 1.0, self.kappa_Y, 1.0])
+
     def get_equilibrium_probs(self):
         return self.pi
 
-jc_eigendecomposition = (
-    make_tensor([
+    def get_equilibrium_probs_val(self):
+        return np.asarray(self.pi, dtype=float)
+
+def get_codon_exchangeability_masks(alphabet=CODONS):
+    # Whether each pair of codons, ordered as get_exchangeability_indices, differs at a single position,
+    # by a transition, and by a non-synonymous substitution
+    rows, columns = get_exchangeability_indices(alphabet.state_count)
+    codon_pairs = [(alphabet.states[i], alphabet.states[j]) for i, j in zip(rows, columns)]
+    differences = [[(x, y) for x, y in zip(*codon_pair) if x != y] for codon_pair in codon_pairs]
+    single_change = np.array([len(difference) == 1 for difference in differences])
+    transition = np.array([len(difference) == 1 and set(difference[0]) in ({'A', 'G'}, {'C', 'T'}) for difference in differences])
+    non_synonymous = np.array([GENETIC_CODE[x] != GENETIC_CODE[y] for x, y in codon_pairs])
+    return single_change, transition, non_synonymous
+
+class GY94SubstitutionModel(ReversibleSubstitutionModel):
+    # Goldman and Yang (1994) codon model with transition-transversion ratio kappa and non-synonymous-synonymous ratio omega
+    alphabet = CODONS
+
+    def __init__(self, kappa, omega, pi):
+        super().__init__()
+        self.kappa = kappa
+        self.omega = omega
+        self.pi = pi
+        self.single_change, self.transition, self.non_synonymous = get_codon_exchangeability_masks(self.alphabet)
+
+    def get_rates(self):
+        return self.single_change * tt.switch(self.transition, self.kappa, 1.0) * tt.switch(self.non_synonymous, self.omega, 1.0)
+
+    def get_rates_val(self):
+        kappa = np.asarray(self.kappa, dtype=float)[..., np.newaxis]
+        omega = np.asarray(self.omega, dtype=float)[..., np.newaxis]
+        return self.single_change * np.where(self.transition, kappa, 1.0) * np.where(self.non_synonymous, omega, 1.0)
+
+    def get_equilibrium_probs(self):
+        return self.pi
+
+    def get_equilibrium_probs_val(self):
+        return np.asarray(self.pi, dtype=float)
+
+jc_eigendecomposition_val = (
+    np.array([
         [1.0, 2.0, 0.0, 0.5],
         [1.0, -2.0, 0.5, 0.0],
         [1.0, 2.0, 0.0, -0.5],
         [1.0, -2.0, -0.5, 0.0]
     ]),
-    make_tensor([0.0, -1.3333333333333333, -1.3333333333333333, -1.3333333333333333]),
-    make_tensor([
+    np.array([0.0, -1.3333333333333333, -1.3333333333333333, -1.3333333333333333]),
+    np.array([
         [0.25, 0.25, 0.25, 0.25],
         [0.125, -0.125, 0.125, -0.125],
         [0.0, 1.0, 0.0, -1.0],
@@ -153,9 +441,17 @@ jc_eigendecomposition = (
     ])
 )
 
+jc_eigendecomposition = tuple(tt.as_tensor(x) for x in jc_eigendecomposition_val)
+
 class JCSubstitutionModel(EigenSubstitutionModel):
     def get_eigendecomposition(self):
        return jc_eigendecomposition
     
     def get_equilibrium_probs(self):
         return tt.as_tensor(np.full(4, 0.25))
+
+    def get_eigendecomposition_val(self):
+        return jc_eigendecomposition_val
+
+    def get_equilibrium_probs_val(self):
+        return np.full(4, 0.25)
@@ -0,0 +1,156 @@
+import numpy as np
+from pylo.common import STATE_PARTIALS
+from pylo.topology import get_node_levels
+
+# Arrays may have leading batch dimensions before the node dimension
+
+def get_leaf_partials(child_patterns, state_partials=STATE_PARTIALS):
+    return state_partials[np.asarray(child_patterns)] # [node, child, site, char]
+
+def exclusive_products(x, axis):
+    # Product of all other elements along axis, without dividing
+    x = np.moveaxis(x, axis, 0)
+    ones = np.ones_like(x[:1])
+    prefix_products = np.cumprod(np.concatenate([ones, x[:-1]]), axis=0)
+    suffix_products = np.cumprod(np.concatenate([ones, x[:0:-1]]), axis=0)[::-1]
+    return np.moveaxis(prefix_products * suffix_products, 0, axis)
+
+def make_scaled_partial_probabilities(child_indices, child_transition_probs, leaf_partials, child_leaf_mask, node_levels):
+    # child_transition_probs [..., node, child, parent_char, child_char]
+    batch_shape = child_transition_probs.shape[:-4]
+    partials = np.zeros(batch_shape + leaf_partials.shape[:1] + leaf_partials.shape[2:]) # [..., node, site, char]
+    log_scale_factors = np.zeros(partials.shape[:-1]) # [..., node, site]
+    child_partials = np.zeros(batch_shape + leaf_partials.shape) # [..., node, child, site, child_char]
+    child_contributions = np.zeros(batch_shape + leaf_partials.shape) # [..., node, child, site, parent_char]
+
+    for level in node_levels:
+        child_partials[..., level, :, :, :] = np.where(child_leaf_mask[level, :, np.newaxis, np.newaxis], leaf_partials[level], partials[..., child_indices[level], :, :])
+        child_contributions[..., level, :, :, :] = child_partials[..., level, :, :, :] @ np.swapaxes(child_transition_probs[..., level, :, :, :], -1, -2)
+        node_partials = child_contributions[..., level, :, :, :].prod(axis=-3)
+        scale_factors = node_partials.max(axis=-1)
+        partials[..., level, :, :] = node_partials / scale_factors[..., np.newaxis]
+        log_scale_factors[..., level, :] = np.log(scale_factors)
+
+    return partials, log_scale_factors, child_partials, child_contributions
+
+def get_scaled_site_likelihoods(partials, character_frequencies):
+    return np.einsum('...sc,...c->...s', partials[..., -1, :, :], character_frequencies)
+
+def phylogenetic_log_likelihood(child_indices, child_transition_probs, leaf_partials, child_leaf_mask, pattern_frequencies, character_frequencies, node_levels=None):
+    if node_levels is None:
+        node_levels = get_node_levels(child_indices)
+    partials, log_scale_factors, _, _ = make_scaled_partial_probabilities(child_indices, child_transition_probs, leaf_partials, child_leaf_mask, node_levels)
+    return log_likelihood_from_partials(partials, log_scale_factors, pattern_frequencies, character_frequencies)
+
+def log_likelihood_from_partials(partials, log_scale_factors, pattern_frequencies, character_frequencies):
+    site_log_likelihoods = np.log(get_scaled_site_likelihoods(partials, character_frequencies)) + log_scale_factors.sum(axis=-2)
+    return site_log_likelihoods @ pattern_frequencies
+
+# Gradients with respect to transition probabilities and character frequencies from a pre-order pass over upper partials
+# Upper partials are derivatives of the weighted site log-likelihoods with respect to each node's scaled partials
+def phylogenetic_log_likelihood_gradient(child_indices, child_transition_probs, leaf_partials, child_leaf_mask, pattern_frequencies, character_frequencies, node_levels=None):
+    if node_levels is None:
+        node_levels = get_node_levels(child_indices)
+    forward_partials = make_scaled_partial_probabilities(child_indices, child_transition_probs, leaf_partials, child_leaf_mask, node_levels)
+    return phylogenetic_log_likelihood_gradient_from_partials(child_indices, child_transition_probs, child_leaf_mask, pattern_frequencies, character_frequencies, node_levels, *forward_partials)
+
+# As above, reusing the outputs of make_scaled_partial_probabilities from the log-likelihood evaluation
+def phylogenetic_log_likelihood_gradient_from_partials(child_indices, child_transition_probs, child_leaf_mask, pattern_frequencies, character_frequencies, node_levels, partials, log_scale_factors, child_partials, child_contributions):
+    site_weights = pattern_frequencies / get_scaled_site_likelihoods(partials, character_frequencies) # [..., site]
+
+    upper_partials = np.zeros(partials.shape) # [..., node, site, char]
+    upper_partials[..., -1, :, :] = site_weights[..., np.newaxis] * character_frequencies[..., np.newaxis, :]
+    transition_probs_grad = np.zeros(child_transition_probs.shape)
+
+    for level in reversed(node_levels):
+        node_upper_partials = upper_partials[..., level, :, :] * np.exp(-log_scale_factors[..., level, :, np.newaxis]) # [..., node, site, parent_char]
+        child_upper_contributions = node_upper_partials[..., np.newaxis, :, :] * exclusive_products(child_contributions[..., level, :, :, :], axis=-3) # [..., node, child, site, parent_char]
+        transition_probs_grad[..., level, :, :, :] = np.swapaxes(child_upper_contributions, -1, -2) @ child_partials[..., level, :, :, :]
+        child_upper_partials = child_upper_contributions @ child_transition_probs[..., level, :, :, :] # [..., node, child, site, child_char]
+        internal_child_mask = ~child_leaf_mask[level]
+        upper_partials[..., child_indices[level][internal_child_mask], :, :] = child_upper_partials[..., internal_child_mask, :, :]
+
+    character_frequencies_grad = np.einsum('...s,...sc->...c', site_weights, partials[..., -1, :, :])
+    return transition_probs_grad, character_frequencies_grad
+
+def get_internal_parent_indices(child_indices, child_leaf_mask): # Parent of each internal node, -1 for the root
+    parent_indices = np.full(len(child_indices), -1)
+    nodes = np.repeat(np.arange(len(child_indices))[:, np.newaxis], child_indices.shape[1], axis=1)
+    parent_indices[child_indices[~child_leaf_mask]] = nodes[~child_leaf_mask]
+    return parent_indices
+
+class CachedPartials:
+    # Scaled partials of each node are kept between evaluations, and only nodes with a changed child transition matrix
+    # and their ancestors are recomputed, as in BEAST's tree likelihood
+    # Each node has two buffers, so the partials from before a proposal are restored without recomputation
+    # Arrays are as in phylogenetic_log_likelihood, without batch dimensions
+    def __init__(self, child_indices, leaf_partials, child_leaf_mask, pattern_frequencies):
+        self.child_indices = np.asarray(child_indices)
+        self.leaf_partials = leaf_partials
+        self.child_leaf_mask = np.asarray(child_leaf_mask, dtype=bool)
+        self.pattern_frequencies = np.asarray(pattern_frequencies, dtype=float)
+        self.parent_indices = get_internal_parent_indices(self.child_indices, self.child_leaf_mask)
+        node_count = len(self.child_indices)
+        self.partials = np.zeros((2, node_count) + leaf_partials.shape[2:]) # [buffer, node, site, char]
+        self.log_scale_factors = np.zeros((2, node_count) + leaf_partials.shape[2:-1]) # [buffer, node, site], summed over each node's subtree
+        self.buffer_indices = np.zeros(node_count, dtype=int)
+        self.changed_mask = np.zeros(node_count, dtype=bool) # Nodes with a new buffer since the last store
+        self.child_transition_probs = None
+        self.stored_child_transition_probs = None
+        self.update_count = 0 # Node partials computed
+
+    def get_dirty_nodes(self, child_transition_probs): # Postorder indices of nodes to recompute
+        if self.child_transition_probs is None:
+            return np.arange(len(self.child_indices))
+        dirty_mask = np.zeros(len(self.child_indices), dtype=bool)
+        for node in np.flatnonzero((child_transition_probs != self.child_transition_probs).any(axis=(1, 2, 3))):
+            while node >= 0 and not dirty_mask[node]: # Stop at ancestors already marked
+                dirty_mask[node] = True
+                node = self.parent_indices[node]
+        return np.flatnonzero(dirty_mask)
+
+    def update_node(self, node, child_transition_probs):
+        child_indices = self.child_indices[node]
+        child_leaf_mask = self.child_leaf_mask[node]
+        child_buffer_indices = self.buffer_indices[child_indices]
+        child_partials = np.where(child_leaf_mask[:, np.newaxis, np.newaxis], self.leaf_partials[node], self.partials[child_buffer_indices, child_indices]) # [child, site, char]
+        node_partials = (child_partials @ np.swapaxes(child_transition_probs[node], -1, -2)).prod(axis=0)
+        scale_factors = node_partials.max(axis=-1)
+        child_log_scale_factors = np.where(child_leaf_mask[:, np.newaxis], 0.0, self.log_scale_factors[child_buffer_indices, child_indices]).sum(axis=0)
+        if not self.changed_mask[node]: # Keep the stored buffer
+            self.buffer_indices[node] = 1 - self.buffer_indices[node]
+            self.changed_mask[node] = True
+        self.partials[self.buffer_indices[node], node] = node_partials / scale_factors[:, np.newaxis]
+        self.log_scale_factors[self.buffer_indices[node], node] = np.log(scale_factors) + child_log_scale_factors
+        self.update_count += 1
+
+    def log_likelihood(self, child_transition_probs, character_frequencies):
+        for node in self.get_dirty_nodes(child_transition_probs):
+            self.update_node(node, child_transition_probs)
+        self.child_transition_probs = np.array(child_transition_probs)
+        root_buffer_index = self.buffer_indices[-1]
+        site_log_likelihoods = np.log(self.partials[root_buffer_index, -1] @ character_frequencies) + self.log_scale_factors[root_buffer_index, -1]
+        return site_log_likelihoods @ self.pattern_frequencies
+
+    def store(self): # Accept the partials of the last evaluation
+        self.changed_mask[:] = False
+        self.stored_child_transition_probs = self.child_transition_probs
+
+    def restore(self): # Return to the partials at the last store
+        self.buffer_indices[self.changed_mask] = 1 - self.buffer_indices[self.changed_mask]
+        self.changed_mask[:] = False
+        self.child_transition_probs = self.stored_child_transition_probs
+
+def leaf_sequences_log_likelihood(topology, substitution_model, child_distances, child_patterns, pattern_frequencies):
+    # Substitution model parameters and distances can have matching leading batch dimensions
+    if not topology.is_binary:
+        raise ValueError('NumPy likelihood is only supported for binary trees')
+    return phylogenetic_log_likelihood(
+        topology.node_child_indices,
+        substitution_model.get_transition_probs_val(child_distances),
+        get_leaf_partials(child_patterns, substitution_model.alphabet.state_partials),
+        topology.get_node_child_leaf_mask(),
+        np.asarray(pattern_frequencies, dtype=float),
+        substitution_model.get_equilibrium_probs_val(),
+        node_levels=topology.get_node_levels()
+    )
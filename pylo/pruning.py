@@ -1,7 +1,11 @@
+import numpy as np
 import theano
 import theano.tensor as tt
 from theano.ifelse import ifelse
-from pylo.common import GAP
+from pylo.common import GAP, STATE_PARTIALS
+from pylo.topology import get_node_levels, get_child_levels, get_child_parent_indices
+import pylo.numpy_pruning
+from pylo.rates import get_category_distances
 from pymc3.distributions import Discrete
 from pymc3 import Potential
 import pymc3 as pm
@@ -9,51 +13,401 @@ import pymc3 as pm
 def logsumexp(x, axis=None):
     return pm.math.logsumexp(x, axis=axis).take(0, axis=axis)
 
+
+# Transition probabilities and partials may have batch dimensions (...) after the leading node/child dimension
+
+def pad_child_mask(child_mask, ndim): # [child] to [child, (...)]
+	return child_mask.dimshuffle([0] + ['x'] * (ndim - 1))
+
+def flatten_node_children(x): # [node, child, ...] to [node * child, ...]
+	return x.reshape(tt.concatenate([[x.shape[0] * x.shape[1]], x.shape[2:]]), ndim=x.ndim - 1)
+
+def unflatten_node_children(x, child_count): # [node * child, ...] to [node, child, ...]
+	return x.reshape(tt.concatenate([[x.shape[0] // child_count, child_count], x.shape[1:]]), ndim=x.ndim + 1)
+
+def swap_last_axes(x):
+	return x.dimshuffle(list(range(x.ndim - 2)) + [x.ndim - 1, x.ndim - 2])
+
+def batched_matmul(x, y): # [..., n, m] and [..., m, k] with identical leading dimensions
+	x_flat = x.reshape(tt.concatenate([[-1], x.shape[-2:]]), ndim=3)
+	y_flat = y.reshape(tt.concatenate([[-1], y.shape[-2:]]), ndim=3)
+	return tt.batched_dot(x_flat, y_flat).reshape(tt.concatenate([x.shape[:-1], y.shape[-1:]]), ndim=x.ndim)
+
+# With site_partitions [site], the last batch dimension of child_transition_probs is a partition,
+# and each site is evaluated with the transition probabilities of its partition
+def get_batch_ndim(child_transition_probs, site_partitions, child_ndim=1): # Batch dimensions other than the partition
+	return child_transition_probs.ndim - child_ndim - 2 - (0 if site_partitions is None else 1)
+
+def expand_site_transition_probs(child_transition_probs, site_partitions): # [child, ..., (partition), parent_char, child_char] to [child, ..., site, parent_char, child_char]
+	if site_partitions is None:
+		return tt.shape_padaxis(child_transition_probs, -3) # [child, ..., (site), parent_char, child_char]
+	return child_transition_probs.take(site_partitions, axis=child_transition_probs.ndim - 3)
+
+def alloc_partials(child_transition_probs, node_count, site_count, *trailing_shape, child_ndim=2, site_partitions=None): # [node, ..., site, *trailing_shape]
+	batch_shape = [child_transition_probs.shape[i] for i in range(child_ndim, child_ndim + get_batch_ndim(child_transition_probs, site_partitions, child_ndim=child_ndim))]
+	return tt.alloc(0.0, node_count, *(batch_shape + [site_count] + list(trailing_shape)))
+
+def partials_from_partials(child_partials, child_transition_probs, site_partitions=None):
+	# child_partials [child, ..., site, child_char]
+	child_partials_shuffled = tt.shape_padaxis(child_partials, -2) # [child, ..., site, (parent_char), child_char]
+	transition_probs_shuffled = expand_site_transition_probs(child_transition_probs, site_partitions) # [child, ..., (site), parent_char, child_char]
+	return logsumexp(child_partials_shuffled + transition_probs_shuffled, axis=-1)
+
+MATMUL_STATE_COUNT = 4 # Above this many states, log-space partials are computed with matrix products of the transition probabilities
+
+def uses_matmul_partials(state_partials): # If so, log-space pruning takes transition probabilities rather than their logs
+	return state_partials.shape[1] > MATMUL_STATE_COUNT
+
+def partials_from_partials_matmul(child_partials, child_transition_probs, site_partitions=None):
+	# child_partials [child, ..., site, child_char] in log space, child_transition_probs in probability space
+	# Exponentiated partials are shifted by their maximum at each site, which cancels out, to avoid underflow
+	max_partials = theano.gradient.disconnected_grad(child_partials.max(axis=-1)) # [child, ..., site]
+	shifted_partials = tt.exp(child_partials - tt.shape_padright(max_partials))
+	return tt.log(scaled_partials_from_partials(shifted_partials, child_transition_probs, site_partitions)) + tt.shape_padright(max_partials)
+
+def gather_sequence_transition_probs(child_sequences, child_transition_probs, site_partitions=None):
+	# child_sequences [child, site], child_transition_probs [child, ..., (partition), parent_char, code]
+	batch_ndim = get_batch_ndim(child_transition_probs, site_partitions)
+	children = tt.arange(child_sequences.shape[0]).dimshuffle(0, 'x') # [child, (site)]
+	if site_partitions is None:
+		transition_probs_by_code = child_transition_probs.dimshuffle([0, batch_ndim + 2] + list(range(1, batch_ndim + 2))) # [child, code, ..., parent_char]
+		gathered = transition_probs_by_code[children, child_sequences] # [child, site, ..., parent_char]
+	else:
+		transition_probs_by_code = child_transition_probs.dimshuffle([0, batch_ndim + 1, batch_ndim + 3] + list(range(1, batch_ndim + 1)) + [batch_ndim + 2]) # [child, partition, code, ..., parent_char]
+		gathered = transition_probs_by_code[children, site_partitions, child_sequences] # [child, site, ..., parent_char]
+	return gathered.dimshuffle([0] + list(range(2, batch_ndim + 2)) + [1, batch_ndim + 2]) # [child, ..., site, parent_char]
+
+# Ambiguous codes contribute the summed transition probabilities of their states
+# state_partials [code, child_char] are those of the sequences' alphabet
+def extend_transition_probs(child_transition_probs, state_partials=STATE_PARTIALS): # [..., parent_char, child_char] to [..., parent_char, code]
+	return tt.dot(child_transition_probs, state_partials.T)
+
+def extend_log_transition_probs(child_log_transition_probs, state_partials=STATE_PARTIALS):
+	log_state_partials = np.where(state_partials > 0.0, 0.0, -np.inf) # [code, child_char]
+	return logsumexp(tt.shape_padaxis(child_log_transition_probs, -2) + log_state_partials, axis=-1)
+
+def get_gap_mask(child_sequences, batch_ndim): # [child, (...), site, (parent_char)]
+	return tt.eq(child_sequences, GAP).dimshuffle([0] + ['x'] * batch_ndim + [1, 'x'])
+
+def partials_from_sequences(child_sequences, child_transition_probs, site_partitions=None, state_partials=STATE_PARTIALS):
+	# child_transition_probs [child, ..., parent_char, child_char]
+	batch_ndim = get_batch_ndim(child_transition_probs, site_partitions)
+	return tt.switch(get_gap_mask(child_sequences, batch_ndim), 0.0, gather_sequence_transition_probs(child_sequences, extend_log_transition_probs(child_transition_probs, state_partials), site_partitions)) # [child, ..., site, parent_char]
+
+def child_partials_from_partials(child_indices, child_transition_probs, child_sequences, child_leaf_mask, partial_probs, site_partitions=None, state_partials=STATE_PARTIALS):
+	if uses_matmul_partials(state_partials): # Transition probabilities in probability space
+		leaf_child_partials = tt.log(scaled_partials_from_sequences(child_sequences, child_transition_probs, site_partitions, state_partials))
+		node_child_partials = partials_from_partials_matmul(partial_probs[child_indices], child_transition_probs, site_partitions)
+	else:
+		leaf_child_partials = partials_from_sequences(child_sequences, child_transition_probs, site_partitions, state_partials)
+		node_child_partials = partials_from_partials(partial_probs[child_indices], child_transition_probs, site_partitions)
+	return tt.switch(pad_child_mask(child_leaf_mask, leaf_child_partials.ndim), leaf_child_partials, node_child_partials) # [child, ..., site, parent_char]
+
 # For stateless children, use dummy sequence
 # For stateful children, use dummy child indices
-def make_partial_probabilities(child_indices, child_transition_probs, child_sequences, child_leaf_mask):
-	partial_probs = tt.alloc(0.0, child_indices.shape[0], child_sequences.shape[2], 4)
-	
-	def partials_from_partials(child_partials, child_transition_probs):
-		# child_partials [child, site, child_char]
-		child_partials_shuffled = child_partials.dimshuffle(0, 1, 'x', 2) # [child, site, (parent_char), child_char]
-		transition_probs_shuffled = child_transition_probs.dimshuffle(0, 'x', 1, 2) # [child, (site), parent_char, child_char]
-		return logsumexp(child_partials_shuffled + transition_probs_shuffled, axis=3)
-
-	def partials_from_sequences(child_sequences, child_transition_probs):
-		# child_transition_probs [child, parent_char, child_char] 
-		children = tt.arange(child_sequences.shape[0]).dimshuffle(0, 'x') # [child, (site)]
-		return tt.switch(tt.eq(child_sequences, GAP).dimshuffle(0, 1, 'x'), 0.0, child_transition_probs[children, :, child_sequences]) # [child, site, parent_char]
+def make_partial_probabilities(child_indices, child_transition_probs, child_sequences, child_leaf_mask, site_partitions=None, state_partials=STATE_PARTIALS):
+	partial_probs = alloc_partials(child_transition_probs, child_indices.shape[0], child_sequences.shape[2], state_partials.shape[1], site_partitions=site_partitions)
 
 	def fill_row(node_index, child_indices, child_sequences, child_transition_probs, child_leaf_mask, partial_probs):
-		leaf_child_partials = partials_from_sequences(child_sequences, child_transition_probs)
-		node_child_partials = partials_from_partials(partial_probs[child_indices], child_transition_probs)
-		return tt.set_subtensor(partial_probs[node_index], tt.switch(child_leaf_mask.dimshuffle(0, 'x', 'x'), leaf_child_partials, node_child_partials).sum(axis=0))
-		
+		child_partials = child_partials_from_partials(child_indices, child_transition_probs, child_sequences, child_leaf_mask, partial_probs, site_partitions, state_partials)
+		return tt.set_subtensor(partial_probs[node_index], child_partials.sum(axis=0))
+
 	partial_probs_filled = theano.scan(fill_row,
 		sequences=[tt.arange(child_indices.shape[0]), child_indices, child_sequences, child_transition_probs, child_leaf_mask],
 		outputs_info=partial_probs)[0][-1]
 
 	return partial_probs_filled
 
-def phylogenetic_log_likelihood(child_indices, child_transition_probs, child_patterns, child_leaf_mask, pattern_frequencies, character_frequencies):
-    partials = make_partial_probabilities(child_indices, tt.log(child_transition_probs), child_patterns, child_leaf_mask) # [node, site, char]
-    root_partials = partials[-1] #[site, char]
-    char_freqs_reshuffled = character_frequencies.dimshuffle('x', 0) #[(site), char]
-    site_logprobs = logsumexp(root_partials + tt.log(char_freqs_reshuffled), axis=1)
-    return (site_logprobs * pattern_frequencies).sum()
-    
-def LeafSequences(name, topology, substitution_model, child_distances, child_patterns, pattern_frequencies, *args, **kwargs):
+# Nodes in the same level only depend on nodes in lower levels, so each level is filled in one batched step
+def make_partial_probabilities_level_order(node_levels, child_indices, child_transition_probs, child_sequences, child_leaf_mask, site_partitions=None, state_partials=STATE_PARTIALS):
+	partial_probs = alloc_partials(child_transition_probs, child_indices.shape[0], child_sequences.shape[2], state_partials.shape[1], site_partitions=site_partitions)
+
+	for level in node_levels:
+		child_partials = child_partials_from_partials( # Flatten [node, child] into a single child axis
+			flatten_node_children(child_indices[level]),
+			flatten_node_children(child_transition_probs[level]),
+			flatten_node_children(child_sequences[level]),
+			flatten_node_children(child_leaf_mask[level]),
+			partial_probs,
+			site_partitions,
+			state_partials
+		)
+		level_partials = unflatten_node_children(child_partials, child_indices.shape[1]).sum(axis=1)
+		partial_probs = tt.set_subtensor(partial_probs[level], level_partials)
+
+	return partial_probs
+
+def scaled_partials_from_partials(child_partials, child_transition_probs, site_partitions=None):
+	# child_partials [child, ..., site, child_char], probability space
+	if site_partitions is None:
+		return batched_matmul(child_partials, swap_last_axes(child_transition_probs)) # [child, ..., site, parent_char]
+	site_transition_probs = expand_site_transition_probs(child_transition_probs, site_partitions) # [child, ..., site, parent_char, child_char]
+	return batched_matmul(tt.shape_padaxis(child_partials, -2), swap_last_axes(site_transition_probs))[..., 0, :]
+
+def scaled_partials_from_sequences(child_sequences, child_transition_probs, site_partitions=None, state_partials=STATE_PARTIALS):
+	batch_ndim = get_batch_ndim(child_transition_probs, site_partitions)
+	return tt.switch(get_gap_mask(child_sequences, batch_ndim), 1.0, gather_sequence_transition_probs(child_sequences, extend_transition_probs(child_transition_probs, state_partials), site_partitions)) # [child, ..., site, parent_char]
+
+def scaled_child_partials_from_partials(child_indices, child_transition_probs, child_sequences, child_leaf_mask, partial_probs, site_partitions=None, state_partials=STATE_PARTIALS):
+	leaf_child_partials = scaled_partials_from_sequences(child_sequences, child_transition_probs, site_partitions, state_partials)
+	node_child_partials = scaled_partials_from_partials(partial_probs[child_indices], child_transition_probs, site_partitions)
+	return tt.switch(pad_child_mask(child_leaf_mask, leaf_child_partials.ndim), leaf_child_partials, node_child_partials)
+
+def rescale_partials(node_partials):
+	# The likelihood is linear in each node's partials, so the scale factors can be treated as constants when differentiating
+	scale_factors = theano.gradient.disconnected_grad(node_partials.max(axis=-1)) # [..., site]
+	return node_partials / tt.shape_padright(scale_factors), tt.log(scale_factors)
+
+# Partials in probability space, rescaled at every node to avoid underflow
+# Returns partials [node, ..., site, char] and log scale factors [node, ..., site]
+def make_scaled_partial_probabilities(child_indices, child_transition_probs, child_sequences, child_leaf_mask, node_levels=None, site_partitions=None, state_partials=STATE_PARTIALS):
+	partial_probs = alloc_partials(child_transition_probs, child_indices.shape[0], child_sequences.shape[2], state_partials.shape[1], site_partitions=site_partitions)
+	log_scale_factors = alloc_partials(child_transition_probs, child_indices.shape[0], child_sequences.shape[2], site_partitions=site_partitions)
+
+	if node_levels is None:
+		def fill_row(node_index, child_indices, child_sequences, child_transition_probs, child_leaf_mask, partial_probs, log_scale_factors):
+			child_partials = scaled_child_partials_from_partials(child_indices, child_transition_probs, child_sequences, child_leaf_mask, partial_probs, site_partitions, state_partials)
+			node_partials, node_log_scale_factors = rescale_partials(child_partials.prod(axis=0))
+			return tt.set_subtensor(partial_probs[node_index], node_partials), tt.set_subtensor(log_scale_factors[node_index], node_log_scale_factors)
+
+		partial_probs, log_scale_factors = [output[-1] for output in theano.scan(fill_row,
+			sequences=[tt.arange(child_indices.shape[0]), child_indices, child_sequences, child_transition_probs, child_leaf_mask],
+			outputs_info=[partial_probs, log_scale_factors])[0]]
+	else:
+		for level in node_levels:
+			child_partials = scaled_child_partials_from_partials(
+				flatten_node_children(child_indices[level]),
+				flatten_node_children(child_transition_probs[level]),
+				flatten_node_children(child_sequences[level]),
+				flatten_node_children(child_leaf_mask[level]),
+				partial_probs,
+				site_partitions,
+				state_partials
+			)
+			level_partials, level_log_scale_factors = rescale_partials(unflatten_node_children(child_partials, child_indices.shape[1]).prod(axis=1))
+			partial_probs = tt.set_subtensor(partial_probs[level], level_partials)
+			log_scale_factors = tt.set_subtensor(log_scale_factors[level], level_log_scale_factors)
+
+	return partial_probs, log_scale_factors
+
+# Children flattened into a single [child] axis, so nodes can have any number of children
+# child_offsets delimit the children of each node
+def make_partial_probabilities_flat(child_offsets, child_indices, child_transition_probs, child_sequences, child_leaf_mask, scaled=False, site_partitions=None, state_partials=STATE_PARTIALS):
+	node_count = child_offsets.shape[0] - 1
+	partial_probs = alloc_partials(child_transition_probs, node_count, child_sequences.shape[1], state_partials.shape[1], child_ndim=1, site_partitions=site_partitions)
+	log_scale_factors = alloc_partials(child_transition_probs, node_count, child_sequences.shape[1], child_ndim=1, site_partitions=site_partitions)
+	get_child_partials = scaled_child_partials_from_partials if scaled else child_partials_from_partials
+
+	def fill_row(node_index, start, end, partial_probs, log_scale_factors, child_indices, child_transition_probs, child_sequences, child_leaf_mask):
+		child_partials = get_child_partials(child_indices[start:end], child_transition_probs[start:end], child_sequences[start:end], child_leaf_mask[start:end], partial_probs, site_partitions, state_partials)
+		if scaled:
+			node_partials, node_log_scale_factors = rescale_partials(child_partials.prod(axis=0))
+		else:
+			node_partials, node_log_scale_factors = child_partials.sum(axis=0), log_scale_factors[node_index]
+		return tt.set_subtensor(partial_probs[node_index], node_partials), tt.set_subtensor(log_scale_factors[node_index], node_log_scale_factors)
+
+	partial_probs, log_scale_factors = [output[-1] for output in theano.scan(fill_row,
+		sequences=[tt.arange(node_count), child_offsets[:-1], child_offsets[1:]],
+		outputs_info=[partial_probs, log_scale_factors],
+		non_sequences=[child_indices, child_transition_probs, child_sequences, child_leaf_mask])[0]]
+
+	return partial_probs, log_scale_factors
+
+def make_partial_probabilities_level_order_flat(node_levels, child_offsets, child_indices, child_transition_probs, child_sequences, child_leaf_mask, scaled=False, site_partitions=None, state_partials=STATE_PARTIALS):
+	partial_probs = alloc_partials(child_transition_probs, len(child_offsets) - 1, child_sequences.shape[1], state_partials.shape[1], child_ndim=1, site_partitions=site_partitions)
+	log_scale_factors = alloc_partials(child_transition_probs, len(child_offsets) - 1, child_sequences.shape[1], child_ndim=1, site_partitions=site_partitions)
+	child_parent_indices = get_child_parent_indices(child_offsets)
+	get_child_partials = scaled_child_partials_from_partials if scaled else child_partials_from_partials
+
+	for level, level_children in zip(node_levels, get_child_levels(node_levels, child_offsets)):
+		child_partials = get_child_partials(child_indices[level_children], child_transition_probs[level_children], child_sequences[level_children], child_leaf_mask[level_children], partial_probs, site_partitions, state_partials)
+		child_level_positions = np.searchsorted(level, child_parent_indices[level_children])
+		level_partials = tt.alloc(0.0, len(level), *[child_partials.shape[i] for i in range(1, child_partials.ndim)])
+		if scaled: # Products over children as sums of logs
+			level_log_partials = tt.inc_subtensor(level_partials[child_level_positions], tt.log(child_partials))
+			level_log_scale_factors = theano.gradient.disconnected_grad(level_log_partials.max(axis=-1))
+			level_partials = tt.exp(level_log_partials - tt.shape_padright(level_log_scale_factors))
+			log_scale_factors = tt.set_subtensor(log_scale_factors[level], level_log_scale_factors)
+		else:
+			level_partials = tt.inc_subtensor(level_partials[child_level_positions], child_partials)
+		partial_probs = tt.set_subtensor(partial_probs[level], level_partials)
+
+	return partial_probs, log_scale_factors
+
+# child_transition_probs [..., node, child, parent_char, child_char] and character_frequencies [..., char]
+# can have leading batch dimensions, e.g. for parameter draws
+# If child_offsets is given, children are flattened into a single [child] axis and delimited by child_offsets
+# If category_weights [..., category] are given, the last batch dimension of child_transition_probs is a rate category,
+# and each site's likelihood is mixed over categories
+# If site_partitions [site] are given, the last batch dimension of child_transition_probs and character_frequencies [..., partition, char]
+# is a partition (after any rate category), and the log-likelihood of each partition [..., partition] is returned
+# state_partials [code, char] are those of the alphabet of child_patterns, which sets the number of characters
+def phylogenetic_log_likelihood(child_indices, child_transition_probs, child_patterns, child_leaf_mask, pattern_frequencies, character_frequencies, node_levels=None, scaled=False, child_offsets=None, category_weights=None, site_partitions=None, state_partials=STATE_PARTIALS):
+    child_indices, child_patterns, child_leaf_mask = [tt.as_tensor_variable(x) for x in [child_indices, child_patterns, child_leaf_mask]]
+    child_ndim = 2 if child_offsets is None else 1
+    batch_ndim = child_transition_probs.ndim - child_ndim - 2
+    child_transition_probs = child_transition_probs.dimshuffle(list(range(batch_ndim, batch_ndim + child_ndim)) + list(range(batch_ndim)) + [batch_ndim + child_ndim, batch_ndim + child_ndim + 1]) # [node, child, ..., parent_char, child_char]
+    if site_partitions is None:
+        char_freqs_reshuffled = tt.shape_padaxis(character_frequencies, -2) #[..., (site), char]
+    else:
+        site_partitions = tt.as_tensor_variable(site_partitions)
+        char_freqs_reshuffled = character_frequencies.take(site_partitions, axis=character_frequencies.ndim - 2) #[..., site, char]
+    if category_weights is not None:
+        char_freqs_reshuffled = tt.shape_padaxis(char_freqs_reshuffled, -3) #[..., (category), (site), char]
+    log_space_transition_probs = child_transition_probs if uses_matmul_partials(state_partials) else tt.log(child_transition_probs)
+    if child_offsets is not None:
+        if node_levels is None:
+            partials, log_scale_factors = make_partial_probabilities_flat(tt.as_tensor_variable(child_offsets), child_indices, child_transition_probs if scaled else log_space_transition_probs, child_patterns, child_leaf_mask, scaled=scaled, site_partitions=site_partitions, state_partials=state_partials)
+        else:
+            partials, log_scale_factors = make_partial_probabilities_level_order_flat(node_levels, get_constant_value(child_offsets), child_indices, child_transition_probs if scaled else log_space_transition_probs, child_patterns, child_leaf_mask, scaled=scaled, site_partitions=site_partitions, state_partials=state_partials)
+    elif scaled:
+        partials, log_scale_factors = make_scaled_partial_probabilities(child_indices, child_transition_probs, child_patterns, child_leaf_mask, node_levels=node_levels, site_partitions=site_partitions, state_partials=state_partials)
+    elif node_levels is None:
+        partials = make_partial_probabilities(child_indices, log_space_transition_probs, child_patterns, child_leaf_mask, site_partitions=site_partitions, state_partials=state_partials) # [node, ..., site, char]
+    else:
+        partials = make_partial_probabilities_level_order(node_levels, child_indices, log_space_transition_probs, child_patterns, child_leaf_mask, site_partitions=site_partitions, state_partials=state_partials)
+    root_partials = partials[-1] #[..., site, char]
+    if scaled:
+        site_logprobs = tt.log((root_partials * char_freqs_reshuffled).sum(axis=-1)) + log_scale_factors.sum(axis=0)
+    else:
+        site_logprobs = logsumexp(root_partials + tt.log(char_freqs_reshuffled), axis=-1)
+    if category_weights is not None:
+        site_logprobs = logsumexp(site_logprobs + tt.shape_padright(tt.log(category_weights)), axis=-2) # [..., site]
+    if site_partitions is None:
+        return (site_logprobs * pattern_frequencies).sum(axis=-1)
+    site_partition_mask = tt.eq(tt.shape_padright(site_partitions), tt.arange(character_frequencies.shape[-2])) # [site, partition]
+    return tt.dot(site_logprobs * pattern_frequencies, tt.cast(site_partition_mask, site_logprobs.dtype))
+
+# Concatenates the sequence tables [node, child, site] (or [child, site]) and pattern frequencies of each partition,
+# with the partition index of each site
+def concatenate_partitions(partition_child_patterns, partition_pattern_frequencies):
+    partition_child_patterns = [np.asarray(child_patterns) for child_patterns in partition_child_patterns]
+    child_patterns = np.concatenate(partition_child_patterns, axis=-1)
+    pattern_frequencies = np.concatenate([np.asarray(pattern_frequencies) for pattern_frequencies in partition_pattern_frequencies])
+    site_partitions = np.repeat(np.arange(len(partition_child_patterns)), [x.shape[-1] for x in partition_child_patterns])
+    return child_patterns, pattern_frequencies, site_partitions
+
+def get_constant_value(x):
+    if isinstance(x, tt.TensorConstant):
+        return x.data
+    elif isinstance(x, theano.Variable):
+        raise ValueError('Expected a constant, got symbolic variable {0}'.format(x))
+    else:
+        return np.asarray(x)
+
+# Tree likelihood computed in NumPy, with gradients from a single pre-order traversal
+# rather than reverse-mode differentiation through every node's partials
+# The partials of the post-order pass are extra outputs, so the gradient reuses them instead of traversing the tree again
+class PhylogeneticLikelihood(theano.Op):
+    def __init__(self, child_indices, child_patterns, child_leaf_mask, pattern_frequencies, state_partials=STATE_PARTIALS):
+        self.child_indices = np.asarray(child_indices)
+        self.leaf_partials = pylo.numpy_pruning.get_leaf_partials(child_patterns, state_partials)
+        self.child_leaf_mask = np.asarray(child_leaf_mask, dtype=bool)
+        self.pattern_frequencies = np.asarray(pattern_frequencies, dtype=float)
+        self.node_levels = get_node_levels(self.child_indices)
+        self.grad_op = PhylogeneticLikelihoodGrad(self)
+
+    def get_args(self, child_transition_probs, character_frequencies):
+        return self.child_indices, child_transition_probs, self.leaf_partials, self.child_leaf_mask, self.pattern_frequencies, character_frequencies
+
+    def __call__(self, child_transition_probs, character_frequencies): # Log-likelihood only
+        return super().__call__(child_transition_probs, character_frequencies)[0]
+
+    def make_node(self, child_transition_probs, character_frequencies):
+        child_transition_probs = tt.as_tensor_variable(child_transition_probs)
+        character_frequencies = tt.as_tensor_variable(character_frequencies)
+        batch_broadcastable = child_transition_probs.broadcastable[:-4] # Leading batch dimensions, as for phylogenetic_log_likelihood
+        partials_types = [tt.TensorType('float64', batch_broadcastable + (False,) * ndim)() for ndim in [3, 2, 4, 4]] # partials, log_scale_factors, child_partials, child_contributions
+        return theano.Apply(self, [child_transition_probs, character_frequencies], [tt.TensorType('float64', batch_broadcastable)()] + partials_types)
+
+    def perform(self, node, inputs, output_storage):
+        child_transition_probs, character_frequencies = inputs
+        forward_partials = pylo.numpy_pruning.make_scaled_partial_probabilities(self.child_indices, child_transition_probs, self.leaf_partials, self.child_leaf_mask, self.node_levels)
+        partials, log_scale_factors, _, _ = forward_partials
+        output_storage[0][0] = np.array(pylo.numpy_pruning.log_likelihood_from_partials(partials, log_scale_factors, self.pattern_frequencies, character_frequencies))
+        for storage, value in zip(output_storage[1:], forward_partials):
+            storage[0] = value
+
+    def L_op(self, inputs, outputs, output_grads): # Only the log-likelihood is differentiable
+        return self.grad_op(*(inputs + [output_grads[0]] + outputs[1:]))
+
+def sum_to_shape(x, shape): # Sum out leading dimensions added by broadcasting
+    return x.reshape((-1,) + tuple(shape)).sum(axis=0)
+
+class PhylogeneticLikelihoodGrad(theano.Op):
+    def __init__(self, likelihood_op):
+        self.likelihood_op = likelihood_op
+
+    def make_node(self, child_transition_probs, character_frequencies, output_grad, *forward_partials):
+        child_transition_probs = tt.as_tensor_variable(child_transition_probs)
+        character_frequencies = tt.as_tensor_variable(character_frequencies)
+        output_grad = tt.as_tensor_variable(output_grad)
+        forward_partials = [tt.as_tensor_variable(x) for x in forward_partials]
+        return theano.Apply(self, [child_transition_probs, character_frequencies, output_grad] + forward_partials, [child_transition_probs.type(), character_frequencies.type()])
+
+    def perform(self, node, inputs, output_storage):
+        child_transition_probs, character_frequencies, output_grad = inputs[:3]
+        likelihood_op = self.likelihood_op
+        grads = pylo.numpy_pruning.phylogenetic_log_likelihood_gradient_from_partials(likelihood_op.child_indices, child_transition_probs, likelihood_op.child_leaf_mask,
+            likelihood_op.pattern_frequencies, character_frequencies, likelihood_op.node_levels, *inputs[3:])
+        for storage, grad, input in zip(output_storage, grads, inputs):
+            weighted_grad = np.expand_dims(output_grad, tuple(range(output_grad.ndim, grad.ndim))) * grad
+            storage[0] = sum_to_shape(weighted_grad, input.shape).astype(input.dtype)
+
+# category_rates [..., category] multiply the distances for each rate category, with equal weights unless category_weights are given
+def LeafSequences(name, topology, substitution_model, child_distances, child_patterns, pattern_frequencies, *args, level_order=False, scaled=False, analytic_gradient=False, category_rates=None, category_weights=None, **kwargs):
+    if category_rates is not None:
+        category_rates = tt.as_tensor_variable(category_rates)
+        child_distances = get_category_distances(category_rates, tt.as_tensor_variable(child_distances))
+        if category_weights is None:
+            category_weights = tt.ones_like(category_rates) / category_rates.shape[-1]
     transition_probs = substitution_model.get_transition_probs(child_distances)
     character_frequencies = substitution_model.get_equilibrium_probs()
     child_leaf_mask = topology.get_node_child_leaf_mask()
+    if analytic_gradient:
+        if not topology.is_binary:
+            raise ValueError('Analytic gradient is only supported for binary trees')
+        if category_rates is not None:
+            raise ValueError('Analytic gradient is not supported with rate categories')
+        likelihood_op = PhylogeneticLikelihood(topology.node_child_indices, get_constant_value(child_patterns), child_leaf_mask, get_constant_value(pattern_frequencies), substitution_model.alphabet.state_partials)
+        logp = likelihood_op(transition_probs, character_frequencies)
+    else:
+        logp = phylogenetic_log_likelihood(
+            tt.as_tensor_variable(topology.node_child_indices),
+            transition_probs,
+            child_patterns,
+            tt.as_tensor_variable(child_leaf_mask),
+            pattern_frequencies,
+            character_frequencies,
+            node_levels=(topology.get_node_levels() if level_order else None),
+            scaled=scaled,
+            child_offsets=topology.get_node_child_offsets(),
+            category_weights=category_weights,
+            state_partials=substitution_model.alphabet.state_partials
+        )
+    return Potential(name, logp, *args, **kwargs)
+
+# Each partition has its own substitution model and rate multiplier, from partition_rates [..., partition],
+# and every partition's log-likelihood is computed in a single traversal of the tree
+def PartitionedLeafSequences(name, topology, substitution_models, child_distances, partition_child_patterns, partition_pattern_frequencies, *args, partition_rates=None, level_order=False, scaled=False, **kwargs):
+    partition_rates = tt.ones(len(substitution_models)) if partition_rates is None else tt.as_tensor_variable(partition_rates)
+    partition_distances = get_category_distances(partition_rates, tt.as_tensor_variable(child_distances)) # [..., partition, node, child]
+    partition_axis = partition_rates.ndim - 1
+    transition_probs = tt.stack([substitution_model.get_transition_probs(partition_distances.take(i, axis=partition_axis)) for i, substitution_model in enumerate(substitution_models)], axis=partition_axis)
+    character_frequencies = [substitution_model.get_equilibrium_probs() for substitution_model in substitution_models]
+    character_frequencies = tt.stack(character_frequencies, axis=character_frequencies[0].ndim - 1) # [..., partition, char]
+    child_patterns, pattern_frequencies, site_partitions = concatenate_partitions(partition_child_patterns, partition_pattern_frequencies)
     logp = phylogenetic_log_likelihood(
         tt.as_tensor_variable(topology.node_child_indices),
         transition_probs,
         child_patterns,
-        tt.as_tensor_variable(child_leaf_mask),
+        tt.as_tensor_variable(topology.get_node_child_leaf_mask()),
         pattern_frequencies,
-        character_frequencies
+        character_frequencies,
+        node_levels=(topology.get_node_levels() if level_order else None),
+        scaled=scaled,
+        child_offsets=topology.get_node_child_offsets(),
+        site_partitions=site_partitions,
+        state_partials=substitution_models[0].alphabet.state_partials
     )
-    return Potential(name, logp, *args, **kwargs)
-        
+    return Potential(name, logp.sum(axis=-1), *args, **kwargs)
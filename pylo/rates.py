@@ -0,0 +1,63 @@
+import numpy as np
+import scipy.special
+import theano
+import theano.tensor as tt
+
+# Among-site rate heterogeneity, with rate categories as an extra leading axis of distances and transition probabilities
+
+FINITE_DIFFERENCE_STEP = 1e-6 # Relative to alpha
+
+def discrete_gamma_rates_val(alpha, category_count):
+    # Mean rate of each of category_count equal-probability bins of a Gamma(alpha, alpha) distribution (Yang 1994)
+    boundaries = scipy.special.gammaincinv(alpha, np.arange(1, category_count) / category_count)
+    cumulative_means = np.concatenate([[0.0], scipy.special.gammainc(alpha + 1, boundaries), [1.0]])
+    return np.diff(cumulative_means) * category_count
+
+class DiscreteGammaRates(theano.Op):
+    __props__ = ('category_count',)
+
+    def __init__(self, category_count):
+        self.category_count = category_count
+
+    def make_node(self, alpha):
+        alpha = as_scalar_alpha(alpha)
+        return theano.Apply(self, [alpha], [tt.dvector()])
+
+    def perform(self, node, inputs, output_storage):
+        (alpha,) = inputs
+        output_storage[0][0] = discrete_gamma_rates_val(alpha, self.category_count)
+
+    def grad(self, inputs, output_grads):
+        (alpha,) = inputs
+        (rates_grad,) = output_grads
+        return [tt.dot(rates_grad, DiscreteGammaRatesDerivative(self.category_count)(alpha))]
+
+class DiscreteGammaRatesDerivative(theano.Op):
+    # Central finite difference, as the gamma quantile function has no closed-form derivative with respect to alpha
+    __props__ = ('category_count',)
+
+    def __init__(self, category_count):
+        self.category_count = category_count
+
+    def make_node(self, alpha):
+        alpha = as_scalar_alpha(alpha)
+        return theano.Apply(self, [alpha], [tt.dvector()])
+
+    def perform(self, node, inputs, output_storage):
+        (alpha,) = inputs
+        step = FINITE_DIFFERENCE_STEP * alpha
+        output_storage[0][0] = (discrete_gamma_rates_val(alpha + step, self.category_count) - discrete_gamma_rates_val(alpha - step, self.category_count)) / (2 * step)
+
+def as_scalar_alpha(alpha): # perform computes the rates of a single alpha
+    alpha = tt.as_tensor_variable(alpha)
+    if alpha.ndim != 0:
+        raise TypeError('Discrete gamma rates need a scalar alpha, got {0} dimensions'.format(alpha.ndim))
+    return alpha
+
+def get_discrete_gamma_rates(alpha, category_count=4):
+    return DiscreteGammaRates(category_count)(alpha)
+
+def get_category_distances(category_rates, child_distances):
+    # category_rates [..., category] and child_distances [..., node, child] to [..., category, node, child]
+    child_ndim = child_distances.ndim - (category_rates.ndim - 1)
+    return category_rates.dimshuffle(list(range(category_rates.ndim)) + ['x'] * child_ndim) * tt.shape_padaxis(child_distances, category_rates.ndim - 1)
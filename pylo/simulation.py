@@ -0,0 +1,61 @@
+import numpy as np
+import newick
+from pylo.topology import TreeTopology
+
+# Forward simulation of data for coverage studies, in place of BEAST's RandomTree and SequenceSimulator
+
+def simulate_coalescent_tree(sampling_times, pop_sizes, change_times=[], taxon_names=None, random_state=np.random):
+    # Serially sampled coalescent, with sampling_times [taxon] as heights and population sizes piecewise constant between change_times,
+    # pop_sizes[i] applying up to change_times[i] as in GridPopulationFunction
+    pop_sizes = np.atleast_1d(pop_sizes)
+    change_times = np.append(change_times, np.inf)
+    if taxon_names is None:
+        taxon_names = ['T{0}'.format(i) for i in range(len(sampling_times))]
+    sample_order = np.argsort(sampling_times, kind='stable')
+    sample_times = np.append(np.asarray(sampling_times, dtype=float)[sample_order], np.inf)
+
+    lineages, heights = [], []
+    time, next_sample, interval = 0.0, 0, 0
+    while next_sample < len(sampling_times) or len(lineages) > 1:
+        if len(lineages) < 2: # Nothing can coalesce before the next sample
+            time = sample_times[next_sample]
+        else:
+            coalescence_rate = 0.5 * len(lineages) * (len(lineages) - 1) / pop_sizes[interval]
+            event_time = time + random_state.exponential(1.0 / coalescence_rate)
+            if event_time < min(sample_times[next_sample], change_times[interval]):
+                i, j = sorted(random_state.choice(len(lineages), 2, replace=False), reverse=True)
+                children = [(lineages.pop(i), heights.pop(i)), (lineages.pop(j), heights.pop(j))]
+                for child, child_height in children:
+                    child.length = event_time - child_height
+                lineages.append(newick.Node(descendants=[child for child, _ in children]))
+                heights.append(event_time)
+                time = event_time
+                continue
+            time = min(sample_times[next_sample], change_times[interval]) # Memoryless, so the waiting time restarts at the next event
+        while time >= change_times[interval]:
+            interval += 1
+        while sample_times[next_sample] <= time:
+            lineages.append(newick.Node(name=taxon_names[sample_order[next_sample]]))
+            heights.append(sample_times[next_sample])
+            next_sample += 1
+    return lineages[0]
+
+def simulate_sequences(tree, substitution_model, sequence_length, rate=1.0, branch_rates=None, random_state=np.random):
+    # Sequences along a newick tree as a dict of taxon names to strings, vectorised over sites
+    # substitution_model has Numpy parameters, and branch_rates [node] are indexed by postorder index as in pylo.clock
+    topology = TreeTopology(tree)
+    parent_indices = topology.parent_indices
+    heights = topology.get_init_heights()
+    distances = (heights[parent_indices[:-1]] - heights[:-1]) * rate * (1.0 if branch_rates is None else np.asarray(branch_rates))
+    cumulative_probs = np.cumsum(substitution_model.get_transition_probs_val(distances), axis=-1) # [node, parent char, char]
+    state_count = cumulative_probs.shape[-1]
+
+    uniforms = random_state.uniform(size=(topology.get_node_count(), sequence_length, 1))
+    states = np.empty((topology.get_node_count(), sequence_length), dtype=int)
+    states[-1] = np.minimum(np.sum(uniforms[-1] > np.cumsum(substitution_model.get_equilibrium_probs_val()), axis=-1), state_count - 1)
+    for node_index in range(topology.get_node_count() - 2, -1, -1): # Parents precede children
+        site_probs = cumulative_probs[node_index, states[parent_indices[node_index]]] # [site, char]
+        states[node_index] = np.minimum(np.sum(uniforms[node_index] > site_probs, axis=-1), state_count - 1)
+
+    state_bytes = np.array([list(state.encode()) for state in substitution_model.alphabet.states], dtype=np.uint8) # [state, width]
+    return { name: state_bytes[states[node_index]].tobytes().decode() for node_index, name in zip(np.flatnonzero(topology.leaf_mask), topology.names[topology.leaf_mask]) }
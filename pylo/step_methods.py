@@ -0,0 +1,78 @@
+import numpy as np
+import theano.tensor as tt
+import pymc3 as pm
+from pymc3.step_methods.arraystep import ArrayStep, Competence, metrop_select
+from pymc3.step_methods.metropolis import tune
+from pylo.pruning import PhylogeneticLikelihood
+from pylo.numpy_pruning import CachedPartials
+
+class CachedTreeMetropolis(ArrayStep):
+    # Random-walk Metropolis on one element of vars at a time, such as a node height, with the tree likelihood from CachedPartials
+    # so a proposal only recomputes the partials of the nodes whose branches it changes and their ancestors
+    # likelihood is a LeafSequences potential with analytic_gradient=True, whose Op holds the patterns
+    name = 'cached_tree_metropolis'
+
+    default_blocked = True
+    generates_stats = True
+    stats_dtypes = [{
+        'accept': np.float64,
+        'tune': bool,
+        'scaling': np.float64,
+        'partial_updates': np.int64
+    }]
+
+    def __init__(self, vars, likelihood, scaling=1.0, tune=True, tune_interval=100, model=None, **kwargs):
+        model = pm.modelcontext(model)
+        vars = pm.inputvars(vars) # Transformed variables, as sampled
+        if likelihood.owner is None or not isinstance(likelihood.owner.op, PhylogeneticLikelihood):
+            raise ValueError('Cached likelihood requires a LeafSequences potential with analytic_gradient=True')
+        likelihood_op = likelihood.owner.op
+        self.cache = CachedPartials(likelihood_op.child_indices, likelihood_op.leaf_partials, likelihood_op.child_leaf_mask, likelihood_op.pattern_frequencies)
+
+        self.scaling = scaling
+        self.tune = tune
+        self.tune_interval = tune_interval
+        self.steps_until_tune = tune_interval
+        self.accepted = 0
+
+        factors = [var.logpt for var in model.basic_RVs] + [potential for potential in model.potentials if potential is not likelihood]
+        other_logp = model.fastfn(tt.sum([tt.sum(factor) for factor in factors]))
+        likelihood_inputs = model.fastfn(likelihood.owner.inputs) # Transition probabilities and character frequencies
+        super().__init__(vars, [other_logp, likelihood_inputs], **kwargs)
+
+    def get_logp(self, q, other_logp, likelihood_inputs):
+        return other_logp(q) + self.cache.log_likelihood(*likelihood_inputs(q))
+
+    def astep(self, q0, other_logp, likelihood_inputs):
+        if not self.steps_until_tune and self.tune:
+            self.scaling = tune(self.scaling, self.accepted / float(self.tune_interval))
+            self.steps_until_tune = self.tune_interval
+            self.accepted = 0
+
+        update_count = self.cache.update_count
+        logp0 = self.get_logp(q0, other_logp, likelihood_inputs) # Only recomputes partials if other steps changed the tree
+        self.cache.store()
+
+        q = q0.copy()
+        index = np.random.randint(len(q))
+        q[index] += np.random.normal() * self.scaling
+        accept = self.get_logp(q, other_logp, likelihood_inputs) - logp0
+        q_new, accepted = metrop_select(accept, q, q0)
+        if accepted:
+            self.cache.store()
+        else:
+            self.cache.restore()
+        self.accepted += accepted
+        self.steps_until_tune -= 1
+
+        stats = {
+            'tune': self.tune,
+            'accept': np.exp(min(accept, 0.0)),
+            'scaling': self.scaling,
+            'partial_updates': self.cache.update_count - update_count
+        }
+        return q_new, [stats]
+
+    @staticmethod
+    def competence(var, has_grad):
+        return Competence.INCOMPATIBLE # Only used when given explicitly
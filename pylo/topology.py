@@ -2,90 +2,130 @@ import numpy as np
 import theano
 import theano.tensor as tt
 
-def traverse_postorder(node, leaf_f, node_f, transform=False):
-    if node.is_leaf:
-        return np.array([leaf_f(node)])
-    else:
-        child_results = [traverse_postorder(child, leaf_f, node_f, transform=transform) for child in node.descendants]
-        if transform:
-            node_result, child_results = node_f(node, child_results) 
-        else:
-            node_result = node_f(node, child_results)
-        return np.concatenate(child_results + [[node_result]])
-
-def get_heights(node):
-    leaf_f = lambda x: 0.0
-    def node_f(node, child_heights):
-        child_branch_lengths = [child.length for child in node.descendants]
-        child_branch_heights = [single_child_heights[-1] + branch_length for single_child_heights, branch_length in zip(child_heights, child_branch_lengths)]
-        node_height = max(child_branch_heights)
-        adjusted_child_heights = [single_child_heights + (node_height - child_branch_height) for single_child_heights, child_branch_height in zip(child_heights, child_branch_heights)]
-        return node_height, adjusted_child_heights
-    return traverse_postorder(node, leaf_f, node_f, transform=True)
-
-def get_max_leaf_descendant_heights(node):
-    leaf_f = lambda x: [0.0, 0.0]
-    def node_f(node, child_results):
-        child_branch_lengths = [child.length for child in node.descendants]
-        child_branch_heights = [single_child_results[-1, 0] + branch_length for single_child_results, branch_length in zip(child_results, child_branch_lengths)]
-        node_height = max(child_branch_heights)
-        adjusted_child_results = [single_child_results + (node_height - child_branch_height) for single_child_results, child_branch_height in zip(child_results, child_branch_heights)]
-        max_leaf_descendant_height = max(adjusted_result[-1, 1] for adjusted_result in adjusted_child_results)
-        return [node_height, max_leaf_descendant_height], adjusted_child_results
-    return traverse_postorder(node, leaf_f, node_f, transform=True)[:, 1]
-
-def get_leaf_mask(node):
-    return traverse_postorder(node, lambda x: True, lambda x, y: False)
-
-def get_parent_indices(node):
-    leaf_f = lambda x: -1
-    def node_f(node, child_results):
-        lengths = np.array([len(child_result) for child_result in child_results])
-        node_index = np.sum(lengths)
-        adjustments = np.concatenate(([0], np.cumsum(lengths[:-1])))
-        adjusted_child_results = [np.concatenate((child_result[:-1] + adjustment, [node_index])) for child_result, adjustment in zip(child_results, adjustments)]
-
-        return -1, adjusted_child_results
-    return traverse_postorder(node, leaf_f, node_f, transform=True)
-
-def get_child_indices(node): # Assumes binary trees
-    leaf_f = lambda x: [-1, -1]
-    def node_f(node, child_results):
-        lengths = np.array([len(child_result) for child_result in child_results])
-        adjustments = np.concatenate(([0], np.cumsum(lengths[:-1])))
-        node_children = np.cumsum(lengths) - 1 
-        adjusted_child_results = [np.where(child_result == -1, -1, child_result + adjustment) for child_result, adjustment in zip(child_results, adjustments)]
-        return node_children, adjusted_child_results
-    return traverse_postorder(node, leaf_f, node_f, transform=True)
-
-def get_names(node):
-    leaf_f = lambda x: x.name
-    node_f = lambda x, y: None
-    return traverse_postorder(node, leaf_f, node_f)
+# Single pass over the tree without recursion, giving nodes in postorder (children in order before their parent) and parent indices
+def get_postorder(tree):
+    stack, nodes, preorder_parents = [(tree, -1)], [], []
+    while stack:
+        node, parent = stack.pop()
+        preorder_parents.append(parent)
+        nodes.append(node)
+        stack.extend((child, len(nodes) - 1) for child in node.descendants)
+    preorder_parents = np.array(preorder_parents[::-1])
+    parent_indices = np.where(preorder_parents == -1, -1, len(nodes) - 1 - preorder_parents)
+    return nodes[::-1], parent_indices
+
+def get_child_counts(parent_indices):
+    return np.bincount(parent_indices[:-1], minlength=len(parent_indices))
+
+def get_leaf_mask(parent_indices):
+    return get_child_counts(parent_indices) == 0
+
+def get_child_offsets(parent_indices): # CSR offsets of each node's children in get_flat_child_indices
+    return np.concatenate([[0], np.cumsum(get_child_counts(parent_indices))])
+
+def get_flat_child_indices(parent_indices):
+    return np.argsort(parent_indices[:-1], kind='stable') # Children of each parent stay in order
+
+def get_child_indices(parent_indices): # Assumes binary trees
+    child_indices = np.full((len(parent_indices), 2), -1)
+    flat_child_indices = get_flat_child_indices(parent_indices)
+    child_indices[parent_indices[flat_child_indices[::2]]] = flat_child_indices.reshape(-1, 2)
+    return child_indices
+
+def get_child_parent_indices(child_offsets): # Parent of each child in the flattened layout
+    return np.repeat(np.arange(len(child_offsets) - 1), np.diff(child_offsets))
+
+def get_heights(nodes, parent_indices): # Root is the distance to its furthest leaf
+    branch_lengths = [node.length or 0.0 for node in nodes]
+    depths = [0.0] * len(nodes)
+    for node_index in range(len(nodes) - 2, -1, -1): # Parents precede children in reverse postorder
+        depths[node_index] = depths[parent_indices[node_index]] + branch_lengths[node_index]
+    depths = np.array(depths)
+    return depths.max() - depths
+
+def get_max_leaf_descendant_heights(heights, leaf_mask, parent_indices):
+    max_leaf_descendant_heights = np.where(leaf_mask, heights, -np.inf).tolist()
+    for node_index, parent_index in enumerate(parent_indices[:-1]):
+        max_leaf_descendant_heights[parent_index] = max(max_leaf_descendant_heights[parent_index], max_leaf_descendant_heights[node_index])
+    return np.array(max_leaf_descendant_heights)
+
+def get_names(nodes, leaf_mask):
+    return np.array([node.name if is_leaf else None for node, is_leaf in zip(nodes, leaf_mask)], dtype=object)
+
+def get_node_levels(node_child_indices, node_child_offsets=None): # Groups of internal node indices whose children are all in lower groups
+    if node_child_offsets is None: # [node, child]
+        node_child_offsets = np.arange(len(node_child_indices) + 1) * np.shape(node_child_indices)[1]
+    node_child_indices = np.ravel(node_child_indices)
+    node_levels = np.zeros(len(node_child_offsets) - 1, dtype=int)
+    for node_index, (start, end) in enumerate(zip(node_child_offsets[:-1], node_child_offsets[1:])): # Children precede parents in postorder
+        internal_child_indices = node_child_indices[start:end][node_child_indices[start:end] != -1]
+        node_levels[node_index] = 1 + (node_levels[internal_child_indices].max() if len(internal_child_indices) > 0 else 0)
+    return [np.flatnonzero(node_levels == level) for level in range(1, node_levels.max() + 1)]
+
+def get_node_depth_levels(node_parent_indices): # Groups of internal node indices by depth below the root, whose parents are all in the previous group
+    node_depths = np.zeros(len(node_parent_indices), dtype=int)
+    for node_index in range(len(node_parent_indices) - 2, -1, -1): # Parents follow children in postorder
+        node_depths[node_index] = node_depths[node_parent_indices[node_index]] + 1
+    return np.split(np.argsort(node_depths, kind='stable'), np.cumsum(np.bincount(node_depths))[:-1])
+
+def get_child_levels(node_levels, node_child_offsets): # Positions of the children of each level's nodes in the flattened layout
+    child_parent_indices = get_child_parent_indices(node_child_offsets)
+    return [np.flatnonzero(np.isin(child_parent_indices, level)) for level in node_levels]
+
+def get_merge_positions(a_sorted, b_sorted): # Positions of the elements of two sorted vectors in their merge, with a first on ties
+    a_positions = tt.arange(a_sorted.shape[0]) + tt.extra_ops.searchsorted(b_sorted, a_sorted, side='left')
+    b_positions = tt.arange(b_sorted.shape[0]) + tt.extra_ops.searchsorted(a_sorted, b_sorted, side='right')
+    return a_positions, b_positions
+
+def merge_sorted(positions, values): # Scatters values at their merge positions, which together cover the merged vector
+    values = [tt.as_tensor_variable(value) for value in values]
+    merged = tt.zeros((sum(position.shape[0] for position in positions),), dtype=theano.scalar.upcast(*[value.dtype for value in values]))
+    for position, value in zip(positions, values):
+        merged = tt.set_subtensor(merged[position], value)
+    return merged
+
+MAX_HEIGHT_LEVELS = 64 # Deeper trees fill heights by scan, as level-order graphs grow with the number of levels
 
 class TreeTopology(object):
 
+    # Arrays over the children of internal nodes are [node, child] for binary trees
+    # Otherwise children are flattened into a single [child] axis, delimited by node_child_offsets
     def _init_mappings(self):
         self.node_indices = self.node_mask.nonzero()
-        self.node_index_mapping = np.where(self.node_mask, (np.arange(len(self.init_heights))[:, np.newaxis] == self.node_indices).argmax(axis=1), -1)
+        self.node_index_mapping = np.full(len(self.node_mask), -1)
+        self.node_index_mapping[self.node_indices] = np.arange(self.get_internal_node_count())
         node_parent_indices = self.parent_indices[self.node_mask]
         self.node_parent_indices = np.where(node_parent_indices == -1, -1, self.node_index_mapping[node_parent_indices])
-        node_child_indices = self.child_indices[self.node_mask]
-        node_child_indices = np.where(self.node_mask[node_child_indices], node_child_indices, -1)
-        self.node_child_indices = np.where(node_child_indices == -1, -1, self.node_index_mapping[node_child_indices])
-        
+        self.node_child_offsets = np.append(self.child_offsets[:-1][self.node_mask], self.child_offsets[-1]) # Leaves have no children
+        node_child_indices = self.get_node_children()
+        self.node_child_indices = np.where(self.node_mask[node_child_indices], self.node_index_mapping[node_child_indices], -1)
+        self.node_depth_levels = None # Only needed by level-order heights, so built on first use
 
     def __init__(self, tree):
         self.tree = tree
-        self.init_heights = get_heights(tree)
-        self.names = get_names(tree)
-        self.leaf_mask = get_leaf_mask(tree)
+        nodes, self.parent_indices = get_postorder(tree)
+        self.leaf_mask = get_leaf_mask(self.parent_indices)
+        self.names = get_names(nodes, self.leaf_mask)
         self.node_mask = np.logical_not(self.leaf_mask)
-        self.child_indices = get_child_indices(tree)
-        self.parent_indices = get_parent_indices(tree)
-        self.max_leaf_descendant_heights = get_max_leaf_descendant_heights(tree)
+        self.is_binary = np.all(get_child_counts(self.parent_indices)[self.node_mask] == 2)
+        self.child_offsets = get_child_offsets(self.parent_indices)
+        self.flat_child_indices = get_flat_child_indices(self.parent_indices)
+        self.child_indices = get_child_indices(self.parent_indices) if self.is_binary else None
+        self.init_heights = get_heights(nodes, self.parent_indices)
+        self.max_leaf_descendant_heights = get_max_leaf_descendant_heights(self.init_heights, self.leaf_mask, self.parent_indices)
+        self.leaf_heights_sorted = np.sort(self.init_heights[self.leaf_mask]) # Constant, so only internal heights are sorted during inference
         self._init_mappings()
 
+    def get_node_children(self): # Postorder indices of the children of internal nodes
+        return self.child_indices[self.node_mask] if self.is_binary else self.flat_child_indices
+
+    def get_node_child_parents(self): # Internal node indices of the parents of the children of internal nodes
+        child_parent_indices = get_child_parent_indices(self.node_child_offsets)
+        return child_parent_indices.reshape(-1, 2) if self.is_binary else child_parent_indices
+
+    def get_node_child_offsets(self): # None for the [node, child] layout of binary trees
+        return None if self.is_binary else self.node_child_offsets
+
     def get_init_heights(self):
         return self.init_heights
     
@@ -93,10 +133,14 @@ class TreeTopology(object):
         if dummy_seq is None:
             dummy_seq = list(sequence_dict.values())[0]
                
-        node_child_indices = self.child_indices[self.node_mask]
+        node_child_indices = self.get_node_children()
         leaf_child_names = np.where(self.leaf_mask[node_child_indices], self.names[node_child_indices], None)        
+        get_sequence = lambda name: dummy_seq if name is None else sequence_dict[name]
 
-        return [[dummy_seq if name is None else sequence_dict[name] for name in node] for node in leaf_child_names]
+        if self.is_binary:
+            return [[get_sequence(name) for name in node] for node in leaf_child_names]
+        else:
+            return [get_sequence(name) for name in leaf_child_names]
 
     def get_proportions(self, heights):
         root_height = heights[-1]
@@ -105,7 +149,18 @@ class TreeTopology(object):
         min_heights = self.max_leaf_descendant_heights[self.node_mask][:-1]
         return (non_root_heights - min_heights)/(parent_heights - min_heights), root_height - self.max_leaf_descendant_heights[-1]
 
-    def get_heights(self, root_val, proportions):
+    def get_heights(self, root_val, proportions, level_order=False):
+        if not level_order or len(self.get_node_depth_levels()) > MAX_HEIGHT_LEVELS:
+            return self.get_heights_scan(root_val, proportions)
+        # Nodes at the same depth only need their parents' heights, so each level is filled in one batched step
+        max_leaf_heights = self.max_leaf_descendant_heights[self.node_mask]
+        heights = tt.set_subtensor(tt.zeros(self.get_internal_node_count())[-1], root_val + self.max_leaf_descendant_heights[-1])
+        for level in self.get_node_depth_levels()[1:]:
+            parent_heights = heights[self.node_parent_indices[level]]
+            heights = tt.set_subtensor(heights[level], proportions[level]*(parent_heights - max_leaf_heights[level]) + max_leaf_heights[level])
+        return heights
+
+    def get_heights_scan(self, root_val, proportions): # Serial over internal nodes
         n = self.get_internal_node_count()
         parent_indices_reversed = tt.as_tensor(n - self.node_parent_indices[-2::-1] - 1)
         max_leaf_height_reversed = tt.as_tensor(self.max_leaf_descendant_heights[self.node_mask][-2::-1])
@@ -116,21 +171,40 @@ class TreeTopology(object):
         heights_reversed = theano.scan(func, sequences=(ixs, parent_indices_reversed, max_leaf_height_reversed, proportions[::-1]), outputs_info=out_init)[0][-1]
         return heights_reversed[::-1]
 
-    def get_heights_sorted(self, node_heights):
-        heights = tt.where(self.node_mask, node_heights[self.node_index_mapping], self.init_heights)
-        argsort = tt.argsort(heights)
-        return heights[argsort], tt.as_tensor_variable(self.node_mask)[argsort]
+    def get_heights_sorted(self, node_heights): # Merges sorted internal heights into the sorted leaf heights, with leaves first on ties
+        node_heights_sorted = tt.sort(node_heights)
+        positions = get_merge_positions(self.leaf_heights_sorted, node_heights_sorted)
+        heights_sorted = merge_sorted(positions, [self.leaf_heights_sorted, node_heights_sorted])
+        node_mask_sorted = merge_sorted(positions, [np.zeros(self.get_taxon_count(), dtype='int8'), np.ones(self.get_internal_node_count(), dtype='int8')])
+        return heights_sorted, tt.neq(node_mask_sorted, 0) # Compiled set_subtensor does not support bool
     
     def get_node_child_leaf_mask(self):
-        return self.leaf_mask[self.child_indices[self.node_mask]]
+        return self.leaf_mask[self.get_node_children()]
 
-    def get_child_branch_lengths(self, heights):
+    def get_child_branch_lengths(self, heights): # heights [..., node]
         child_heights = tt.where(
             self.get_node_child_leaf_mask(),
-            self.init_heights[self.child_indices[self.node_mask]],
-            heights[self.node_index_mapping[self.child_indices[self.node_mask]]]
+            self.init_heights[self.get_node_children()],
+            heights[..., self.node_index_mapping[self.get_node_children()]]
+        )
+        return heights[..., self.get_node_child_parents()] - child_heights
+
+    def get_child_branch_lengths_val(self, heights): # Numpy, heights [..., node]
+        heights = np.asarray(heights)
+        child_heights = np.where(
+            self.get_node_child_leaf_mask(),
+            self.init_heights[self.get_node_children()],
+            heights[..., self.node_index_mapping[self.get_node_children()]]
         )
-        return heights.dimshuffle(0, 'x') - child_heights
+        return heights[..., self.get_node_child_parents()] - child_heights
+
+    def get_node_levels(self):
+        return get_node_levels(self.node_child_indices, self.get_node_child_offsets())
+
+    def get_node_depth_levels(self):
+        if self.node_depth_levels is None:
+            self.node_depth_levels = get_node_depth_levels(self.node_parent_indices)
+        return self.node_depth_levels
 
     def get_internal_node_count(self):
         return np.sum(self.node_mask)
@@ -150,3 +224,114 @@ class TreeTopology(object):
     def get_max_node_heights(self):
         return self.max_leaf_descendant_heights[self.node_mask]
 
+
+class SharedTreeTopology(object):
+    # Stands in for the TreeTopology of a binary tree in model graphs, with its arrays in shared variables
+    # so that functions compiled for one tree can be reused for any binary tree with the same number of taxa through set_tree
+    # Only shape-independent graphs are supported, so heights are filled by scan and there are no node levels
+    is_binary = True
+
+    def __init__(self, tree):
+        self.topology = self.check_topology(TreeTopology(tree))
+        self.shared_arrays = { name: theano.shared(value, name=name) for name, value in self.get_arrays(self.topology).items() }
+        for name, shared_array in self.shared_arrays.items():
+            setattr(self, name, shared_array)
+
+    def check_topology(self, topology):
+        if not topology.is_binary:
+            raise ValueError('Shared topologies require binary trees')
+        if hasattr(self, 'topology') and topology.get_taxon_count() != self.topology.get_taxon_count():
+            raise ValueError('Expected a tree with {0} taxa, got {1}'.format(self.topology.get_taxon_count(), topology.get_taxon_count()))
+        return topology
+
+    def get_arrays(self, topology):
+        node_children = topology.get_node_children()
+        return {
+            'node_parent_indices': topology.node_parent_indices,
+            'node_child_indices': topology.node_child_indices,
+            'node_children': node_children,
+            'node_child_parents': topology.get_node_child_parents(),
+            'node_child_node_indices': topology.node_index_mapping[node_children],
+            'node_child_leaf_mask': topology.get_node_child_leaf_mask(),
+            'child_leaf_heights': topology.init_heights[node_children],
+            'max_node_heights': topology.get_max_node_heights(),
+            'leaf_heights_sorted': topology.leaf_heights_sorted
+        }
+
+    def set_tree(self, tree):
+        self.topology = self.check_topology(TreeTopology(tree))
+        for name, value in self.get_arrays(self.topology).items():
+            self.shared_arrays[name].set_value(value)
+
+    # Numpy values of the current tree
+    @property
+    def node_mask(self):
+        return self.topology.node_mask
+
+    def get_init_heights(self):
+        return self.topology.get_init_heights()
+
+    def build_sequence_table(self, sequence_dict, dummy_seq=None):
+        return self.topology.build_sequence_table(sequence_dict, dummy_seq=dummy_seq)
+
+    # Theano, apart from get_proportions of Numpy heights
+    def get_node_children(self):
+        return self.node_children
+
+    def get_node_child_parents(self):
+        return self.node_child_parents
+
+    def get_node_child_offsets(self):
+        return None
+
+    def get_node_child_leaf_mask(self):
+        return self.node_child_leaf_mask
+
+    def get_node_levels(self):
+        raise ValueError('Node levels depend on the shape of the tree, so are not available for shared topologies')
+
+    def get_proportions(self, heights):
+        if not isinstance(heights, theano.Variable):
+            return self.topology.get_proportions(heights)
+        parent_heights = heights[self.node_parent_indices[:-1]]
+        min_heights = self.max_node_heights[:-1]
+        return (heights[:-1] - min_heights)/(parent_heights - min_heights), heights[-1] - self.max_node_heights[-1]
+
+    def get_heights(self, root_val, proportions, level_order=False): # Always serial over internal nodes
+        n = self.get_internal_node_count()
+        parent_indices_reversed = n - self.node_parent_indices[-2::-1] - 1
+        max_leaf_height_reversed = self.max_node_heights[-2::-1]
+        out_init = tt.set_subtensor(tt.zeros(n)[0], root_val + self.max_node_heights[-1])
+        func = lambda i, parent, max_leaf, prop, out: tt.set_subtensor(out[i], prop*(out[parent] - max_leaf) + max_leaf)
+        heights_reversed = theano.scan(func, sequences=(tt.arange(1, n), parent_indices_reversed, max_leaf_height_reversed, proportions[::-1]), outputs_info=out_init)[0][-1]
+        return heights_reversed[::-1]
+
+    def get_heights_sorted(self, node_heights):
+        node_heights_sorted = tt.sort(node_heights)
+        positions = get_merge_positions(self.leaf_heights_sorted, node_heights_sorted)
+        heights_sorted = merge_sorted(positions, [self.leaf_heights_sorted, node_heights_sorted])
+        node_mask_sorted = merge_sorted(positions, [np.zeros(self.get_taxon_count(), dtype='int8'), np.ones(self.get_internal_node_count(), dtype='int8')])
+        return heights_sorted, tt.neq(node_mask_sorted, 0)
+
+    def get_child_branch_lengths(self, heights): # heights [..., node]
+        child_heights = tt.where(self.node_child_leaf_mask, self.child_leaf_heights, heights[..., self.node_child_node_indices])
+        return heights[..., self.node_child_parents] - child_heights
+
+    # Fixed by the number of taxa
+    def get_internal_node_count(self):
+        return self.topology.get_internal_node_count()
+
+    def get_node_count(self):
+        return self.topology.get_node_count()
+
+    def get_taxon_count(self):
+        return self.topology.get_taxon_count()
+
+    def get_root_index(self):
+        return self.topology.get_root_index()
+
+    def get_max_leaf_height(self):
+        return self.max_node_heights[-1]
+
+    def get_max_node_heights(self):
+        return self.max_node_heights
@@ -1,21 +1,264 @@
 from pylo.common import *
-import pandas as pd
 import numpy as np
 
+DEFAULT_CHUNK_SIZE = 10000 # Sites compressed at a time
+
 def list_concat(lists, last_item):
     return [y for x in lists for y in x] + [last_item]
 
-def encode_sequences(taxa_dict):
-    state_dict = { 'A': A, 'C': C, 'G': G, 'T': T, '-': GAP }
-    return { name: [state_dict[char] for char in sequence] for name, sequence in taxa_dict.items() }
+def make_packed_state_codes(alphabet):
+    # Byte to packed state code lookup table, codes are offset so that GAP packs to 0 and sorting is preserved
+    # Alphabets of several characters per site, such as codons, are packed as nucleotides and combined by pack_columns
+    packed_state_codes = np.full(256, INVALID_PACKED_CODE, dtype=np.uint8)
+    for char, code in (alphabet.codes.items() if alphabet.width == 1 else NUCLEOTIDES.codes.items()):
+        packed_state_codes[[ord(char), ord(char.lower())]] = code - GAP
+    return packed_state_codes
+
+INVALID_PACKED_CODE = 255
+PACKED_STATE_CODES = { NUCLEOTIDES: make_packed_state_codes(NUCLEOTIDES) } # Lookup tables by alphabet
+
+def get_packed_state_codes(alphabet):
+    if alphabet not in PACKED_STATE_CODES:
+        PACKED_STATE_CODES[alphabet] = make_packed_state_codes(alphabet)
+    return PACKED_STATE_CODES[alphabet]
+
+def make_packed_codon_codes(alphabet): # Packed codes of codons from their nucleotides, with any ambiguity or stop codon as GAP
+    packed_codon_codes = np.zeros((len(NUCLEOTIDE_CODONS),), dtype=np.uint8)
+    for i, codon in enumerate(NUCLEOTIDE_CODONS):
+        packed_codon_codes[i] = alphabet.codes.get(codon, GAP) - GAP
+    return packed_codon_codes
+
+def pack_chars(sequence, alphabet=NUCLEOTIDES): # String or bytes to packed uint8 codes of each character
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii')
+    packed = get_packed_state_codes(alphabet)[np.frombuffer(sequence, dtype=np.uint8)]
+    if (packed == INVALID_PACKED_CODE).any():
+        invalid_chars = set(chr(char) for char in np.frombuffer(sequence, dtype=np.uint8)[packed == INVALID_PACKED_CODE])
+        raise ValueError('Invalid characters in sequence: {0}'.format(sorted(invalid_chars)))
+    return packed
+
+def pack_columns(packed, alphabet=NUCLEOTIDES): # Packed characters [..., char_site] to packed codes [..., site]
+    if alphabet.width == 1:
+        return packed
+    if packed.shape[-1] % alphabet.width != 0:
+        raise ValueError('Sequence length {0} is not a multiple of {1}'.format(packed.shape[-1], alphabet.width))
+    nucleotides = unpack_codes(packed).reshape(packed.shape[:-1] + (-1, alphabet.width)) # [..., site, position]
+    codon_indices = (np.where(nucleotides >= 0, nucleotides, 0) * (4 ** np.arange(alphabet.width)[::-1])).sum(axis=-1)
+    is_unambiguous = ((nucleotides >= 0) & (nucleotides < 4)).all(axis=-1)
+    return np.where(is_unambiguous, make_packed_codon_codes(alphabet)[codon_indices], pack_codes(GAP))
+
+def pack_sequence(sequence, alphabet=NUCLEOTIDES): # String or bytes to packed uint8 codes
+    return pack_columns(pack_chars(sequence, alphabet), alphabet)
+
+def pack_codes(codes):
+    return (np.asarray(codes) - GAP).astype(np.uint8)
+
+def unpack_codes(packed):
+    return packed.astype(int) + GAP
+
+def encode_sequences(taxa_dict, alphabet=NUCLEOTIDES):
+    return { name: unpack_codes(pack_sequence(sequence, alphabet)) for name, sequence in taxa_dict.items() }
 
 def get_dummy_seq(taxa_dict):
-    return np.repeat(GAP, len(list(taxa_dict.values())[0])) 
+    return np.repeat(GAP, len(list(taxa_dict.values())[0]))
+
+def get_state_partials(codes, alphabet=NUCLEOTIDES): # [..., char]
+    return alphabet.state_partials[codes]
+
+def compress_packed_patterns(packed): # [taxon, site] to unique columns and their counts
+    columns = np.ascontiguousarray(packed.T)
+    column_view = columns.view(np.dtype((np.void, columns.shape[1]))).ravel() # Each column as a single value
+    return np.unique(column_view, return_counts=True)
 
-def group_sequences(taxa_dict):
+def merge_patterns(patterns, counts):
+    merged_patterns, inverse = np.unique(np.concatenate(patterns), return_inverse=True)
+    merged_counts = np.zeros(len(merged_patterns), dtype=int)
+    np.add.at(merged_counts, inverse, np.concatenate(counts))
+    return merged_patterns, merged_counts
+
+def unpack_patterns(patterns, taxon_count): # Unique columns to [taxon, pattern] codes
+    return unpack_codes(np.frombuffer(patterns.tobytes(), dtype=np.uint8).reshape(-1, taxon_count).T)
+
+def group_packed_chunks(named_chunks):
+    # named_chunks yields taxon names and [taxon, site] packed codes, patterns are sorted as in a groupby over taxa
+    patterns, counts = None, None
+    for taxon_names, packed in named_chunks:
+        chunk_patterns, chunk_counts = compress_packed_patterns(packed)
+        if patterns is None:
+            patterns, counts = chunk_patterns, chunk_counts
+        else:
+            patterns, counts = merge_patterns([patterns, chunk_patterns], [counts, chunk_counts])
+    if patterns is None:
+        raise ValueError('Alignment has no sites')
+    return dict(zip(taxon_names, unpack_patterns(patterns, len(taxon_names)))), counts
+
+def group_sequences(taxa_dict, chunk_size=DEFAULT_CHUNK_SIZE):
     taxon_names = list(taxa_dict.keys())
-    taxa_df = pd.DataFrame(taxa_dict)
-    pattern_series = taxa_df.groupby(taxon_names).size()
-    pattern_dict = pattern_series.index.to_frame().to_dict(orient='list')
-    return pattern_dict, pattern_series.values
+    sequences = list(taxa_dict.values())
+    site_count = len(sequences[0])
+    return group_packed_chunks((taxon_names, np.stack([pack_codes(sequence[start:start + chunk_size]) for sequence in sequences])) for start in range(0, site_count, chunk_size))
+
+# Alignment file readers yield blocks of (name, packed sequence piece) pairs, which are aligned into column chunks
+
+def read_fasta_blocks(f, alphabet=NUCLEOTIDES):
+    name, pieces = None, []
+    for line in f:
+        line = line.strip()
+        if line.startswith(b'>'):
+            if name is not None:
+                yield [(name, np.concatenate(pieces))]
+            name, pieces = line[1:].strip().decode(), []
+        elif line:
+            pieces.append(pack_chars(line, alphabet))
+    if name is not None:
+        yield [(name, np.concatenate(pieces))]
+
+def read_phylip_blocks(f, alphabet=NUCLEOTIDES):
+    # Relaxed PHYLIP, sequential with one line per taxon or interleaved
+    # Wrapped sequential lines can't be told apart from names in interleaved blocks, so taxa are checked against the header's counts instead
+    taxon_count, site_count = [int(x) for x in f.readline().split()[:2]]
+    lines = (line.strip() for line in f)
+    lines = (line for line in lines if line)
+    names, lengths = [], {}
+
+    def read_sequence(name, line):
+        sequence = b''.join(line.split())
+        lengths[name] += len(sequence)
+        if lengths[name] > site_count:
+            raise ValueError('Sequence {0} has more than the {1} characters in the header, wrapped sequential PHYLIP is not supported'.format(name, site_count))
+        return [(name, pack_chars(sequence, alphabet))]
+
+    for line in lines:
+        parts = line.split(None, 1)
+        if len(parts) < 2 or parts[0].decode() in lengths:
+            raise ValueError('Expected a taxon name and sequence, wrapped sequential PHYLIP is not supported: {0}'.format(line.decode()))
+        names.append(parts[0].decode())
+        lengths[names[-1]] = 0
+        yield read_sequence(names[-1], parts[1])
+        if len(names) == taxon_count:
+            break
+    for i, line in enumerate(lines): # Interleaved blocks without names
+        yield read_sequence(names[i % taxon_count], line)
+
+    if len(names) < taxon_count or any(length < site_count for length in lengths.values()):
+        raise ValueError('Expected {0} taxa of {1} characters, as in the header'.format(taxon_count, site_count))
+
+def strip_nexus_comments(line):
+    while b'[' in line:
+        start = line.index(b'[')
+        end = line.index(b']', start) if b']' in line[start:] else len(line)
+        line = line[:start] + line[end + 1:]
+    return line
+
+def split_nexus_name(line):
+    if line[:1] in (b"'", b'"'):
+        end = line.index(line[:1], 1)
+        return line[1:end].decode(), line[end + 1:]
+    parts = line.split(None, 1)
+    return parts[0].decode(), parts[1] if len(parts) > 1 else b''
+
+def get_nexus_options(command): # Options of a command such as DIMENSIONS or FORMAT, with flags such as INTERLEAVE as yes
+    tokens = command.lower().rstrip(b';').replace(b'=', b' = ').split()[1:]
+    options, i = {}, 0
+    while i < len(tokens):
+        if i + 2 < len(tokens) and tokens[i + 1] == b'=':
+            options[tokens[i]] = tokens[i + 2]
+            i += 3
+        else:
+            options[tokens[i]] = b'yes'
+            i += 1
+    return options
+
+def read_nexus_blocks(f, alphabet=NUCLEOTIDES):
+    # Interleaved matrices have a name on each line, while in sequential ones a taxon continues over lines until it has NCHAR characters
+    # Sequential taxa are yielded whole, as in FASTA, since a repeated name marks the start of the next interleaved block
+    in_matrix, interleaved, site_count = False, False, None
+    name, pieces, length = None, [], 0
+    for line in f:
+        line = strip_nexus_comments(line).strip()
+        if not in_matrix:
+            command = line.lower()
+            if command.startswith(b'dimensions'):
+                site_count = int(get_nexus_options(command).get(b'nchar', 0)) or None
+            elif command.startswith(b'format'):
+                interleaved = get_nexus_options(command).get(b'interleave', b'no') in (b'yes', b'true')
+            in_matrix = command == b'matrix'
+            if in_matrix and not interleaved and site_count is None:
+                raise ValueError('Sequential NEXUS matrices need NCHAR in their DIMENSIONS')
+            continue
+        end = line.endswith(b';')
+        line = line.rstrip(b';').strip()
+        if line and interleaved:
+            name, sequence = split_nexus_name(line)
+            yield [(name, pack_chars(b''.join(sequence.split()), alphabet))]
+        elif line:
+            if name is None or length == site_count:
+                if name is not None:
+                    yield [(name, np.concatenate(pieces))]
+                name, line = split_nexus_name(line)
+                pieces, length = [], 0
+            sequence = b''.join(line.split())
+            length += len(sequence)
+            if length > site_count:
+                raise ValueError('Sequence {0} has more than NCHAR={1} characters'.format(name, site_count))
+            pieces.append(pack_chars(sequence, alphabet))
+        if end:
+            break
+    if name is not None and not interleaved:
+        yield [(name, np.concatenate(pieces))]
+
+ALIGNMENT_READERS = {
+    'fasta': read_fasta_blocks,
+    'phylip': read_phylip_blocks,
+    'nexus': read_nexus_blocks
+}
+
+ALIGNMENT_EXTENSIONS = {
+    'fasta': 'fasta', 'fa': 'fasta', 'fas': 'fasta', 'fna': 'fasta',
+    'phy': 'phylip', 'phylip': 'phylip',
+    'nex': 'nexus', 'nexus': 'nexus', 'nxs': 'nexus'
+}
+
+def align_blocks(blocks, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Buffers sequence pieces until every taxon has a full chunk of columns
+    # All taxa are known once a name repeats, so sequential formats are only chunked at the end
+    # Lengths are kept as pieces arrive, so each block costs its own size rather than the whole buffer
+    # Yields taxon names and [taxon, site] packed chunks
+    pending, lengths = {}, {}
+    short_count = 0 # Taxa with less than a chunk of columns pending
+    taxa_complete = False
+
+    def pop_columns(column_count):
+        chunk = []
+        for name, pieces in pending.items():
+            sequence = np.concatenate(pieces)
+            chunk.append(sequence[:column_count])
+            pending[name] = [sequence[column_count:]]
+            lengths[name] -= column_count
+        return list(pending.keys()), np.stack(chunk)
+
+    for block in blocks:
+        for name, packed in block:
+            taxa_complete = taxa_complete or name in pending
+            was_short = name in lengths and lengths[name] < chunk_size
+            pending.setdefault(name, []).append(packed)
+            lengths[name] = lengths.get(name, 0) + len(packed)
+            short_count += (lengths[name] < chunk_size) - was_short
+        if taxa_complete and short_count == 0:
+            column_count = min(lengths.values())
+            yield pop_columns(column_count - column_count % chunk_size)
+            short_count = sum(length < chunk_size for length in lengths.values())
+
+    remaining_lengths = set(lengths.values())
+    if len(remaining_lengths) > 1:
+        raise ValueError('Sequences have different lengths: {0}'.format(sorted(remaining_lengths)))
+    if remaining_lengths - {0}:
+        yield pop_columns(remaining_lengths.pop())
 
+def read_alignment(filename, format=None, chunk_size=DEFAULT_CHUNK_SIZE, alphabet=NUCLEOTIDES):
+    # FASTA, PHYLIP or NEXUS to a pattern dict and pattern counts, without holding sequences as Python strings
+    if format is None:
+        format = ALIGNMENT_EXTENSIONS[filename.rsplit('.', 1)[-1].lower()]
+    with open(filename, 'rb') as f:
+        chunks = align_blocks(ALIGNMENT_READERS[format](f, alphabet), chunk_size=chunk_size * alphabet.width)
+        return group_packed_chunks((taxon_names, pack_columns(packed, alphabet)) for taxon_names, packed in chunks)
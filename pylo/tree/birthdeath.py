@@ -1,7 +1,9 @@
 import numpy as np
+import scipy.special
 import theano.tensor as tt
 from pylo.tree.transform import TreeHeightProportionTransform
 from pymc3.distributions import Continuous
+from pymc3.distributions.distribution import draw_values
 from pymc3.util import get_variable_name
 
 class BirthDeathSamplingTree(Continuous):
@@ -52,4 +54,145 @@ class BirthDeathSamplingTree(Continuous):
         return r'${} \sim \text{{BirthDeathSamplingTree}}(r={}, a={}, \rho={})'.format(name,
             get_variable_name(r), get_variable_name(a), get_variable_name(rho))
 
-    # TODO: def random
+    def random(self, point=None, size=None):
+        # The one-interval skyline with no sampling through time has the same density up to a constant
+        return BirthDeathSkylineTree.dist(self.topology, self.lam, self.mu, 0.0, self.rho).random(point=point, size=size)
+
+# Birth-death skyline (Stadler et al. 2013) with piecewise-constant birth, death and sampling rates between rate change times (as heights)
+# p is the probability that a lineage at a height has no sampled descendants, and q the probability density of a lineage's path, with q(0) = 1
+# Functions take xp as numpy or theano.tensor, so the likelihood and the simulator share the same closed forms
+
+def get_interval_p(birth_rate, death_rate, sampling_rate, A, B, duration, xp):
+    decay = xp.exp(-A * duration)
+    ratio = ((1 + B) - (1 - B) * decay) / ((1 + B) + (1 - B) * decay)
+    return (birth_rate + death_rate + sampling_rate - A * ratio) / (2 * birth_rate)
+
+def get_interval_log_q(A, B, duration, xp): # Relative to the start of the interval
+    return np.log(4.0) - A * duration - 2 * xp.log((1 + B) + (1 - B) * xp.exp(-A * duration))
+
+def get_interval_params(birth_rate, death_rate, sampling_rate, rho, interval_times, xp):
+    # Rates [interval] and interval start heights to A, B and log q at each interval start
+    As, Bs, log_q_starts = [], [], []
+    p_start, log_q_start = 1.0 - rho, 0.0 # Sampling with probability rho at the present only
+    for i in range(len(interval_times)):
+        A = xp.sqrt((birth_rate[i] - death_rate[i] - sampling_rate[i]) ** 2 + 4 * birth_rate[i] * sampling_rate[i])
+        B = ((1 - 2 * p_start) * birth_rate[i] + death_rate[i] + sampling_rate[i]) / A
+        As.append(A)
+        Bs.append(B)
+        log_q_starts.append(log_q_start)
+        if i + 1 < len(interval_times):
+            duration = interval_times[i + 1] - interval_times[i]
+            p_start = get_interval_p(birth_rate[i], death_rate[i], sampling_rate[i], A, B, duration, xp)
+            log_q_start = log_q_start + get_interval_log_q(A, B, duration, xp)
+    return xp.stack(As), xp.stack(Bs), xp.stack(log_q_starts)
+
+def get_p_log_q(birth_rate, death_rate, sampling_rate, interval_params, interval_times, interval_indices, heights, xp):
+    # p and log q at heights [event], in the intervals given by interval_indices [event]
+    A, B, log_q_start = [param[interval_indices] for param in interval_params]
+    duration = heights - interval_times[interval_indices]
+    p = get_interval_p(birth_rate[interval_indices], death_rate[interval_indices], sampling_rate[interval_indices], A, B, duration, xp)
+    return p, log_q_start + get_interval_log_q(A, B, duration, xp)
+
+def get_rates(birth_rate, death_rate, sampling_rate, interval_count, xp):
+    return [rate * xp.ones(interval_count) for rate in (birth_rate, death_rate, sampling_rate)]
+
+def get_log_subtree_integrals(topology, grid, log_f):
+    # Log of the integral of f(x) * (the same for each internal child) from the node's oldest sampled descendant up to each grid height
+    max_node_heights = topology.get_max_node_heights()
+    log_integrals = np.empty((topology.get_internal_node_count(), len(grid)))
+    log_child_integrals = np.zeros_like(log_integrals)
+    for node_index, parent_index in enumerate(topology.node_parent_indices): # Children precede parents
+        log_integrand = np.where(grid > max_node_heights[node_index], log_f + log_child_integrals[node_index], -np.inf)
+        shift = log_integrand.max()
+        integrand = np.exp(log_integrand - shift)
+        with np.errstate(divide='ignore'):
+            log_integrals[node_index] = np.log(np.concatenate([[0.0], np.cumsum(0.5 * (integrand[1:] + integrand[:-1]) * np.diff(grid))])) + shift
+        if parent_index != -1:
+            log_child_integrals[parent_index] += log_integrals[node_index]
+    return log_integrals, log_child_integrals[-1]
+
+def sample_birth_death_skyline_heights(topology, birth_rate, death_rate, sampling_rate, rho=None, rate_change_times=[], size=1, grid_size=2048, random_state=np.random):
+    # Given its parent, a node's height has density proportional to birth rate * q times its internal children's subtree integrals, above its sampled descendants
+    # Subtree integrals are accumulated on a grid of heights from the leaves up, then heights are drawn by inverting them from the root down
+    interval_times = np.concatenate([[0.0], rate_change_times])
+    rates = get_rates(birth_rate, death_rate, sampling_rate, len(interval_times), np)
+    interval_params = get_interval_params(*rates, 0.0 if rho is None else rho, interval_times, np)
+    max_leaf_height = topology.get_max_leaf_height()
+
+    max_height = 2 * max(max_leaf_height, interval_times[-1]) + 1 / interval_params[0].min()
+    for _ in range(32): # Extend the grid until the root height density is negligible at its end
+        grid = np.linspace(0.0, max_height, grid_size)
+        grid_intervals = np.searchsorted(interval_times, grid, side='right') - 1
+        p, log_q = get_p_log_q(*rates, interval_params, interval_times, grid_intervals, grid, np)
+        log_integrals, log_root_child_integrals = get_log_subtree_integrals(topology, grid, np.log(rates[0][grid_intervals]) + log_q)
+        log_root_density = np.where(grid > max_leaf_height, 2 * log_q - 2 * np.log1p(-p) + log_root_child_integrals, -np.inf)
+        if log_root_density[-1] < log_root_density.max() - 40.0:
+            break
+        max_height *= 2
+
+    heights = np.empty((size, topology.get_internal_node_count()))
+    root_weights = np.exp(log_root_density - log_root_density.max())
+    heights[:, -1] = np.interp(random_state.uniform(size=size), np.cumsum(root_weights) / root_weights.sum(), grid)
+    log_integrals = np.maximum(log_integrals, np.finfo(float).min) # Finite, for interpolation
+    for node_index in range(topology.get_internal_node_count() - 2, -1, -1): # Parents precede children
+        log_parent_integrals = np.interp(heights[:, topology.node_parent_indices[node_index]], grid, log_integrals[node_index])
+        heights[:, node_index] = np.interp(log_parent_integrals + np.log(random_state.uniform(size=size)), log_integrals[node_index], grid)
+    return heights
+
+class BirthDeathSkylineTree(Continuous):
+    # Serially sampled birth-death prior on node heights, conditioned on the root and survival of both its lineages
+    # Rates are scalars or [interval], for the intervals between rate_change_times; tips at height zero are sampled with probability rho, or at the sampling rate if rho is None
+    def __init__(self, topology, birth_rate, death_rate, sampling_rate, rho=None, rate_change_times=[], *args, **kwargs):
+        shape = topology.get_internal_node_count()
+        kwargs.setdefault('shape', shape)
+        transform = TreeHeightProportionTransform(topology)
+        super(BirthDeathSkylineTree, self).__init__(transform=transform, *args, **kwargs)
+
+        self.topology = topology
+        self.birth_rate = tt.as_tensor_variable(birth_rate)
+        self.death_rate = tt.as_tensor_variable(death_rate)
+        self.sampling_rate = tt.as_tensor_variable(sampling_rate)
+        self.rho = None if rho is None else tt.as_tensor_variable(rho)
+        self.interval_times = np.concatenate([[0.0], rate_change_times])
+
+        leaf_heights = topology.get_init_heights()[topology.leaf_mask]
+        self.present_leaf_count = np.sum(leaf_heights == 0.0)
+        self.sampled_leaf_heights = leaf_heights[leaf_heights > 0.0] if rho is not None else leaf_heights
+        self.sampled_leaf_intervals = np.searchsorted(self.interval_times, self.sampled_leaf_heights, side='right') - 1
+
+    def get_rates(self):
+        return get_rates(self.birth_rate, self.death_rate, self.sampling_rate, len(self.interval_times), tt)
+
+    def logp(self, value):
+        topology = self.topology
+        taxon_count = topology.get_taxon_count()
+        rates = self.get_rates()
+        interval_times = tt.as_tensor_variable(self.interval_times)
+        interval_params = get_interval_params(*rates, 0.0 if self.rho is None else self.rho, self.interval_times, tt)
+
+        # All node heights in one pass, with the root's lineages starting at its height
+        node_intervals = tt.extra_ops.searchsorted(interval_times, value, side='right') - 1
+        p, log_q = get_p_log_q(*rates, interval_params, interval_times, node_intervals, value, tt)
+        node_terms = tt.sum(tt.log(rates[0][node_intervals[:-1]]) + log_q[:-1])
+        root_term = 2 * log_q[-1] - 2 * tt.log1p(-p[-1])
+
+        _, leaf_log_q = get_p_log_q(*rates, interval_params, interval_times, self.sampled_leaf_intervals, self.sampled_leaf_heights, tt)
+        leaf_terms = tt.sum(tt.log(rates[2][self.sampled_leaf_intervals]) - leaf_log_q)
+        if self.rho is not None:
+            leaf_terms += self.present_leaf_count * tt.log(self.rho)
+
+        log_coeff = (taxon_count - 1)*np.log(2.0) - scipy.special.gammaln(taxon_count)
+        return log_coeff + node_terms + root_term + leaf_terms
+
+    def random(self, point=None, size=None):
+        params = [self.birth_rate, self.death_rate, self.sampling_rate] + ([] if self.rho is None else [self.rho])
+        sample_count = 1 if size is None else size
+        if all(isinstance(param, tt.TensorConstant) for param in params):
+            batches = [(draw_values(params, point=point), sample_count)]
+        else: # Parameters are drawn once for each sample
+            batches = [(draw_values(params, point=point), 1) for _ in range(sample_count)]
+        samples = np.concatenate([
+            sample_birth_death_skyline_heights(self.topology, birth_rate, death_rate, sampling_rate, rho[0] if rho else None, self.interval_times[1:], size=batch_size)
+            for (birth_rate, death_rate, sampling_rate, *rho), batch_size in batches
+        ])
+        return samples[0] if size is None else samples
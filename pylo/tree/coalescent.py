@@ -1,6 +1,7 @@
 import numpy as np
 import theano.tensor as tt
 from pylo.tree.transform import TreeHeightProportionTransform
+from pylo.topology import get_merge_positions, merge_sorted
 from pymc3.distributions import Continuous
 from pymc3.util import get_variable_name
 
@@ -13,8 +14,8 @@ def coalescent_likelihood(lineage_count,
     k_choose_2 = lineage_count * (lineage_count - 1) * 0.5
     return -tt.sum(k_choose_2 * population_areas) - tt.sum(tt.log(population_func[coalescent_mask]))
 
-def get_lineage_count(event_types):
-    return tt.cumsum(event_types)
+def get_lineage_count(event_types): # Typed, as NumPy's cumsum upcasts small integers and test values would disagree
+    return tt.cumsum(tt.cast(event_types, 'int64'))
 
 class PopulationFunction:
     def make_intervals(heights_sorted, node_mask): #returns lineage_count, population_func, population_areas, coalescent_mask
@@ -41,36 +42,32 @@ class GridPopulationFunction(PopulationFunction): # Piecewise constant changing
         self.grid_size = grid_size
 
     def make_intervals(self, heights_sorted, node_mask):
-        grid_times = self.max_height / self.grid_size * (np.arange(self.grid_size) + 1)
+        grid_times = np.append(self.max_height / self.grid_size * (np.arange(self.grid_size) + 1), np.inf)
 
-        event_types_unsorted = tt.concatenate((tt.alloc(OTHER, self.grid_size + 1), tt.where(node_mask, COALESCENCE, SAMPLING)))
-        times_unsorted = tt.concatenate((grid_times, [np.inf], heights_sorted))
-        pop_sizes_unsorted = tt.concatenate((self.population_func, tt.fill(node_mask, np.nan)))
-        sort_indices = tt.argsort(times_unsorted, kind='stable')
-        indices = np.arange(self.topology.get_node_count() + self.grid_size + 1)
+        # Grid times are sorted constants, so they are merged with the sorted heights rather than sorted together
+        positions = get_merge_positions(grid_times, heights_sorted) # Grid first on ties
+        event_types_sorted = merge_sorted(positions, [tt.alloc(OTHER, self.grid_size + 1), tt.where(node_mask, COALESCENCE, SAMPLING)])
+        times_sorted = merge_sorted(positions, [grid_times, heights_sorted])
+        grid_mask = merge_sorted(positions, [np.ones(self.grid_size + 1, dtype=int), np.zeros(self.topology.get_node_count(), dtype=int)])
 
-        times_sorted = times_unsorted[sort_indices]
         time_mask = times_sorted <= heights_sorted[-1]
         times_to_use = times_sorted[time_mask]
 
-
-        event_types_sorted = event_types_unsorted[sort_indices]
         event_types_to_use = event_types_sorted[time_mask]
         lineage_count = get_lineage_count(event_types_to_use)[:-1]
         coalescent_mask = tt.eq(event_types_to_use[1:], COALESCENCE)
 
-        pop_sizes_null = pop_sizes_unsorted[sort_indices]
-        notnull_indices = (~tt.isnan(pop_sizes_null) & (indices[:, np.newaxis] <= indices[np.newaxis, :])).argmax(axis=1)
-        pop_sizes = pop_sizes_null[notnull_indices][time_mask][1:]
+        grid_indices = tt.cumsum(grid_mask) - grid_mask # Each event takes the population size of the next grid point at or after it
+        pop_sizes = tt.as_tensor_variable(self.population_func)[grid_indices][time_mask][1:]
         durations = times_to_use[1:] - times_to_use[:-1]
         population_areas = durations / pop_sizes 
         return lineage_count, pop_sizes, population_areas, coalescent_mask 
     
 class CoalescentTree(Continuous):
-    def __init__(self, topology, population_func, *args, **kwargs):
+    def __init__(self, topology, population_func, *args, level_order=False, **kwargs):
         shape = topology.get_internal_node_count()
         kwargs.setdefault('shape', shape)
-        transform = TreeHeightProportionTransform(topology)
+        transform = TreeHeightProportionTransform(topology, level_order=level_order)
         super(CoalescentTree, self).__init__(transform=transform, *args, **kwargs)
 
         self.topology = topology
@@ -8,10 +8,12 @@ from scipy.special import logit as logit_val
 class TreeHeightProportionTransform(Transform):
     name = 'tree_height_proportion'
 
-    def __init__(self, topology, max_height=None):
+    def __init__(self, topology, max_height=None, level_order=False):
         self.topology = topology
         self.max_height = max_height
-        
+        self.level_order = level_order
+        self.backward_cache = (None, None) # Input and output of the last backward graph, shared with jacobian_det
+
     def forward(self, x_): # Theano
         non_root_proportions, root_height = self.topology.get_proportions(x_)
         if self.max_height is None:
@@ -29,18 +31,23 @@ class TreeHeightProportionTransform(Transform):
         return np.concatenate([logit_val(non_root_proportions), [root_val]])
     
     def backward(self, y_):
+        cached_y_, cached_heights = self.backward_cache
+        if cached_y_ is y_:
+            return cached_heights
         if self.max_height is None:
             root_val = tt.exp(y_[-1])
         else:
             root_proportion = invlogit(y_[-1])
             root_val = root_proportion * (self.max_height - self.topology.get_max_leaf_height())
         proportions = invlogit(y_[:-1])
-        return self.topology.get_heights(root_val, proportions)
+        heights = self.topology.get_heights(root_val, proportions, level_order=self.level_order)
+        self.backward_cache = (y_, heights)
+        return heights
 
     def jacobian_det(self, y_):
         proportions = invlogit(y_[:-1])
         y_root = y_[-1]
-        times = self.backward(y_)
+        times = self.backward(y_) # Same graph as the model's backward transform of y_
 
         if self.max_height is None:
             root_contrib = y_root
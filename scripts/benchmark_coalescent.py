@@ -0,0 +1,42 @@
+import argparse
+import timeit
+import numpy as np
+import theano
+import theano.tensor as tt
+from pylo.topology import TreeTopology
+from pylo.tree.coalescent import CoalescentTree, ConstantPopulationFunction, GridPopulationFunction
+from benchmark_topology import random_tree
+
+def serially_sampled(tree, seed=1): # Moves leaves up by random sampling times, keeping branch lengths positive
+    rng = np.random.RandomState(seed)
+    for node in tree.walk():
+        if not node.descendants:
+            node.length = float(node.length) * rng.uniform(0.5, 1.0)
+    return tree
+
+def compile_logp(topology, grid_size):
+    node_heights_ = tt.vector()
+    if grid_size is None:
+        population_function = ConstantPopulationFunction(topology, 1.0)
+    else:
+        population_function = GridPopulationFunction(topology, np.ones(grid_size + 1), 2.0 * topology.get_init_heights()[-1], grid_size)
+    logp_ = CoalescentTree.dist(topology, population_function).logp(node_heights_)
+    return theano.function([node_heights_], logp_), theano.function([node_heights_], tt.grad(logp_, node_heights_))
+
+def benchmark(taxon_counts, grid_sizes, repeats):
+    for taxon_count in taxon_counts:
+        topology = TreeTopology(serially_sampled(random_tree(taxon_count)))
+        node_heights = topology.get_init_heights()[topology.node_mask]
+        for grid_size in grid_sizes:
+            f, f_grad = compile_logp(topology, grid_size)
+            value_seconds = min(timeit.repeat(lambda: f(node_heights), number=10, repeat=repeats)) / 10
+            grad_seconds = min(timeit.repeat(lambda: f_grad(node_heights), number=10, repeat=repeats)) / 10
+            print('{0:>8} taxa, grid {1:>8}: logp {2:8.3f} ms, gradient {3:8.3f} ms'.format(taxon_count, str(grid_size), value_seconds * 1000, grad_seconds * 1000))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time CoalescentTree logp and gradient on serially sampled trees')
+    parser.add_argument('--taxon-counts', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.taxon_counts, [None] + args.grid_sizes, args.repeats)
@@ -0,0 +1,36 @@
+import argparse
+import timeit
+import numpy as np
+import theano
+import theano.tensor as tt
+from pylo.hky import HKYSubstitutionModel, EigenSubstitutionModel
+
+def compile_transition_probs(get_transition_probs):
+    kappa_ = tt.scalar()
+    pi_ = tt.vector()
+    distances_ = tt.matrix()
+    transition_probs_ = get_transition_probs(HKYSubstitutionModel(kappa_, pi_), distances_)
+    grad_ = tt.grad(tt.log(transition_probs_).sum(), [kappa_, pi_, distances_])
+    return theano.function([kappa_, pi_, distances_], transition_probs_), theano.function([kappa_, pi_, distances_], grad_)
+
+def benchmark(node_counts, repeats):
+    paths = {
+        'closed form': lambda model, d: model.get_transition_probs(d),
+        'eigen': lambda model, d: EigenSubstitutionModel.get_transition_probs(model, d)
+    }
+    functions = { name: compile_transition_probs(path) for name, path in paths.items() }
+    kappa = 2.0
+    pi = np.array([0.3, 0.2, 0.25, 0.25])
+    for node_count in node_counts:
+        distances = np.random.RandomState(1).exponential(0.1, size=(node_count, 2))
+        for name, (f, f_grad) in functions.items():
+            value_seconds = min(timeit.repeat(lambda: f(kappa, pi, distances), number=10, repeat=repeats)) / 10
+            grad_seconds = min(timeit.repeat(lambda: f_grad(kappa, pi, distances), number=10, repeat=repeats)) / 10
+            print('{0:>12} {1:>8} nodes: value {2:8.3f} ms, gradient {3:8.3f} ms'.format(name, node_count, value_seconds * 1000, grad_seconds * 1000))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time HKY transition probabilities for [node, child] distances')
+    parser.add_argument('--node-counts', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.node_counts, args.repeats)
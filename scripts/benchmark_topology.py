@@ -0,0 +1,55 @@
+import argparse
+import timeit
+import tracemalloc
+import numpy as np
+import newick
+from pylo.topology import TreeTopology
+
+def random_tree(taxon_count, seed=1):
+    # Random coalescent-style binary tree built directly as newick nodes
+    rng = np.random.RandomState(seed)
+    nodes = [newick.Node(name='T{0}'.format(i)) for i in range(taxon_count)]
+    heights = [0.0] * taxon_count
+    height = 0.0
+    while len(nodes) > 1:
+        height += rng.exponential(1.0 / len(nodes))
+        i, j = sorted(rng.choice(len(nodes), 2, replace=False), reverse=True)
+        children = [(nodes.pop(i), heights.pop(i)), (nodes.pop(j), heights.pop(j))]
+        for child, child_height in children:
+            child.length = height - child_height
+        nodes.append(newick.Node(descendants=[child for child, _ in children]))
+        heights.append(height)
+    return nodes[0]
+
+def caterpillar_tree(taxon_count):
+    node = newick.Node(name='T0')
+    for i in range(1, taxon_count):
+        node.length = 1.0
+        leaf = newick.Node(name='T{0}'.format(i), length=str(float(i)))
+        node = newick.Node(descendants=[node, leaf])
+    return node
+
+def get_peak_memory(f):
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def benchmark(tree_f, taxon_counts, repeats):
+    for taxon_count in taxon_counts:
+        tree = tree_f(taxon_count)
+        seconds = min(timeit.repeat(lambda: TreeTopology(tree), number=1, repeat=repeats))
+        topology = TreeTopology(tree)
+        mapping_seconds = min(timeit.repeat(topology._init_mappings, number=1, repeat=repeats))
+        mapping_memory = get_peak_memory(topology._init_mappings)
+        print('{0:>16} {1:>8} taxa: {2:8.1f} ms, mappings {3:8.2f} ms, {4:8.2f} MB peak'.format(
+            tree_f.__name__, taxon_count, seconds * 1000, mapping_seconds * 1000, mapping_memory / 1e6))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time TreeTopology construction and index mappings')
+    parser.add_argument('--taxon-counts', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    benchmark(random_tree, args.taxon_counts, args.repeats)
+    benchmark(caterpillar_tree, args.taxon_counts, args.repeats)
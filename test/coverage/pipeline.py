@@ -33,18 +33,23 @@ def sim_pipeline(**config):
 
     beast_args = ['java'] + cmd_kwargs(jar=config['beast_jar'], seed=config['seed']) + ['-overwrite']
     
-    pop_size, taxon_names, date_trait_string = build_templates.build_tree_sim(config)
-    
-    print('Running tree simulation')
-    subprocess.run(beast_args + [build_templates.tree_sim_out_path])
+    if config.get('simulator', 'native') == 'native':
+        print('Running simulations')
+        pop_size, taxon_names, date_trait_string, newick_string = build_templates.simulate_tree(config)
+        sequence_dict = build_templates.simulate_sequences(config, newick_string)
+    else:
+        pop_size, taxon_names, date_trait_string = build_templates.build_tree_sim(config)
 
-    newick_string = build_templates.extract_newick_string()
-    build_templates.build_seq_sim(config, taxon_names, newick_string)
+        print('Running tree simulation')
+        subprocess.run(beast_args + [build_templates.tree_sim_out_path])
 
-    print('Running sequence simulation')
-    subprocess.run(beast_args + [build_templates.seq_sim_out_path])
+        newick_string = build_templates.extract_newick_string(build_templates.tree_sim_result_path)
+        build_templates.build_seq_sim(config, taxon_names, newick_string)
 
-    sequence_dict = build_templates.extract_sequence_dict()
+        print('Running sequence simulation')
+        subprocess.run(beast_args + [build_templates.seq_sim_out_path])
+
+        sequence_dict = build_templates.extract_sequence_dict()
     
     build_templates.build_beast_analysis(config, newick_string, date_trait_string, sequence_dict)
     print('Running BEAST analysis')
@@ -0,0 +1,70 @@
+import numpy as np
+import newick
+import theano
+import theano.tensor as tt
+import scipy.integrate
+from numpy.testing import assert_allclose
+from pylo.topology import TreeTopology
+from pylo.tree.birthdeath import BirthDeathSamplingTree, BirthDeathSkylineTree, get_interval_params, get_p_log_q, sample_birth_death_skyline_heights
+
+birth_rate, death_rate, sampling_rate, rho, rate_change_times = np.array([2.0, 1.0]), np.array([0.5, 0.8]), np.array([0.3, 0.6]), 0.4, [0.7]
+interval_times = np.array([0.0, 0.7])
+
+def get_p_q_val(heights):
+    interval_params = get_interval_params(birth_rate, death_rate, sampling_rate, rho, interval_times, np)
+    p, log_q = get_p_log_q(birth_rate, death_rate, sampling_rate, interval_params, interval_times, np.searchsorted(interval_times, heights, side='right') - 1, heights, np)
+    return p, np.exp(log_q)
+
+def test_birth_death_skyline_p_q():
+    def derivatives(height, y):
+        i = np.searchsorted(interval_times, height, side='right') - 1
+        p, q = y
+        return [-(birth_rate[i] + death_rate[i] + sampling_rate[i]) * p + birth_rate[i] * p ** 2 + death_rate[i], -(birth_rate[i] + death_rate[i] + sampling_rate[i]) * q + 2 * birth_rate[i] * p * q]
+    heights = np.array([0.3, 0.7, 1.2, 1.5])
+    solution = scipy.integrate.solve_ivp(derivatives, [0.0, 1.5], [1.0 - rho, 1.0], t_eval=heights, rtol=1e-10, atol=1e-12, max_step=0.01)
+    p, q = get_p_q_val(heights)
+    assert_allclose(p, solution.y[0], rtol=1e-6)
+    assert_allclose(q, solution.y[1], rtol=1e-6)
+
+def test_birth_death_skyline_random():
+    topology = TreeTopology(newick.loads('((A:0.5,B:0.2):0.4,C:0.4)')[0]) # Leaves at 0.0, 0.3 and 0.5
+    dist = BirthDeathSkylineTree.dist(topology, birth_rate, death_rate, sampling_rate, rho=rho, rate_change_times=rate_change_times)
+    value_ = tt.vector()
+    logp = theano.function([value_], dist.logp(value_))
+
+    # Density of the two node heights on a grid from the closed forms, checked against logp at a few points
+    grid = np.linspace(0.0005, 8.0, 4000)
+    p, q = get_p_q_val(grid)
+    log_density = np.log(birth_rate[np.searchsorted(interval_times, grid, side='right') - 1] * q)[:, np.newaxis] + (2 * np.log(q) - 2 * np.log1p(-p))[np.newaxis, :]
+    node_heights, root_heights = np.meshgrid(grid, grid, indexing='ij')
+    log_density[~((node_heights > 0.3) & (root_heights > node_heights) & (root_heights > 0.5))] = -np.inf
+    for i, j in [(1000, 1500), (500, 2000)]:
+        assert_allclose(logp(np.array([grid[i], grid[j]])) - logp(np.array([grid[500], grid[1500]])), log_density[i, j] - log_density[500, 1500])
+    density = np.exp(log_density - log_density.max())
+    density /= density.sum()
+
+    samples = sample_birth_death_skyline_heights(topology, birth_rate, death_rate, sampling_rate, rho, rate_change_times, size=20000, random_state=np.random.RandomState(1))
+    assert_allclose(samples.mean(axis=0), [(density * node_heights).sum(), (density * root_heights).sum()], atol=5 * samples.std(axis=0).max() / np.sqrt(20000))
+
+def test_birth_death_skyline_serial(dengue_config):
+    topology = TreeTopology(newick.loads(dengue_config['newick_string'])[0])
+    dist = BirthDeathSkylineTree.dist(topology, [0.3, 0.5], 0.1, 0.05, rate_change_times=[5.0])
+    samples = dist.random(size=10)
+    assert np.all(samples > topology.get_max_node_heights())
+    assert np.all(samples[:, :-1] < samples[:, topology.node_parent_indices[:-1]])
+    value_ = tt.vector()
+    logp_grad = theano.function([value_], tt.grad(dist.logp(value_), value_))
+    assert np.all(np.isfinite(logp_grad(samples[0])))
+
+def test_birth_death_sampling_random():
+    topology = TreeTopology(newick.loads('((A:1.0,B:1.0):1.0,(C:0.5,D:0.5):1.5)')[0])
+    r, a, sample_rho = 1.3, 0.4, 0.6
+    dist = BirthDeathSamplingTree.dist(topology, r, a, sample_rho)
+    skyline_dist = BirthDeathSkylineTree.dist(topology, r / (1 - a), a * r / (1 - a), 0.0, rho=sample_rho)
+    value_ = tt.vector()
+    logp_diff = theano.function([value_], dist.logp(value_) - skyline_dist.logp(value_))
+    assert_allclose(logp_diff(np.array([0.3, 1.2, 3.0])), logp_diff(np.array([0.9, 0.95, 1.1])))
+
+    samples = dist.random(size=10)
+    assert samples.shape == (10, topology.get_internal_node_count())
+    assert np.all(samples[:, :-1] < samples[:, topology.node_parent_indices[:-1]])
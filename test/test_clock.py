@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as tt
+import pymc3 as pm
+from numpy.testing import assert_allclose
+from pylo.topology import TreeTopology, SharedTreeTopology
+from pylo.clock import get_branch_count, get_child_distances, get_root_path_sums, UncorrelatedLognormalClock, RandomLocalClock
+
+def test_clock_child_distances(tree):
+    topology = TreeTopology(tree)
+    branch_rates = np.random.RandomState(1).lognormal(size=get_branch_count(topology))
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    child_distances = get_child_distances(topology, tt.as_tensor_variable(node_heights), tt.as_tensor_variable(branch_rates)).eval()
+    branch_lengths = topology.get_init_heights()[topology.parent_indices[:-1]] - topology.get_init_heights()[:-1]
+    for node_index, children in enumerate(topology.get_node_children()):
+        assert_allclose(child_distances[node_index], branch_lengths[children] * branch_rates[children])
+
+def test_clock_root_path_sums(tree):
+    topology = TreeTopology(tree)
+    branch_values = np.random.RandomState(1).normal(size=get_branch_count(topology))
+    path_sums = get_root_path_sums(topology, tt.as_tensor_variable(branch_values)).eval()
+    for node_index in range(get_branch_count(topology)):
+        expected, ancestor_index = 0.0, node_index
+        while ancestor_index != topology.get_node_count() - 1:
+            expected += branch_values[ancestor_index]
+            ancestor_index = topology.parent_indices[ancestor_index]
+        assert_allclose(path_sums[node_index], expected)
+
+def test_clock_noncentered(tree):
+    topology = TreeTopology(tree)
+    with theano.change_flags(compute_test_value='off'), pm.Model() as model: # pm.Model leaves compute_test_value set on exit
+        ucld_rates = UncorrelatedLognormalClock('ucld_rates', topology, 2.0, 0.5)
+        rlc_rates = RandomLocalClock('rlc_rates', topology, 2.0, 0.1)
+    assert [var.name for var in model.free_RVs] == ['ucld_rates_offsets', 'rlc_rates_local_scales_log__', 'rlc_rates_offsets']
+    point = model.test_point
+    assert_allclose(model.fastfn(ucld_rates)(point), np.full(get_branch_count(topology), 2.0 * np.exp(-0.125)))
+    assert_allclose(model.fastfn(rlc_rates)(point), np.full(get_branch_count(topology), 2.0))
+    assert np.all(np.isfinite(model.fastdlogp()(point)))
+
+def test_random_local_clock_shared_topology(tree):
+    with theano.change_flags(compute_test_value='off'), pm.Model():
+        with pytest.raises(ValueError):
+            RandomLocalClock('rlc_rates', SharedTreeTopology(tree), 2.0, 0.1)
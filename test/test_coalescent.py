@@ -1,7 +1,9 @@
 import pytest
 import numpy as np
 import newick
-from numpy.testing import assert_allclose
+import theano
+import theano.tensor as tt
+from numpy.testing import assert_allclose, assert_array_equal
 from pylo.topology import TreeTopology
 from pylo.tree.coalescent import CoalescentTree, ConstantPopulationFunction, GridPopulationFunction
 
@@ -20,6 +22,15 @@ def test_coalescent_constant_population():
     logp = height_dist.logp(height_values).eval()
     logp_expected = -(4 / pop) - 2 * np.log(pop)
     assert_allclose(logp, logp_expected)
+
+def test_coalescent_test_values(heterochronous_newick):
+    topology = TreeTopology(newick.loads(heterochronous_newick)[0])
+    height_values = topology.get_init_heights()[topology.node_mask]
+    with theano.change_flags(compute_test_value='raise'):
+        heights = tt.vector()
+        heights.tag.test_value = height_values
+        logp = CoalescentTree.dist(topology, ConstantPopulationFunction(topology, 123)).logp(heights)
+    assert_allclose(logp.tag.test_value, -14.446309163678226)
     
 test_data = [(123,-14.446309163678226),(999,-20.721465537146862)]
 @pytest.mark.parametrize('pop,logp_expected', test_data)
@@ -59,3 +70,13 @@ def test_coalescent_skygrid(heterochronous_newick, population_sizes, cutoff, log
     logp = height_dist.logp(height_values).eval()
     assert_allclose(logp, logp_expected)
 
+
+def test_coalescent_heights_sorted(dengue_config):
+    topology = TreeTopology(newick.loads(dengue_config['newick_string'])[0])
+    node_heights = topology.get_init_heights()[topology.node_mask] * np.random.RandomState(2).uniform(0.9, 1.1, topology.get_internal_node_count())
+    heights = np.where(topology.node_mask, node_heights[topology.node_index_mapping], topology.get_init_heights())
+    argsort = np.argsort(heights, kind='stable')
+    node_heights_ = tt.vector()
+    heights_sorted, node_mask = theano.function([node_heights_], topology.get_heights_sorted(node_heights_))(node_heights)
+    assert_allclose(heights_sorted, heights[argsort])
+    assert_array_equal(node_mask, topology.node_mask[argsort])
@@ -1,4 +1,5 @@
 from pylo.hky import *
+from pylo.common import AMINO_ACIDS
 import theano
 import theano.tensor as tt
 import numpy as np
@@ -89,3 +90,109 @@ def test_hky_transition_probs_mat():
 	res_scalar = [[f(kappa, pi, t) for t in trow] for trow in ts]
 	res_vectorised = f_vectorised(kappa, pi, ts)
 	assert_allclose(res_vectorised, np.stack(res_scalar, axis=0))
+
+def test_hky_transition_probs_batch():
+	kappa_ = tt.vector()
+	pi_ = tt.matrix()
+	ts_ = tt.tensor3()
+
+	kappa = np.array([1.2, 2.0])
+	pi = np.array([[0.3, 0.2, 0.25, 0.25], [0.5, 0.2, 0.2, 0.1]])
+	ts = np.array([[[1.2, 0.8, 1.3], [1.1, 0.7, 2.2]], [[0.1, 0.2, 0.3], [0.4, 0.5, 0.6]]])
+
+	substitution_model = HKYSubstitutionModel(kappa_, pi_)
+	f_batch = theano.function([kappa_, pi_, ts_], substitution_model.get_transition_probs(ts_))
+	res_batch = f_batch(kappa, pi, ts)
+
+	kappa_scalar_ = tt.scalar()
+	pi_vector_ = tt.vector()
+	ts_matrix_ = tt.matrix()
+	f = theano.function([kappa_scalar_, pi_vector_, ts_matrix_], HKYSubstitutionModel(kappa_scalar_, pi_vector_).get_transition_probs(ts_matrix_))
+	res = np.stack([f(*args) for args in zip(kappa, pi, ts)])
+	assert_allclose(res_batch, res)
+	assert_allclose(HKYSubstitutionModel(kappa, pi).get_transition_probs_val(ts), res)
+
+@pytest.mark.parametrize('kappa,pi,t,expected', test_data)
+def test_hky_closed_form_transition_probs(kappa, pi, t, expected):
+	kappa_ = tt.scalar()
+	pi_ = tt.vector()
+	ts_ = tt.matrix()
+	ts = np.array([[t, 2 * t], [0.5 * t, 10 * t], [0.0, t]])
+
+	substitution_model = HKYSubstitutionModel(kappa_, pi_)
+	f = theano.function([kappa_, pi_, ts_], [substitution_model.get_transition_probs(ts_), EigenSubstitutionModel.get_transition_probs(substitution_model, ts_)])
+	closed_form, eigen = f(kappa, pi, ts)
+	assert_allclose(closed_form, eigen, atol=1e-12)
+	assert_allclose(closed_form[0, 0], expected)
+	assert_allclose(closed_form[2, 0], np.eye(4), atol=1e-12)
+
+@pytest.mark.parametrize('kappa,pi,t,expected', test_data)
+def test_hky_transition_probs_expm(kappa, pi, t, expected):
+	assert_allclose(hky_transition_probs_expm(tt.as_tensor(kappa), tt.as_tensor(pi), t).eval(), expected)
+
+@pytest.mark.parametrize('kappa,pi,t,expected', test_data)
+def test_tn93_hky_special_case(kappa, pi, t, expected):
+	kappa_ = tt.scalar()
+	pi_ = tt.vector()
+	ts_ = tt.vector()
+	ts = np.array([t, 2 * t, 10 * t])
+	substitution_model = TN93SubstitutionModel(kappa_, kappa_, pi_)
+	f = theano.function([kappa_, pi_, ts_], substitution_model.get_transition_probs(ts_))
+	res = f(kappa, pi, ts)
+	assert_allclose(res[0], expected)
+	assert_allclose(res, HKYSubstitutionModel(kappa, pi).get_transition_probs_val(ts))
+	assert_allclose(TN93SubstitutionModel(kappa, kappa, pi).get_transition_probs_val(ts), res)
+
+@pytest.mark.parametrize('t', [0.1, 1.0, 10.0])
+def test_gtr_jc_special_case(t):
+	substitution_model = GTRSubstitutionModel(tt.as_tensor(np.ones(6)), tt.as_tensor(np.full(4, 0.25)))
+	jc_transition_probs = eigen_transition_probs_scalar(jc_eigendecomposition, t).eval()
+	assert_allclose(substitution_model.get_transition_probs(tt.as_tensor(t)).eval(), jc_transition_probs)
+
+def test_gtr_eigendecomposition_cache():
+	rates_ = tt.vector()
+	pi_ = tt.vector()
+	ts_ = tt.vector()
+	f = theano.function([rates_, pi_, ts_], GTRSubstitutionModel(rates_, pi_).get_transition_probs(ts_))
+	pi = np.array([0.3, 0.2, 0.25, 0.25])
+	ts = np.array([0.1, 1.0])
+	for rates in [np.array([1.0, 2.0, 0.5, 1.5, 3.0, 1.0]), np.array([1.0, 2.0, 0.5, 1.5, 3.0, 1.0]), np.array([0.5, 4.0, 1.0, 1.0, 2.0, 0.7])]:
+		for t_scale in [1.0, 2.0]:
+			assert_allclose(f(rates, pi, ts * t_scale), GTRSubstitutionModel(rates, pi).get_transition_probs_val(ts * t_scale))
+
+def test_gtr_transition_probs_val_batch():
+	rates = np.array([[1.0, 2.0, 0.5, 1.5, 3.0, 1.0], [0.5, 4.0, 1.0, 1.0, 2.0, 0.7]])
+	pi = np.array([[0.3, 0.2, 0.25, 0.25], [0.1, 0.4, 0.3, 0.2]])
+	ts = np.array([[0.1, 1.0], [0.5, 2.0]])
+	res = GTRSubstitutionModel(rates, pi).get_transition_probs_val(ts)
+	for i in range(2):
+		assert_allclose(res[i], GTRSubstitutionModel(rates[i], pi[i]).get_transition_probs_val(ts[i]))
+	assert_allclose(res.sum(axis=-1), 1.0)
+
+def test_gtr_transition_probs_gradient():
+	pi = np.array([0.3, 0.2, 0.25, 0.25])
+	ts = np.array([0.1, 1.0])
+	theano.gradient.verify_grad(lambda rates: GTRSubstitutionModel(rates, pi).get_transition_probs(tt.as_tensor(ts)), [np.array([1.0, 2.0, 0.5, 1.5, 3.0, 1.0])], rng=np.random.RandomState(1))
+
+def test_gtr_amino_acids_transition_probs():
+	rng = np.random.RandomState(1)
+	rates = rng.uniform(0.5, 2.0, 190)
+	pi = rng.dirichlet(np.ones(20))
+	ts = np.array([0.1, 1.0])
+	res = GTRSubstitutionModel(tt.as_tensor(rates), tt.as_tensor(pi), alphabet=AMINO_ACIDS).get_transition_probs(tt.as_tensor(ts)).eval()
+	assert res.shape == (2, 20, 20)
+	assert_allclose(res, GTRSubstitutionModel(rates, pi, alphabet=AMINO_ACIDS).get_transition_probs_val(ts))
+	assert_allclose(res.sum(axis=-1), 1.0)
+	assert_allclose(pi @ res, np.stack([pi, pi])) # Stationary
+
+def test_gy94_transition_probs():
+	single_change, transition, non_synonymous = get_codon_exchangeability_masks()
+	assert single_change.sum() == 288 - 25 # Pairs of the 64 codons one substitution apart, less those with a stop codon
+	assert (single_change & transition).sum() == 96 - 7
+	assert not (transition & ~single_change).any()
+	pi = np.random.RandomState(1).dirichlet(np.ones(61))
+	substitution_model = GY94SubstitutionModel(tt.as_tensor(2.0), tt.as_tensor(0.3), tt.as_tensor(pi))
+	res = substitution_model.get_transition_probs(tt.as_tensor(np.array([0.1, 1.0]))).eval()
+	assert res.shape == (2, 61, 61)
+	assert_allclose(res, GY94SubstitutionModel(2.0, 0.3, pi).get_transition_probs_val(np.array([0.1, 1.0])), atol=1e-12)
+	assert_allclose(res.sum(axis=-1), 1.0)
@@ -0,0 +1,97 @@
+from pylo.numpy_pruning import leaf_sequences_log_likelihood, get_leaf_partials, CachedPartials
+from pylo.pruning import phylogenetic_log_likelihood
+from pylo.transform import group_sequences
+from pylo.hky import HKYSubstitutionModel
+from pylo.topology import TreeTopology
+
+import pytest
+import newick
+import numpy as np
+import theano.tensor as tt
+import theano
+from numpy.testing import assert_allclose
+
+def test_numpy_pruning_value(taxa_encoded, tree):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    topology = TreeTopology(tree)
+    child_patterns = topology.build_sequence_table(taxa_patterns)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+
+    substitution_model = HKYSubstitutionModel(1.0, np.ones(4)/4)
+    res = leaf_sequences_log_likelihood(topology, substitution_model, topology.get_child_branch_lengths_val(node_heights), child_patterns, pattern_frequencies)
+
+    assert_allclose(res, -1992.2056440317247)
+
+def test_numpy_pruning_polytomy():
+    topology = TreeTopology(newick.loads('((A:0.4,B:0.2,C:0.1):0.6,D:1.0)')[0])
+    sequence_dict = { name: np.zeros(3, dtype=int) for name in 'ABCD' }
+    with pytest.raises(ValueError):
+        leaf_sequences_log_likelihood(topology, HKYSubstitutionModel(1.0, np.ones(4)/4), topology.get_child_branch_lengths_val(topology.get_init_heights()[topology.node_mask]), topology.build_sequence_table(sequence_dict), np.ones(3))
+
+def test_numpy_pruning_batch(taxa_encoded, tree):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    pattern_frequencies = np.array(pattern_frequencies)
+    topology = TreeTopology(tree)
+    child_patterns = topology.build_sequence_table(taxa_patterns)
+    init_node_heights = topology.get_init_heights()[topology.node_mask]
+
+    kappa = np.array([1.0, 2.0, 5.0])
+    pi = np.array([[0.25, 0.25, 0.25, 0.25], [0.5, 0.2, 0.2, 0.1], [0.2, 0.3, 0.25, 0.25]])
+    node_heights = init_node_heights * np.array([1.0, 0.5, 2.0])[:, np.newaxis]
+
+    substitution_model = HKYSubstitutionModel(kappa, pi)
+    res = leaf_sequences_log_likelihood(topology, substitution_model, topology.get_child_branch_lengths_val(node_heights), child_patterns, pattern_frequencies)
+
+    kappa_ = tt.scalar()
+    pi_ = tt.vector()
+    node_heights_ = tt.vector()
+    child_transition_probs_ = HKYSubstitutionModel(kappa_, pi_).get_transition_probs(topology.get_child_branch_lengths(node_heights_))
+    ll_ = phylogenetic_log_likelihood(
+        tt.as_tensor_variable(topology.node_child_indices),
+        child_transition_probs_,
+        tt.as_tensor_variable(np.array(child_patterns)),
+        tt.as_tensor_variable(topology.get_node_child_leaf_mask()),
+        pattern_frequencies,
+        pi_
+    )
+    f = theano.function([kappa_, pi_, node_heights_], ll_)
+    expected = [f(*args) for args in zip(kappa, pi, node_heights)]
+
+    assert res.shape == kappa.shape
+    assert_allclose(res, expected)
+
+def test_cached_partials(taxa_encoded, tree):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    topology = TreeTopology(tree)
+    child_patterns = topology.build_sequence_table(taxa_patterns)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    substitution_model = HKYSubstitutionModel(2.0, np.array([0.3, 0.2, 0.25, 0.25]))
+    pi = substitution_model.get_equilibrium_probs_val()
+    cache = CachedPartials(topology.node_child_indices, get_leaf_partials(child_patterns), topology.get_node_child_leaf_mask(), pattern_frequencies)
+
+    def get_expected(node_heights):
+        return leaf_sequences_log_likelihood(topology, substitution_model, topology.get_child_branch_lengths_val(node_heights), child_patterns, pattern_frequencies)
+
+    def get_cached(node_heights):
+        return cache.log_likelihood(substitution_model.get_transition_probs_val(topology.get_child_branch_lengths_val(node_heights)), pi)
+
+    assert_allclose(get_cached(node_heights), get_expected(node_heights))
+    assert cache.update_count == len(node_heights)
+    cache.store()
+
+    proposed_node_heights = node_heights.copy()
+    proposed_node_heights[0] *= 0.9 # Lowest internal node, its parent and the path to the root change
+    assert_allclose(get_cached(proposed_node_heights), get_expected(proposed_node_heights))
+    assert cache.update_count == 2 * len(node_heights)
+    cache.restore()
+    update_count = cache.update_count
+    assert_allclose(get_cached(node_heights), get_expected(node_heights))
+    assert cache.update_count == update_count # Restored without recomputation
+
+    proposed_node_heights = node_heights.copy()
+    proposed_node_heights[-2] *= 0.9 # Child of the root
+    assert_allclose(get_cached(proposed_node_heights), get_expected(proposed_node_heights))
+    assert cache.update_count == update_count + 2 # The node and the root, as partials only depend on the branches below a node
+    cache.store()
+    assert_allclose(get_cached(proposed_node_heights), get_expected(proposed_node_heights))
+    assert cache.update_count == update_count + 2
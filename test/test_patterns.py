@@ -0,0 +1,129 @@
+import time
+import pytest
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_equal
+
+from pylo.common import A, C, G, T, R, GAP, AMINO_ACIDS, CODONS
+from pylo.transform import encode_sequences, group_sequences, get_state_partials, read_alignment
+
+def group_sequences_dataframe(taxa_dict):
+    pattern_series = pd.DataFrame(taxa_dict).groupby(list(taxa_dict.keys())).size()
+    return pattern_series.index.to_frame().to_dict(orient='list'), pattern_series.values
+
+@pytest.mark.parametrize('chunk_size', [7, 10000])
+def test_group_sequences(taxa_encoded, chunk_size):
+    pattern_dict, pattern_counts = group_sequences(taxa_encoded, chunk_size=chunk_size)
+    expected_pattern_dict, expected_pattern_counts = group_sequences_dataframe(taxa_encoded)
+    assert list(pattern_dict.keys()) == list(taxa_encoded.keys())
+    for name, patterns in pattern_dict.items():
+        assert_array_equal(patterns, expected_pattern_dict[name])
+    assert_array_equal(pattern_counts, expected_pattern_counts)
+
+def test_group_sequences_no_sites():
+    with pytest.raises(ValueError, match='no sites'):
+        group_sequences({ 'a': '', 'b': '' })
+
+def test_encode_sequences():
+    encoded = encode_sequences({ 'a': 'ACGTu-?Nr', 'b': b'acgtRYn.-' })
+    assert_array_equal(encoded['a'], [A, C, G, T, T, GAP, GAP, GAP, R])
+    assert_array_equal(get_state_partials(encoded['b'][4:]), [[1, 0, 1, 0], [0, 1, 0, 1], [1, 1, 1, 1], [1, 1, 1, 1], [1, 1, 1, 1]])
+
+def test_encode_sequences_invalid():
+    with pytest.raises(ValueError):
+        encode_sequences({ 'a': 'ACGX' })
+
+def test_encode_sequences_alphabets():
+    amino_acids = encode_sequences({ 'a': 'ARNdcX-B*' }, AMINO_ACIDS)['a']
+    assert_array_equal(amino_acids[:7], [0, 1, 2, 3, 4, GAP, GAP])
+    assert_array_equal(get_state_partials(amino_acids[7:], AMINO_ACIDS), [AMINO_ACIDS.state_partials[2] + AMINO_ACIDS.state_partials[3], np.ones(20)])
+    codons = encode_sequences({ 'a': 'ATGtggTAAANG---' }, CODONS)['a']
+    assert_array_equal(codons, [CODONS.states.index('ATG'), CODONS.states.index('TGG'), GAP, GAP, GAP]) # Stop codons and ambiguous codons are missing
+    with pytest.raises(ValueError):
+        encode_sequences({ 'a': 'ATGT' }, CODONS)
+
+def write_fasta(taxa, f):
+    for name, sequence in taxa.items():
+        f.write('>{0}\n'.format(name))
+        for start in range(0, len(sequence), 60):
+            f.write(sequence[start:start + 60] + '\n')
+
+def write_phylip(taxa, f, block_size=100):
+    sequence_length = len(list(taxa.values())[0])
+    f.write('{0} {1}\n'.format(len(taxa), sequence_length))
+    for start in range(0, sequence_length, block_size):
+        for name, sequence in taxa.items():
+            f.write(('{0}  '.format(name) if start == 0 else '') + sequence[start:start + block_size] + '\n')
+        f.write('\n')
+
+def write_nexus(taxa, f, block_size=100):
+    sequence_length = len(list(taxa.values())[0])
+    f.write('#NEXUS\nBEGIN DATA;\n\tDIMENSIONS NTAX={0} NCHAR={1};\n\tFORMAT DATATYPE=DNA GAP=- INTERLEAVE;\n\tMATRIX\n'.format(len(taxa), sequence_length))
+    for start in range(0, sequence_length, block_size):
+        for name, sequence in taxa.items():
+            f.write("'{0}' {1} [{2}]\n".format(name, sequence[start:start + block_size], start))
+    f.write(';\nEND;\n')
+
+def write_nexus_sequential(taxa, f, block_size=100): # Wrapped lines, with continuation lines split into groups of ten
+    sequence_length = len(list(taxa.values())[0])
+    f.write('#NEXUS\nBEGIN DATA;\n\tDIMENSIONS NTAX={0} NCHAR={1};\n\tFORMAT DATATYPE=DNA GAP=-;\n\tMATRIX\n'.format(len(taxa), sequence_length))
+    for name, sequence in taxa.items():
+        f.write('{0} {1}\n'.format(name, sequence[:block_size]))
+        for start in range(block_size, sequence_length, block_size):
+            f.write('  ' + ' '.join(sequence[i:i + 10] for i in range(start, min(start + block_size, sequence_length), 10)) + '\n')
+    f.write(';\nEND;\n')
+
+@pytest.mark.parametrize('extension,write', [('fasta', write_fasta), ('phy', write_phylip), ('nex', write_nexus), ('nex', write_nexus_sequential)])
+@pytest.mark.parametrize('chunk_size', [64, 10000])
+def test_read_alignment(taxa, tmp_path, extension, write, chunk_size):
+    filename = str(tmp_path / ('alignment.' + extension))
+    with open(filename, 'w') as f:
+        write(taxa, f)
+    pattern_dict, pattern_counts = read_alignment(filename, chunk_size=chunk_size)
+    expected_pattern_dict, expected_pattern_counts = group_sequences(encode_sequences(taxa))
+    assert list(pattern_dict.keys()) == list(taxa.keys())
+    for name, patterns in pattern_dict.items():
+        assert_array_equal(patterns, expected_pattern_dict[name])
+    assert_array_equal(pattern_counts, expected_pattern_counts)
+
+@pytest.mark.parametrize('extension,contents', [('fasta', ''), ('nex', '#NEXUS\nBEGIN DATA;\nEND;\n')])
+def test_read_alignment_empty(tmp_path, extension, contents):
+    filename = str(tmp_path / ('alignment.' + extension))
+    with open(filename, 'w') as f:
+        f.write(contents)
+    with pytest.raises(ValueError, match='no sites'):
+        read_alignment(filename)
+
+@pytest.mark.parametrize('continuation', ['ACGT', 'AC GT'])
+def test_read_phylip_wrapped_sequential(tmp_path, continuation):
+    filename = str(tmp_path / 'alignment.phy')
+    with open(filename, 'w') as f:
+        f.write('2 8\nA ACGT\n{0}\nB ACGT\n{0}\n'.format(continuation))
+    with pytest.raises(ValueError, match='wrapped sequential PHYLIP'):
+        read_alignment(filename)
+
+@pytest.mark.parametrize('extension,write', [('fasta', write_fasta), ('phy', write_phylip), ('nex', write_nexus)])
+def test_read_alignment_many_taxa(tmp_path, extension, write):
+    random_state = np.random.RandomState(1)
+    taxa = { 'taxon{0}'.format(i): ''.join(random_state.choice(list('ACGT'), 150)) for i in range(5000) }
+    filename = str(tmp_path / ('alignment.' + extension))
+    with open(filename, 'w') as f:
+        write(taxa, f)
+    start = time.time()
+    pattern_dict, pattern_counts = read_alignment(filename, chunk_size=64)
+    assert time.time() - start < 5.0 # Linear in the taxon count, where buffering costs that grow with the taxa take minutes
+    assert list(pattern_dict.keys()) == list(taxa.keys())
+    assert pattern_counts.sum() == 150
+
+@pytest.mark.parametrize('extension,write', [('fasta', write_fasta), ('phy', write_phylip)])
+def test_read_alignment_codons(taxa, tmp_path, extension, write):
+    site_count = len(list(taxa.values())[0]) // 3 * 3
+    taxa = { name: sequence[:site_count] for name, sequence in taxa.items() }
+    filename = str(tmp_path / ('alignment.' + extension))
+    with open(filename, 'w') as f:
+        write(taxa, f)
+    pattern_dict, pattern_counts = read_alignment(filename, chunk_size=32, alphabet=CODONS) # Lines split codons
+    expected_pattern_dict, expected_pattern_counts = group_sequences(encode_sequences(taxa, CODONS))
+    for name, patterns in pattern_dict.items():
+        assert_array_equal(patterns, expected_pattern_dict[name])
+    assert_array_equal(pattern_counts, expected_pattern_counts)
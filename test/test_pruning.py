@@ -1,11 +1,16 @@
-from pylo.pruning import phylogenetic_log_likelihood
-from pylo.transform import group_sequences
-from pylo.hky import HKYSubstitutionModel
+from pylo.pruning import phylogenetic_log_likelihood, PhylogeneticLikelihood, LeafSequences, PartitionedLeafSequences, concatenate_partitions
+from pylo.transform import group_sequences, encode_sequences
+from pylo.hky import HKYSubstitutionModel, GTRSubstitutionModel
+from pylo.common import AMINO_ACIDS
 from pylo.topology import TreeTopology
+import pylo.numpy_pruning
 
+import pytest
+import newick
 import numpy as np
 import theano.tensor as tt
 import theano
+import pymc3 as pm
 from numpy.testing import assert_allclose
 
 def test_pruning_value(taxa_encoded, tree):
@@ -109,3 +114,294 @@ def test_pruning_gradient_branch(taxa_encoded, tree):
     
     assert_allclose(grad_theano, grad_numeric.reshape(branch_lengths_shape), rtol = GRAD_RTOL)
 
+
+def get_likelihood_and_gradient_function(topology, taxa_patterns, pattern_frequencies, clock_rate=1.0, **kwargs):
+    kappa_ = tt.scalar()
+    pi_ = tt.vector()
+    node_heights_ = tt.vector()
+    child_branch_lengths_ = topology.get_child_branch_lengths(node_heights_) * clock_rate
+    child_sequences_ = tt.as_tensor_variable(np.array(topology.build_sequence_table(taxa_patterns)))
+    child_leaf_mask_ = tt.as_tensor_variable(topology.get_node_child_leaf_mask())
+    child_indices_ = tt.as_tensor_variable(topology.node_child_indices)
+
+    substitution_model = HKYSubstitutionModel(kappa_, pi_)
+    child_transition_probs_ = substitution_model.get_transition_probs(child_branch_lengths_)
+
+    ll_ = phylogenetic_log_likelihood(child_indices_, child_transition_probs_, child_sequences_, child_leaf_mask_, pattern_frequencies, pi_, **kwargs)
+    inputs = [kappa_, pi_, node_heights_]
+    return theano.function(inputs, [ll_] + tt.grad(ll_, inputs))
+
+VARIANT_RTOL = 1e-5
+
+pruning_variants = [
+    dict(level_order=True, scaled=False),
+    dict(level_order=False, scaled=True),
+    dict(level_order=True, scaled=True)
+]
+
+@pytest.mark.parametrize('variant', pruning_variants)
+def test_pruning_variants(taxa_encoded, tree, variant):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    topology = TreeTopology(tree)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    kappa = 2.0
+    pi = np.array([0.3, 0.2, 0.25, 0.25])
+
+    f_default = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies))
+    f_variant = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies),
+        node_levels=(topology.get_node_levels() if variant['level_order'] else None), scaled=variant['scaled'])
+
+    for res_variant, res_default in zip(f_variant(kappa, pi, node_heights), f_default(kappa, pi, node_heights)):
+        assert_allclose(res_variant, res_default, rtol=VARIANT_RTOL)
+
+def test_pruning_scaled_dengue(dengue_config, dengue_sequence_dict):
+    sequence_dict = { '"{0}"'.format(name): sequence for name, sequence in dengue_sequence_dict.items() } # Names are quoted in the Newick string
+    taxa_patterns, pattern_frequencies = group_sequences(encode_sequences(sequence_dict))
+    topology = TreeTopology(newick.loads(dengue_config['newick_string'])[0])
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    kappa = dengue_config['init_values']['kappa']
+    pi = np.ones(4)/4
+    clock_rate = dengue_config['mutation_rate']
+
+    f_log = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies), clock_rate=clock_rate)
+    f_scaled = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies), clock_rate=clock_rate, scaled=True)
+
+    for res_scaled, res_log in zip(f_scaled(kappa, pi, node_heights), f_log(kappa, pi, node_heights)):
+        assert_allclose(res_scaled, res_log, rtol=VARIANT_RTOL)
+
+def test_pruning_op(taxa_encoded, tree):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    topology = TreeTopology(tree)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    kappa = 2.0
+    pi = np.array([0.3, 0.2, 0.25, 0.25])
+
+    kappa_ = tt.scalar()
+    pi_ = tt.vector()
+    node_heights_ = tt.vector()
+    substitution_model = HKYSubstitutionModel(kappa_, pi_)
+    child_transition_probs_ = substitution_model.get_transition_probs(topology.get_child_branch_lengths(node_heights_))
+    likelihood_op = PhylogeneticLikelihood(topology.node_child_indices, topology.build_sequence_table(taxa_patterns), topology.get_node_child_leaf_mask(), pattern_frequencies)
+    ll_ = likelihood_op(child_transition_probs_, pi_)
+    inputs = [kappa_, pi_, node_heights_]
+    f_op = theano.function(inputs, [ll_] + tt.grad(ll_, inputs))
+
+    f_default = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies))
+    ll_op, kappa_grad_op, pi_grad_op, node_heights_grad_op = f_op(kappa, pi, node_heights)
+    ll, kappa_grad, pi_grad, node_heights_grad = f_default(kappa, pi, node_heights)
+    assert_allclose(ll_op, ll, rtol=VARIANT_RTOL)
+    assert_allclose(kappa_grad_op, kappa_grad, rtol=VARIANT_RTOL)
+    assert_allclose(node_heights_grad_op, node_heights_grad, rtol=VARIANT_RTOL)
+    # Gap partials depend on transition probability row sums in the op, so only compare along the simplex
+    assert_allclose(pi_grad_op - pi_grad_op.mean(), pi_grad - pi_grad.mean(), rtol=VARIANT_RTOL)
+
+def test_pruning_op_single_postorder_pass(taxa_encoded, tree, monkeypatch):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    topology = TreeTopology(tree)
+    pi_ = tt.vector()
+    node_heights_ = tt.vector()
+    child_transition_probs_ = HKYSubstitutionModel(2.0, pi_).get_transition_probs(topology.get_child_branch_lengths(node_heights_))
+    likelihood_op = PhylogeneticLikelihood(topology.node_child_indices, topology.build_sequence_table(taxa_patterns), topology.get_node_child_leaf_mask(), pattern_frequencies)
+    ll_ = likelihood_op(child_transition_probs_, pi_)
+    f = theano.function([pi_, node_heights_], [ll_] + tt.grad(ll_, [pi_, node_heights_]))
+
+    make_partials = pylo.numpy_pruning.make_scaled_partial_probabilities
+    calls = []
+    def count_calls(*args, **kwargs):
+        calls.append(1)
+        return make_partials(*args, **kwargs)
+    monkeypatch.setattr(pylo.numpy_pruning, 'make_scaled_partial_probabilities', count_calls)
+    f(np.array([0.3, 0.2, 0.25, 0.25]), topology.get_init_heights()[topology.node_mask])
+    assert len(calls) == 1 # The gradient reuses the partials of the log-likelihood
+
+@pytest.mark.parametrize('variant', [dict(level_order=False, scaled=False)] + pruning_variants + [dict(analytic_gradient=True)])
+def test_pruning_batch(taxa_encoded, tree, variant):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    pattern_frequencies = np.array(pattern_frequencies)
+    topology = TreeTopology(tree)
+    init_node_heights = topology.get_init_heights()[topology.node_mask]
+    kappa = np.array([1.0, 2.0, 5.0])
+    pi = np.array([[0.25, 0.25, 0.25, 0.25], [0.5, 0.2, 0.2, 0.1], [0.2, 0.3, 0.25, 0.25]])
+    node_heights = init_node_heights * np.array([1.0, 0.5, 2.0])[:, np.newaxis]
+
+    kappa_ = tt.vector()
+    pi_ = tt.matrix()
+    node_heights_ = tt.matrix()
+    child_patterns = np.array(topology.build_sequence_table(taxa_patterns))
+    child_transition_probs_ = HKYSubstitutionModel(kappa_, pi_).get_transition_probs(topology.get_child_branch_lengths(node_heights_))
+    if variant.get('analytic_gradient', False):
+        likelihood_op = PhylogeneticLikelihood(topology.node_child_indices, child_patterns, topology.get_node_child_leaf_mask(), pattern_frequencies)
+        ll_ = likelihood_op(child_transition_probs_, pi_)
+    else:
+        ll_ = phylogenetic_log_likelihood(
+            tt.as_tensor_variable(topology.node_child_indices),
+            child_transition_probs_,
+            tt.as_tensor_variable(child_patterns),
+            tt.as_tensor_variable(topology.get_node_child_leaf_mask()),
+            pattern_frequencies,
+            pi_,
+            node_levels=(topology.get_node_levels() if variant['level_order'] else None),
+            scaled=variant['scaled']
+        )
+    f_batch = theano.function([kappa_, pi_, node_heights_], [ll_, tt.grad(ll_.sum(), kappa_), tt.grad(ll_.sum(), node_heights_)])
+    ll_batch, kappa_grad_batch, node_heights_grad_batch = f_batch(kappa, pi, node_heights)
+
+    f = get_likelihood_and_gradient_function(topology, taxa_patterns, pattern_frequencies)
+    ll, kappa_grad, _, node_heights_grad = [np.stack(res) for res in zip(*[f(*args) for args in zip(kappa, pi, node_heights)])]
+
+    assert ll_batch.shape == kappa.shape
+    assert_allclose(ll_batch, ll)
+    assert_allclose(kappa_grad_batch, kappa_grad, rtol=VARIANT_RTOL)
+    assert_allclose(node_heights_grad_batch, node_heights_grad, rtol=VARIANT_RTOL)
+
+@pytest.mark.parametrize('scaled', [False, True])
+def test_pruning_ambiguity(taxa, tree, scaled):
+    topology = TreeTopology(tree)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    kappa = 2.0
+    pi = np.array([0.3, 0.2, 0.25, 0.25])
+
+    def get_first_site_log_likelihood(human_char):
+        taxa_first_site = { name: (human_char if name == 'human' else sequence[0]) for name, sequence in taxa.items() }
+        taxa_patterns, pattern_frequencies = group_sequences(encode_sequences(taxa_first_site))
+        f = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies), scaled=scaled)
+        return f(kappa, pi, node_heights)[0]
+
+    assert_allclose(get_first_site_log_likelihood('R'), np.logaddexp(get_first_site_log_likelihood('A'), get_first_site_log_likelihood('G')))
+    assert_allclose(get_first_site_log_likelihood('N'), get_first_site_log_likelihood('-'))
+
+polytomy_newick = '(((human:0.024003,chimp:0.034003,bonobo:0.034003):0.012035,gorilla:0.036038):0.033087,orangutan:0.069125,siamang:0.102212);'
+resolved_newick = '((((human:0.024003,(chimp:0.034003,bonobo:0.034003):1e-9):0.012035,gorilla:0.036038):0.033087,orangutan:0.069125):1e-9,siamang:0.102212);'
+
+@pytest.mark.parametrize('variant', [dict(level_order=False, scaled=False)] + pruning_variants)
+def test_pruning_polytomy(taxa_encoded, variant):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    pattern_frequencies = np.array(pattern_frequencies)
+    kappa = 2.0
+    pi = np.array([0.3, 0.2, 0.25, 0.25])
+    polytomy_topology = TreeTopology(newick.loads(polytomy_newick)[0])
+    resolved_topology = TreeTopology(newick.loads(resolved_newick)[0]) # Near-zero branches have near-identity transition probabilities
+    assert not polytomy_topology.is_binary
+
+    def get_log_likelihood(topology, **kwargs):
+        f = get_likelihood_and_gradient_function(topology, taxa_patterns, pattern_frequencies, **kwargs)
+        return f(kappa, pi, topology.get_init_heights()[topology.node_mask])[0]
+
+    polytomy_log_likelihood = get_log_likelihood(
+        polytomy_topology,
+        node_levels=(polytomy_topology.get_node_levels() if variant['level_order'] else None),
+        scaled=variant['scaled'],
+        child_offsets=polytomy_topology.get_node_child_offsets()
+    )
+    assert_allclose(polytomy_log_likelihood, get_log_likelihood(resolved_topology), rtol=1e-6)
+
+@pytest.mark.parametrize('variant', [dict(level_order=False, scaled=False)] + pruning_variants)
+def test_pruning_rate_categories(taxa_encoded, tree, variant):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    pattern_frequencies = np.array(pattern_frequencies)
+    topology = TreeTopology(tree)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    child_patterns = np.array(topology.build_sequence_table(taxa_patterns))
+    kappa = 2.0
+    pi = np.array([0.3, 0.2, 0.25, 0.25])
+    category_rates = np.array([0.1, 0.5, 1.2, 2.2])
+    category_weights = np.array([0.1, 0.2, 0.3, 0.4])
+
+    child_distances_ = tt.as_tensor_variable(category_rates)[:, np.newaxis, np.newaxis] * topology.get_child_branch_lengths(tt.as_tensor_variable(node_heights))
+    ll_ = phylogenetic_log_likelihood(
+        topology.node_child_indices,
+        HKYSubstitutionModel(tt.as_tensor_variable(kappa), tt.as_tensor_variable(pi)).get_transition_probs(child_distances_),
+        child_patterns,
+        topology.get_node_child_leaf_mask(),
+        pattern_frequencies,
+        tt.as_tensor_variable(pi),
+        node_levels=(topology.get_node_levels() if variant['level_order'] else None),
+        scaled=variant['scaled'],
+        category_weights=category_weights
+    )
+
+    category_site_log_likelihoods = pylo.numpy_pruning.phylogenetic_log_likelihood( # Identity pattern frequencies give each pattern's log-likelihood
+        topology.node_child_indices,
+        HKYSubstitutionModel(kappa, pi).get_transition_probs_val(category_rates[:, np.newaxis, np.newaxis] * topology.get_child_branch_lengths_val(node_heights)),
+        pylo.numpy_pruning.get_leaf_partials(child_patterns),
+        topology.get_node_child_leaf_mask(),
+        np.eye(len(pattern_frequencies)),
+        pi
+    )
+    expected = np.log(category_weights @ np.exp(category_site_log_likelihoods)) @ pattern_frequencies
+    assert_allclose(ll_.eval(), expected)
+
+@pytest.mark.parametrize('variant', [dict(level_order=False, scaled=False)] + pruning_variants)
+def test_pruning_partitioned(taxa_encoded, tree, variant):
+    topology = TreeTopology(tree)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    site_count = len(list(taxa_encoded.values())[0])
+    partition_taxa = [{ name: sequence[:site_count // 3] for name, sequence in taxa_encoded.items() }, { name: sequence[site_count // 3:] for name, sequence in taxa_encoded.items() }]
+    partition_patterns = [group_sequences(taxa) for taxa in partition_taxa]
+    partition_child_patterns = [np.array(topology.build_sequence_table(taxa_patterns)) for taxa_patterns, _ in partition_patterns]
+    partition_pattern_frequencies = [np.array(pattern_frequencies) for _, pattern_frequencies in partition_patterns]
+    kappa = np.array([2.0, 5.0])
+    pi = np.array([[0.3, 0.2, 0.25, 0.25], [0.4, 0.1, 0.2, 0.3]])
+    partition_rates = np.array([0.5, 2.0])
+
+    kappa_ = tt.vector()
+    child_branch_lengths_ = topology.get_child_branch_lengths(tt.as_tensor_variable(node_heights))
+    child_transition_probs_ = HKYSubstitutionModel(kappa_, tt.as_tensor_variable(pi)).get_transition_probs(partition_rates[:, np.newaxis, np.newaxis] * child_branch_lengths_) # [partition, node, child, parent_char, child_char]
+    child_patterns, pattern_frequencies, site_partitions = concatenate_partitions(partition_child_patterns, partition_pattern_frequencies)
+    ll_ = phylogenetic_log_likelihood(
+        topology.node_child_indices,
+        child_transition_probs_,
+        child_patterns,
+        topology.get_node_child_leaf_mask(),
+        pattern_frequencies,
+        tt.as_tensor_variable(pi),
+        node_levels=(topology.get_node_levels() if variant['level_order'] else None),
+        scaled=variant['scaled'],
+        site_partitions=site_partitions
+    )
+    f_partitioned = theano.function([kappa_], [ll_, tt.grad(ll_.sum(), kappa_)])
+    ll_partitioned, kappa_grad_partitioned = f_partitioned(kappa)
+
+    for i, (taxa_patterns, pattern_frequencies) in enumerate(partition_patterns):
+        f = get_likelihood_and_gradient_function(topology, taxa_patterns, np.array(pattern_frequencies), clock_rate=partition_rates[i])
+        ll, kappa_grad, _, _ = f(kappa[i], pi[i], node_heights)
+        assert_allclose(ll_partitioned[i], ll, rtol=VARIANT_RTOL)
+        assert_allclose(kappa_grad_partitioned[i], kappa_grad, rtol=VARIANT_RTOL)
+
+def test_leaf_sequences_positional_model(taxa_encoded, tree): # Options are keyword-only, so extra positional arguments go to Potential
+    topology = TreeTopology(tree)
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    child_patterns = np.array(topology.build_sequence_table(taxa_patterns))
+    pattern_frequencies = np.array(pattern_frequencies)
+    substitution_model = HKYSubstitutionModel(2.0, np.ones(4) / 4)
+    child_distances = topology.get_child_branch_lengths(tt.as_tensor_variable(topology.get_init_heights()[topology.node_mask]))
+    model = pm.Model()
+    sequences = LeafSequences('sequences', topology, substitution_model, child_distances, child_patterns, pattern_frequencies, model, scaled=True)
+    partitioned = PartitionedLeafSequences('partitioned', topology, [substitution_model], child_distances, [child_patterns], [pattern_frequencies], model, scaled=True)
+    assert model.potentials == [sequences, partitioned]
+
+@pytest.mark.parametrize('variant', [dict(level_order=False, scaled=False)] + pruning_variants)
+def test_pruning_amino_acids(taxa, tree, variant):
+    topology = TreeTopology(tree)
+    node_heights = topology.get_init_heights()[topology.node_mask]
+    rng = np.random.RandomState(1)
+    taxa_amino_acids = { name: ''.join(rng.choice(list(AMINO_ACIDS.states) + ['B', 'X'], 50)) for name in taxa }
+    taxa_patterns, pattern_frequencies = group_sequences(encode_sequences(taxa_amino_acids, AMINO_ACIDS))
+    child_patterns = np.array(topology.build_sequence_table(taxa_patterns))
+    rates = rng.uniform(0.5, 2.0, 190)
+    pi = rng.dirichlet(np.ones(20))
+
+    substitution_model = GTRSubstitutionModel(tt.as_tensor_variable(rates), tt.as_tensor_variable(pi), alphabet=AMINO_ACIDS)
+    ll_ = phylogenetic_log_likelihood(
+        topology.node_child_indices,
+        substitution_model.get_transition_probs(topology.get_child_branch_lengths(tt.as_tensor_variable(node_heights))),
+        child_patterns,
+        topology.get_node_child_leaf_mask(),
+        np.array(pattern_frequencies),
+        tt.as_tensor_variable(pi),
+        node_levels=(topology.get_node_levels() if variant['level_order'] else None),
+        scaled=variant['scaled'],
+        state_partials=AMINO_ACIDS.state_partials
+    )
+    expected = pylo.numpy_pruning.leaf_sequences_log_likelihood(topology, GTRSubstitutionModel(rates, pi, alphabet=AMINO_ACIDS), topology.get_child_branch_lengths_val(node_heights), child_patterns, pattern_frequencies)
+    assert_allclose(ll_.eval(), expected)
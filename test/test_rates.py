@@ -0,0 +1,20 @@
+import numpy as np
+import theano
+import pytest
+from numpy.testing import assert_allclose
+
+from pylo.rates import discrete_gamma_rates_val, get_discrete_gamma_rates, DiscreteGammaRatesDerivative
+
+def test_discrete_gamma_rates_val():
+    rates = discrete_gamma_rates_val(0.5, 4)
+    assert_allclose(rates, [0.033388, 0.251916, 0.820268, 2.894428], atol=1e-6) # Yang (1994)
+    assert_allclose(rates.mean(), 1.0)
+
+@pytest.mark.parametrize('alpha', [0.2, 1.0, 5.0])
+def test_discrete_gamma_rates_gradient(alpha):
+    theano.gradient.verify_grad(lambda alpha: get_discrete_gamma_rates(alpha, 4), [np.array(alpha)], rng=np.random.RandomState(1))
+
+def test_discrete_gamma_rates_batched_alpha():
+    for op in [get_discrete_gamma_rates, DiscreteGammaRatesDerivative(4)]:
+        with pytest.raises(TypeError):
+            op(np.array([0.5, 1.0]))
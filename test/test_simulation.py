@@ -0,0 +1,33 @@
+import numpy as np
+import newick
+from numpy.testing import assert_allclose
+from pylo.topology import TreeTopology
+from pylo.hky import HKYSubstitutionModel
+from pylo.simulation import simulate_coalescent_tree, simulate_sequences
+
+def get_root_heights(sampling_times, pop_sizes, change_times=[], sample_count=2000):
+    random_state = np.random.RandomState(1)
+    return np.array([TreeTopology(simulate_coalescent_tree(sampling_times, pop_sizes, change_times, random_state=random_state)).get_init_heights()[-1] for _ in range(sample_count)])
+
+def test_simulate_coalescent_tree_constant():
+    root_heights = get_root_heights(np.zeros(5), 2.0)
+    assert_allclose(root_heights.mean(), 2 * 2.0 * (1 - 1 / 5), atol=4 * root_heights.std() / np.sqrt(len(root_heights)))
+
+def test_simulate_coalescent_tree_grid():
+    root_heights = get_root_heights(np.zeros(2), [1.0, 4.0], [0.5])
+    expected = (1 - np.exp(-0.5)) + np.exp(-0.5) * 4.0 # Survival function integrated over each population size interval
+    assert_allclose(root_heights.mean(), expected, atol=4 * root_heights.std() / np.sqrt(len(root_heights)))
+
+def test_simulate_coalescent_tree_serial():
+    sampling_times = np.random.RandomState(2).uniform(0.0, 5.0, size=20)
+    topology = TreeTopology(simulate_coalescent_tree(sampling_times, 1.0))
+    leaf_taxa = [int(name[1:]) for name in topology.names[topology.leaf_mask]]
+    assert_allclose(topology.get_init_heights()[topology.leaf_mask], sampling_times[leaf_taxa] - sampling_times.min(), atol=1e-12)
+
+def test_simulate_sequences():
+    substitution_model = HKYSubstitutionModel(2.0, np.array([0.3, 0.2, 0.25, 0.25]))
+    sequence_dict = simulate_sequences(newick.loads('(A:0.3,B:0.3);')[0], substitution_model, 100000, random_state=np.random.RandomState(1))
+    differences = np.array(list(sequence_dict['A'])) != np.array(list(sequence_dict['B']))
+    expected = 1 - np.sum(substitution_model.pi * np.diag(substitution_model.get_transition_probs_val(0.6)))
+    assert_allclose(differences.mean(), expected, atol=4 * np.sqrt(expected * (1 - expected) / len(differences)))
+    assert_allclose([sequence_dict['A'].count(char) / 100000 for char in 'ACGT'], substitution_model.pi, atol=0.01)
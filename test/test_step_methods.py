@@ -0,0 +1,47 @@
+import numpy as np
+import theano
+import pymc3 as pm
+from numpy.testing import assert_allclose
+from pylo.topology import TreeTopology
+from pylo.transform import group_sequences
+from pylo.hky import HKYSubstitutionModel
+from pylo.pruning import LeafSequences
+from pylo.tree.coalescent import CoalescentTree, ConstantPopulationFunction
+from pylo.step_methods import CachedTreeMetropolis
+
+def test_cached_tree_metropolis(taxa_encoded, tree):
+    taxa_patterns, pattern_frequencies = group_sequences(taxa_encoded)
+    topology = TreeTopology(tree)
+    child_patterns = np.array(topology.build_sequence_table(taxa_patterns))
+
+    with theano.change_flags(compute_test_value='off'), pm.Model() as model: # pm.Model leaves compute_test_value set on exit
+        pop_size = pm.Lognormal('pop_size', mu=-2.0, sd=1.0)
+        tree_heights = CoalescentTree('tree', topology, ConstantPopulationFunction(topology, pop_size), testval=topology.get_init_heights()[topology.node_mask])
+        substitution_model = HKYSubstitutionModel(2.0, np.array([0.3, 0.2, 0.25, 0.25]))
+        sequences = LeafSequences('sequences', topology, substitution_model, topology.get_child_branch_lengths(tree_heights), child_patterns, np.array(pattern_frequencies), analytic_gradient=True)
+        step = CachedTreeMetropolis([tree_heights], sequences, scaling=0.1)
+        trace = pm.sample(draws=50, tune=0, chains=1, step=[step, pm.Metropolis([pop_size])], compute_convergence_checks=False, progressbar=False)
+
+    partial_updates = trace.get_sampler_stats('partial_updates')
+    assert partial_updates.max() <= 2 * topology.get_internal_node_count()
+
+    last_point = trace.point(-1)
+    point = { var.name: last_point[var.name] for var in model.free_RVs }
+    other_logp, likelihood_inputs = step.fs
+    assert_allclose(other_logp(point) + step.cache.log_likelihood(*likelihood_inputs(point)), model.logp(point))
+
+    child_transition_probs, character_frequencies = likelihood_inputs(point)
+    step.cache.store()
+    for node in range(topology.get_internal_node_count()):
+        path_length = 0 # Nodes from the branch's parent to the root
+        ancestor = node
+        while ancestor >= 0:
+            path_length += 1
+            ancestor = topology.node_parent_indices[ancestor]
+        for child in range(2): # A proposal changing only this branch
+            proposed_transition_probs = np.array(child_transition_probs)
+            proposed_transition_probs[node, child] = proposed_transition_probs[node, child] @ proposed_transition_probs[node, child]
+            update_count = step.cache.update_count
+            step.cache.log_likelihood(proposed_transition_probs, character_frequencies)
+            assert step.cache.update_count - update_count == path_length
+            step.cache.restore()
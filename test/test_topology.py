@@ -0,0 +1,78 @@
+import sys
+import pytest
+import numpy as np
+import newick
+import theano
+import theano.tensor as tt
+from numpy.testing import assert_allclose, assert_array_equal
+
+from pylo.topology import TreeTopology, SharedTreeTopology
+
+def test_topology_arrays():
+    topology = TreeTopology(newick.loads('((A:0.4,B:0.2):0.6,(C:0.3,D:0.5):0.5)')[0])
+    assert_array_equal(topology.names, ['A', 'B', None, 'C', 'D', None, None])
+    assert_array_equal(topology.leaf_mask, [True, True, False, True, True, False, False])
+    assert_array_equal(topology.parent_indices, [2, 2, 6, 5, 5, 6, -1])
+    assert_array_equal(topology.child_indices, [[-1, -1], [-1, -1], [0, 1], [-1, -1], [-1, -1], [3, 4], [2, 5]])
+    assert_allclose(topology.init_heights, [0.0, 0.2, 0.4, 0.2, 0.0, 0.5, 1.0])
+    assert_allclose(topology.max_leaf_descendant_heights, [0.0, 0.2, 0.2, 0.2, 0.0, 0.2, 0.2])
+    assert_array_equal(topology.node_child_indices, [[-1, -1], [-1, -1], [0, 1]])
+    assert_array_equal(topology.node_parent_indices, [2, 2, -1])
+    assert [list(level) for level in topology.get_node_depth_levels()] == [[2], [0, 1]]
+
+def get_caterpillar(taxon_count): # Internal node heights 1, ..., taxon_count - 1
+    node = newick.Node(name='T0', length='1.0')
+    for i in range(1, taxon_count):
+        node = newick.Node(descendants=[node, newick.Node(name='T{0}'.format(i), length=str(float(i)))], length='1.0')
+    return node
+
+def test_topology_deep_caterpillar():
+    taxon_count = 2 * sys.getrecursionlimit()
+    topology = TreeTopology(get_caterpillar(taxon_count))
+    assert topology.get_taxon_count() == taxon_count
+    assert_allclose(topology.get_init_heights()[topology.node_mask], np.arange(1.0, taxon_count))
+    assert_array_equal(topology.node_child_indices[1:, 0], np.arange(taxon_count - 2))
+    assert topology.node_depth_levels is None # Built only for level-order heights
+    assert [list(level) for level in topology.get_node_depth_levels()] == [[node_index] for node_index in range(taxon_count - 2, -1, -1)]
+
+def test_topology_polytomy():
+    topology = TreeTopology(newick.loads('((A:0.4,B:0.2,C:0.1):0.6,D:1.0)')[0])
+    assert not topology.is_binary
+    assert_array_equal(topology.parent_indices, [3, 3, 3, 5, 5, -1])
+    assert_array_equal(topology.child_offsets, [0, 0, 0, 0, 3, 3, 5])
+    assert_array_equal(topology.flat_child_indices, [0, 1, 2, 3, 4])
+    assert_array_equal(topology.node_child_offsets, [0, 3, 5])
+    assert_array_equal(topology.node_child_indices, [-1, -1, -1, 0, -1])
+    assert_array_equal(topology.get_node_child_leaf_mask(), [True, True, True, False, True])
+    assert_allclose(topology.get_child_branch_lengths_val(topology.get_init_heights()[topology.node_mask]), [0.4, 0.2, 0.1, 0.6, 1.0])
+    assert [list(level) for level in topology.get_node_levels()] == [[0], [1]]
+
+def test_shared_topology_set_tree():
+    topology = SharedTreeTopology(newick.loads('(((A:0.1,B:0.3):0.2,C:0.4):0.5,(D:0.2,E:0.6):0.4)')[0])
+    node_heights = tt.vector()
+    root_val, proportions = tt.scalar(), tt.vector()
+    heights_sorted, node_mask_sorted = topology.get_heights_sorted(node_heights)
+    f = theano.function([node_heights], [topology.get_child_branch_lengths(node_heights), heights_sorted, node_mask_sorted] + list(topology.get_proportions(node_heights)))
+    g = theano.function([root_val, proportions], topology.get_heights(root_val, proportions))
+
+    tree = newick.loads('((((A:0.1,B:0.1):0.1,C:0.4):0.1,D:0.2):0.3,E:0.9)')[0] # Same taxon count, different shape
+    other_topology = TreeTopology(tree)
+    topology.set_tree(tree)
+    other_node_heights = other_topology.get_init_heights()[other_topology.node_mask]
+    branch_lengths, heights_sorted_val, node_mask_sorted_val, proportions_val, root_val_val = f(other_node_heights)
+    assert_allclose(branch_lengths, other_topology.get_child_branch_lengths_val(other_node_heights))
+    assert_allclose(heights_sorted_val, np.sort(other_topology.get_init_heights()))
+    assert node_mask_sorted_val.sum() == other_topology.get_internal_node_count()
+    expected_proportions, expected_root_val = other_topology.get_proportions(other_node_heights)
+    assert_allclose(proportions_val, expected_proportions)
+    assert_allclose(root_val_val, expected_root_val)
+    assert_allclose(g(root_val_val, proportions_val), other_node_heights)
+
+@pytest.mark.parametrize('level_order', [False, True])
+def test_heights_caterpillar_graph_size(level_order):
+    def get_graph_size(taxon_count): # Deep trees must not add graph nodes per level
+        topology = TreeTopology(get_caterpillar(taxon_count))
+        root_val, proportions = tt.scalar(), tt.vector()
+        heights = topology.get_heights(root_val, proportions, level_order=level_order)
+        return len(theano.gof.graph.io_toposort([root_val, proportions], [heights]))
+    assert get_graph_size(200) == get_graph_size(400)
@@ -68,3 +68,28 @@ def test_tree_height_proportion_transform_jacobian(newick_string, constrained_pr
     log_det_jac_func = theano.function([transformed_], log_det_jac_)
     log_det_jac = log_det_jac_func(unconstrain_proportions(constrained_proportions, root_val, use_max, max_root_val))
     assert_allclose(log_det_jac, log_det_jac_expected, atol=ATOL)
+
+
+def test_tree_height_proportion_transform_level_order(tree):
+    topology = TreeTopology(tree)
+    transformed = np.random.RandomState(1).normal(size=topology.get_internal_node_count())
+    transformed_ = tt.vector()
+    root_val_ = tt.exp(transformed_[-1])
+    proportions_ = tt.nnet.sigmoid(transformed_[:-1])
+    results = []
+    for level_order in [True, False]:
+        node_heights_ = topology.get_heights(root_val_, proportions_, level_order=level_order)
+        results.append(theano.function([transformed_], [node_heights_, theano.gradient.jacobian(node_heights_, transformed_)])(transformed))
+    (level_order_heights, level_order_jac), (scan_heights, scan_jac) = results
+    assert_allclose(level_order_heights, scan_heights, atol=ATOL)
+    assert_allclose(level_order_jac, scan_jac, atol=ATOL)
+
+def test_tree_height_proportion_transform_shared_backward(tree):
+    topology = TreeTopology(tree)
+    transform = TreeHeightProportionTransform(topology)
+    transformed_ = tt.vector()
+    node_heights_ = transform.backward(transformed_)
+    log_det_jac_ = transform.jacobian_det(transformed_)
+    assert transform.backward(transformed_) is node_heights_
+    assert node_heights_ in theano.gof.graph.ancestors([log_det_jac_])
+    assert transform.backward(tt.vector()) is not node_heights_